@@ -13,6 +13,10 @@ setup(
         'adafruit-circuitpython-bme680',
         'w1thermsensor',
     ],
+    extras_require={
+        'reprocess': ['numpy'],
+        'msgpack': ['msgpack'],
+    },
     entry_points='''
         [console_scripts]
         weather_station=weather_station.cli:cli
@@ -0,0 +1,105 @@
+"""
+Adaptive sampling of polled sensors.
+
+A fixed period samples stable overnight conditions far too often and a passing
+front too slowly. AdaptiveSampling sits between a polled sensor and its report
+function and tracks how fast each field changes, as an exponentially weighted
+moving average of |change| / second between consecutive readings. It sets the
+period of the sensor's scheduler job so that the fastest changing field moves
+by about its RESOLUTION per sample, between min_interval_s and max_interval_s.
+
+The period shrinks by at most half and grows by at most a quarter per reading,
+so a front is picked up within a few samples while one quiet reading in
+between doesn't drop the rate right away. Every reading carries the current period as
+<sensor name>_sample_interval_s.
+"""
+import fnmatch
+import math
+import time
+
+# field (or fnmatch pattern) -> change (in its unit) to resolve per sample,
+# above the sensor noise
+RESOLUTION = {
+    "temperature_c": 0.05,
+    "temperature_*_c": 0.05,
+    "humidity_pct": 0.25,
+    "pressure_hpa": 0.05,
+}
+# Weight of the newest rate of change in the moving average.
+SMOOTHING = 0.2
+MAX_SPEED_UP = 0.5
+MAX_SLOW_DOWN = 1.25
+# Periods from here on are whole seconds, so sensors with the same period still
+# sample together. Below it, a quarter of the period is less than a second.
+WHOLE_SECONDS_FROM_S = 4
+
+
+class AdaptiveSampling:
+    def __init__(self, name, job, report_function, min_interval_s, max_interval_s, resolution=RESOLUTION):
+        """job: the scheduler.Job sampling the sensor called name."""
+        self.job = job
+        self.report_function = report_function
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max(max_interval_s, min_interval_s)
+        self.resolution = resolution
+        self.interval_field = f"{name}_sample_interval_s"
+        # field -> (ts, value) of the previous reading
+        self.previous = {}
+        # field -> moving average of |change| / s
+        self.rates = {}
+        # field -> its resolution, None if it isn't tracked
+        self._resolved = {}
+        job.period_s = min_interval_s
+
+    def __call__(self, data, ts=None):
+        if ts is None:
+            ts = time.time()
+        self.observe(data, ts)
+        data = dict(data)
+        data[self.interval_field] = self.job.period_s
+        return self.report_function(data=data, ts=ts)
+
+    def observe(self, data, ts):
+        """Updates the rates of change with a reading and adjusts the period."""
+        target_s = self.max_interval_s
+        for field, value in data.items():
+            resolution = self.field_resolution(field)
+            if resolution is None or value is None:
+                continue
+            previous = self.previous.get(field)
+            self.previous[field] = (ts, value)
+            if previous is None or ts <= previous[0]:
+                continue
+            rate = abs(value - previous[1]) / (ts - previous[0])
+            average = self.rates.get(field)
+            average = rate if average is None else average + SMOOTHING * (rate - average)
+            self.rates[field] = average
+            if average > 0:
+                target_s = min(target_s, resolution / average)
+        self.job.period_s = self.next_period(target_s)
+
+    def field_resolution(self, field):
+        if field not in self._resolved:
+            resolution = self.resolution.get(field)
+            if resolution is None:
+                resolution = next(
+                    (
+                        resolution
+                        for pattern, resolution in self.resolution.items()
+                        if fnmatch.fnmatchcase(field, pattern)
+                    ),
+                    None,
+                )
+            self._resolved[field] = resolution
+        return self._resolved[field]
+
+    def next_period(self, target_s):
+        current_s = self.job.period_s
+        period_s = min(max(target_s, current_s * MAX_SPEED_UP), current_s * MAX_SLOW_DOWN)
+        if period_s >= WHOLE_SECONDS_FROM_S:
+            # Rounded towards the current period, so a step stays within the limits.
+            if period_s > current_s:
+                period_s = max(math.floor(period_s), current_s)
+            else:
+                period_s = min(math.ceil(period_s), current_s)
+        return min(max(period_s, self.min_interval_s), self.max_interval_s)
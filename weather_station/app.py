@@ -1,74 +1,248 @@
 import datetime
-import json
+import functools
+import time
 import paho.mqtt.client as mqtt
-import calendar
-from .sensors import anemometer, rainfall, wind_vane, temperature, bme680
-
-
-def now(delta=None):
-    d = datetime.datetime.utcnow()
-    if delta:
-        d = d + delta
-    unixtime = calendar.timegm(d.utctimetuple())
-    return unixtime * 1000
+from . import conditions, derived, encoding, hardware, metrics, publisher, reporting, scheduler, sensors, spool, store, workers
+from .hardware import gpio, notify
 
 
 class WeatherStationApplication:
-    def __init__(self, tb_user=None, tb_access_token=None, tb_host=None, tb_port=1883):
+    def __init__(
+        self,
+        tb_user=None,
+        tb_access_token=None,
+        tb_host=None,
+        tb_port=1883,
+        max_batch_size=publisher.MAX_BATCH_SIZE,
+        max_batch_delay_s=publisher.MAX_BATCH_DELAY_S,
+        max_queue_size=publisher.MAX_QUEUE_SIZE,
+        overflow_policy=publisher.DROP_OLDEST,
+        spool_dir=None,
+        deadband=True,
+        encoding_name="json",
+        console=True,
+        store_dir=None,
+        http_host=conditions.HTTP_HOST,
+        http_port=None,
+        sensor_configs=None,
+        bme680_profile=None,
+        bme680_interval_s=None,
+        processes=False,
+        edge_batches=False,
+        startup_profile=None,
+        altitude_m=None,
+        pipeline=None,
+    ):
+        """
+        sensor_configs: sensors.SensorConfigs, sensors.DEFAULT_SENSORS if None.
+        bme680_profile and bme680_interval_s apply to BME680s configured without.
+        altitude_m: of the station, to report the sea-level pressure.
+        pipeline: a pipeline.Pipeline the published and stored readings go through.
+        """
         self.tb_client = None
+        self.tb_connected = False
         self.tb_access_token = tb_access_token
         self.tb_user = tb_user
         self.tb_host = tb_host
         self.tb_port = tb_port
+        self.console = console
+        self.store = store.TimeSeriesStore(store_dir) if store_dir else None
+        self.publisher = None
+        uplink = bool(self.tb_host and self.tb_access_token)
+        if uplink or self.store:
+            self.publisher = publisher.TelemetryPublisher(
+                get_client=self._setup_report_connection if uplink else None,
+                is_connected=lambda: self.tb_connected,
+                max_queue_size=max_queue_size,
+                max_batch_size=max_batch_size,
+                max_batch_delay_s=max_batch_delay_s,
+                overflow_policy=overflow_policy,
+                spool=spool.Spool(spool_dir) if spool_dir and uplink else None,
+                sinks=[self.store.insert] if self.store else (),
+                report_filter=reporting.DeadbandFilter() if deadband else None,
+                encoder=encoding.get_encoder(encoding_name),
+                pipeline=pipeline,
+            )
+
+        self.conditions = conditions.CurrentConditions()
+        self.conditions_server = None
+        if http_port:
+            self.conditions_server = conditions.ConditionsServer(
+                self.conditions, host=http_host, port=http_port
+            )
+
+        self.derived = derived.DerivedMetrics(altitude_m=altitude_m)
+        self.scheduler = scheduler.SensorScheduler()
+        self.self_telemetry = metrics.SelfTelemetry()
+        if self.publisher:
+            metrics.REGISTRY.gauge(
+                "publisher_queue_depth", "Readings waiting for the publisher", self.publisher.queue.qsize
+            )
+            metrics.REGISTRY.gauge(
+                "publisher_dropped_readings", "Readings dropped by the publisher",
+                lambda: self.publisher.dropped_count,
+            )
+            metrics.REGISTRY.gauge(
+                "publisher_inflight_publishes", "Spooled publishes waiting for a PUBACK",
+                lambda: len(self.publisher._inflight),
+            )
+
+        if sensor_configs is None:
+            sensor_configs = sensors.configs_from_types(sensors.DEFAULT_SENSORS)
+        for config in sensor_configs:
+            if config.sensor_type == "bme680":
+                if bme680_profile:
+                    config.options.setdefault("profile", bme680_profile)
+                if config.interval_s is None:
+                    config.interval_s = bme680_interval_s
+        self.sensor_configs = sensor_configs
+        self.edge_batches = edge_batches
+        self.notification_reader = None
+        self.sensors = {}
+        self.workers = None
+        if processes:
+            # The sensors run in worker processes, see weather_station.workers.
+            self.workers = workers.Supervisor(self.report)
+            edge_configs = [config for config in sensor_configs if config.kind == sensors.EDGE]
+            polled_configs = [config for config in sensor_configs if config.kind == sensors.POLLED]
+            if edge_configs:
+                self.workers.add_worker("gpio", functools.partial(
+                    run_sensors, configs=edge_configs, edge_batches=edge_batches,
+                ))
+            if polled_configs:
+                self.workers.add_worker("polled", functools.partial(run_sensors, configs=polled_configs))
+            metrics.REGISTRY.gauge(
+                "worker_restarts", "Sensor worker processes restarted", lambda: self.workers.restarts
+            )
+            metrics.REGISTRY.gauge(
+                "worker_dropped_readings", "Readings dropped because a worker's ring was full",
+                lambda: self.workers.dropped_count,
+            )
+            metrics.REGISTRY.gauge(
+                "worker_corrupt_readings", "Readings skipped because their record couldn't be decoded",
+                lambda: self.workers.corrupt_count,
+            )
+            return
 
-#        self.anemometer_1 = anemometer.Anemometer(report_function=self.report)
-        self.rainfall_1 = rainfall.Rainfall(report_function=self.report)
-#        self.wind_vane_1 = wind_vane.WindVane(report_function=self.report)
-        # self.temperature_1 = temperature.Temperature(report_function=self.report)
-        self.bme680_1 = bme680.BME680(report_function=self.report)
+        self.sensors = sensors.create_sensors(sensor_configs, self.reporter, profile=startup_profile)
 
     def start(self):
-#        self.anemometer_1.start()
-        self.rainfall_1.start()
-#        self.wind_vane_1.start()
-        # self.temperature_1.start()
-        self.bme680_1.start()
+        if self.publisher:
+            self.publisher.start()
+        if self.conditions_server:
+            self.conditions_server.start()
+        if self.workers:
+            self.workers.start()
+        else:
+            sensors.start_sensors(self.sensor_configs, self.sensors, self.scheduler)
+            if self.edge_batches:
+                self.notification_reader = read_edges_in_batches(self.sensor_configs, self.sensors)
+            check_gpio(self.sensor_configs, self.scheduler)
+        self.scheduler.add_job(
+            "self_telemetry", self.report_metrics, period_s=metrics.SELF_TELEMETRY_INTERVAL_S,
+        )
+        self.scheduler.start()
+
+    def stop(self):
+        self.scheduler.stop()
+        if self.workers:
+            self.workers.stop()
+        else:
+            if self.notification_reader:
+                self.notification_reader.stop()
+            sensors.stop_sensors(self.sensor_configs, self.sensors)
+            hardware.get_backend().close()
+        if self.publisher:
+            self.publisher.stop()
+        if self.store:
+            self.store.close()
+        if self.conditions_server:
+            self.conditions_server.stop()
 
     def _setup_report_connection(self):
+        # Only called from the publisher thread.
         if self.tb_client:
-            return
+            return self.tb_client
         if self.tb_host and self.tb_access_token:
-            self.tb_client = client = mqtt.Client()
+            client = mqtt.Client()
             client.username_pw_set(self.tb_user, self.tb_access_token)
-            client.connect(self.tb_host, self.tb_port, 60)
+            client.on_connect = self._on_connect
+            client.on_disconnect = self._on_disconnect
+            # Connects (and reconnects) in the background. Until then, readings
+            # stay in the spool.
+            client.connect_async(self.tb_host, self.tb_port, 60)
             client.loop_start()
-        else:
-            return
+            self.tb_client = client
+        return self.tb_client
 
-    def report(self, data, ts=None):
-        self._setup_report_connection()
-        prettydata = " ".join([
-            f"{key}: {value}" for key, value in sorted(data.items())
-        ])
-        print(f"[{datetime.datetime.fromtimestamp(ts)}] {prettydata}")
+    def _on_connect(self, client, userdata, flags, rc):
+        self.tb_connected = rc == 0
 
-        if not self.tb_client:
-            return
-        payload = {
-            "ts": now(),
-            "values": data,
-        }
-        self.tb_client.publish(
-            "devices/weather-station/telemetry", json.dumps(payload), 1
-        )
+    def _on_disconnect(self, client, userdata, rc):
+        self.tb_connected = False
+
+    def reporter(self, source):
+        """The report function for the sensor called source."""
+        return functools.partial(self.report, source=source)
+
+    def report_metrics(self, ts):
+        self.report(self.self_telemetry.sample(), ts=ts, source="metrics")
+
+    def report(self, data, ts=None, source=None):
+        # Called from the pigpio callback and sensor threads. Must not block.
+        with metrics.REPORT_SECONDS.time():
+            self._report(data, ts, source)
 
+    def _report(self, data, ts, source):
+        if ts is None:
+            ts = time.time()
+        self.conditions.update(data, ts, source)
+        if self.console:
+            prettydata = " ".join([
+                f"{key}: {value}" for key, value in sorted(data.items())
+            ])
+            print(f"[{datetime.datetime.fromtimestamp(ts)}] {prettydata}")
 
-def start():
-    anemometer_1 = anemometer.Anemometer()
-    anemometer_1.start()
+        if self.publisher:
+            self.publisher.put(ts, data)
+
+        derived_data = self.derived.update(data, ts)
+        if derived_data:
+            self._report(derived_data, ts, "derived")
+
+
+def read_edges_in_batches(sensor_configs, started_sensors):
+    """Feeds the started edge sensors from pigpio's notification pipe instead of callbacks."""
+    reader = notify.NotificationReader(hardware.get_backend().gpio())
+    for config in sensor_configs:
+        if config.kind == sensors.EDGE and config.name in started_sensors:
+            reader.add_sensor(started_sensors[config.name])
+    reader.start()
+    return reader
+
+
+def check_gpio(sensor_configs, sensor_scheduler):
+    """Reconnects to pigpiod when it goes away, if any of the sensors use it."""
+    if any(config.kind == sensors.EDGE for config in sensor_configs):
+        sensor_scheduler.add_job(
+            "gpio_check", lambda ts: hardware.get_backend().gpio().check(),
+            period_s=gpio.CHECK_INTERVAL_S,
+        )
 
-    rainfall_1 = rainfall.Rainfall()
-    rainfall_1.start()
 
-    wind_vane_1 = wind_vane.WindVane()
-    wind_vane_1.start()
+def run_sensors(reporter, stopped, configs, edge_batches=False):
+    """A worker process running the sensors of configs."""
+    worker_sensors = sensors.create_sensors(configs, reporter)
+    sensor_scheduler = scheduler.SensorScheduler()
+    sensors.start_sensors(configs, worker_sensors, sensor_scheduler)
+    check_gpio(configs, sensor_scheduler)
+    if sensor_scheduler.jobs:
+        sensor_scheduler.start()
+    reader = read_edges_in_batches(configs, worker_sensors) if edge_batches else None
+    stopped.wait()
+    if reader:
+        reader.stop()
+    if sensor_scheduler.jobs:
+        sensor_scheduler.stop()
+    sensors.stop_sensors(configs, worker_sensors)
+    hardware.get_backend().close()
@@ -0,0 +1,382 @@
+"""
+Benchmarks of the hot paths on simulated hardware.
+
+Every benchmark is a setup function that returns the callable to measure, or
+(callable, teardown) if it started something that has to be stopped again. Each
+callable is run for a number of iterations and we record:
+
+- ops/s of a plain loop
+- p50/p99 latency of individually timed calls
+- bytes allocated (peak) and retained per call, measured with tracemalloc.
+  CPython has no cheap allocation counter, so this stands in for it.
+
+Results are stored as JSON so they can be compared between commits.
+"""
+import contextlib
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from . import encoding, hardware, publisher
+from .hardware import simulated
+
+BENCHMARKS = {}
+
+# A regression is a drop of ops/s or a rise of p99 latency by more than this.
+REGRESSION_THRESHOLD_PCT = 10.0
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def discard(data, ts=None):
+    pass
+
+
+class FakeMessageInfo:
+    rc = 0
+
+    def is_published(self):
+        return True
+
+
+class FakeMQTTClient:
+    """In-process stand-in for paho's mqtt.Client."""
+
+    def __init__(self):
+        self.message_count = 0
+        self.payload_bytes = 0
+
+    def publish(self, topic, payload, qos=0):
+        self.message_count += 1
+        self.payload_bytes += len(payload)
+        return FakeMessageInfo()
+
+
+# Benchmarks #
+##############
+
+
+@benchmark("anemometer.handle_tick")
+def bench_anemometer_handle_tick(backend):
+    from .sensors import anemometer
+
+    sensor = anemometer.Anemometer(report_function=discard)
+    ticks = itertools.count(0, 20000)
+    return lambda: sensor.handle_tick(anemometer.PIN_ANEMOMETER, 1, next(ticks) & 0xFFFFFFFF)
+
+
+@benchmark("anemometer.aggregate")
+def bench_anemometer_aggregate(backend):
+    from .sensors import anemometer
+
+    sensor = anemometer.Anemometer(report_function=discard)
+    ticks = itertools.count(0, 20000)
+
+    def run():
+        for _ in range(12):
+            sensor.handle_tick(anemometer.PIN_ANEMOMETER, 1, next(ticks) & 0xFFFFFFFF)
+        backend.clock.elapsed_us += round(anemometer.SAMPLE_INTERVAL_S * 1e6)
+        sensor.aggregate()
+
+    return run
+
+
+@benchmark("rainfall.handle_tick")
+def bench_rainfall_handle_tick(backend):
+    from .sensors import rainfall
+
+    sensor = rainfall.Rainfall(report_function=discard)
+
+    def run():
+        # Every tip is far enough from the last one to be reported (worst case).
+        backend.clock.elapsed_us += 1500000
+        sensor.handle_tick(rainfall.PIN, 1, backend.clock.tick)
+
+    return run
+
+
+@benchmark("wind_vane.cbf")
+def bench_wind_vane_cbf(backend):
+    from .sensors import wind_vane
+
+    sensor = wind_vane.WindVane(report_function=discard)
+    frame = simulated.wind_vane_frame(5)
+    # A gap that starts a frame, the pulses and a gap that ends it.
+    gaps = itertools.cycle([wind_vane.PRE_US + 1000] + frame + [wind_vane.POST_US + 1000])
+    levels = itertools.cycle([0, 1])
+
+    def run():
+        backend.clock.elapsed_us += next(gaps)
+        sensor.cbf(wind_vane.PIN_WIND_VANE, next(levels), backend.clock.tick)
+        if sensor.frames.full():
+            sensor.process_frames()
+
+    return run
+
+
+@benchmark("metrics.instrumented_callback")
+def bench_metrics_instrumented_callback(backend):
+    from . import metrics
+    from .sensors import rainfall
+
+    sensor = rainfall.Rainfall(report_function=discard)
+    callback = metrics.instrument_callback("benchmark", sensor.handle_tick)
+
+    def run():
+        backend.clock.elapsed_us += 1500000
+        callback(rainfall.PIN, 1, backend.clock.tick)
+
+    return run
+
+
+@benchmark("notify.wind_vane_batch")
+def bench_notify_wind_vane(backend):
+    from .hardware import notify
+    from .sensors import wind_vane
+
+    sensor = wind_vane.WindVane(report_function=discard)
+    reader = notify.NotificationReader(backend.gpio())
+    reader.add_sensor(sensor)
+    frame = simulated.wind_vane_frame(5)
+    gaps = [wind_vane.PRE_US + 1000] + frame + [wind_vane.POST_US + 1000]
+    # 1000 / len(gaps) whole frames, compare with that many runs of wind_vane.cbf.
+    edge_count = 1000 // len(gaps) * len(gaps)
+    gaps = itertools.cycle(gaps)
+    events = []
+    for index in range(edge_count):
+        backend.clock.elapsed_us += next(gaps)
+        events.append((backend.clock.tick, 0, (index % 2) << wind_vane.PIN_WIND_VANE))
+    chunk = notify.pack_reports(events)
+
+    def run():
+        reader.seqno = None
+        reader.process(chunk)
+        sensor.process_frames()
+
+    return run
+
+
+@benchmark("wind_vane.compare")
+def bench_wind_vane_compare(backend):
+    from .sensors import wind_vane
+
+    sensor = wind_vane.WindVane(report_function=discard)
+    frame_1 = simulated.wind_vane_frame(5)
+    frame_2 = [pulse + 20 for pulse in frame_1]
+    return lambda: sensor.compare(frame_1[:], frame_2)
+
+
+@benchmark("bme680.get_readings")
+def bench_bme680_get_readings(backend):
+    from .sensors import bme680
+
+    sensor = bme680.BME680(report_function=discard)
+    return sensor.get_readings
+
+
+@benchmark("app.report")
+def bench_app_report(backend):
+    from .app import WeatherStationApplication
+
+    app = WeatherStationApplication(tb_host="benchmark", tb_access_token="benchmark", console=False)
+    app.tb_client = FakeMQTTClient()
+    app.tb_connected = True
+    app.publisher.start()
+    data = {"temperature_c": 12.3, "humidity_pct": 71.2, "pressure_hpa": 1013.2, "gas_ohms": 51234}
+    # The publisher thread would keep flushing during the benchmarks after this one.
+    return lambda: app.report(data, ts=backend.time()), app.publisher.stop
+
+
+@benchmark("derived.update")
+def bench_derived_update(backend):
+    from . import derived
+
+    derived_metrics = derived.DerivedMetrics(altitude_m=500)
+    data = {"temperature_c": 12.3, "humidity_pct": 71.2, "pressure_hpa": 1013.2, "gas_ohms": 51234}
+    derived_metrics.update({"wind_speed_km_per_h": 12.0}, backend.time())
+    return lambda: derived_metrics.update(data, backend.time())
+
+
+@benchmark("publisher.flush")
+def bench_publisher_flush(backend):
+    client = FakeMQTTClient()
+    telemetry_publisher = publisher.TelemetryPublisher(get_client=lambda: client)
+    start_ms = int(backend.time() * 1000)
+    batch = [
+        (start_ms + i * 1000, {"wind_speed_km_per_h": 10.0 + i % 7, "rain_amount_mm": 0.08})
+        for i in range(publisher.MAX_BATCH_SIZE)
+    ]
+    return lambda: telemetry_publisher.flush(batch)
+
+
+def storm_batch(backend, size=publisher.MAX_BATCH_SIZE):
+    """A publisher batch of anemometer, rain and BME680 readings."""
+    start_ms = int(backend.time() * 1000)
+    bme680_readings = simulated.synthetic_bme680_readings(backend.time())
+    batch = []
+    for i in range(size):
+        if i % 3 == 0:
+            values = {"wind_speed_km_per_h": 10.0 + i % 7, "wind_gust_2min_km_per_h": 21.3}
+        elif i % 3 == 1:
+            values = {"rain_amount_mm": 0.08, "rain_today_mm": 3.12}
+        else:
+            values = {
+                "temperature_c": round(bme680_readings["temperature"], 1),
+                "humidity_pct": round(bme680_readings["humidity"], 1),
+                "pressure_hpa": round(bme680_readings["pressure"], 1),
+                "gas_ohms": int(bme680_readings["gas"]),
+            }
+        batch.append((start_ms + i * 1000, values))
+    return batch
+
+
+@benchmark("pipeline.storm_batch")
+def bench_pipeline_storm_batch(backend):
+    from . import pipeline
+
+    readings_pipeline = pipeline.Pipeline([
+        pipeline.MedianFilter("wind_speed_km_per_h, temperature_c, humidity_pct", window=5, max_deviation=10),
+        pipeline.Convert("wind_speed_km_per_h", to="wind_speed_m_per_s", scale=1 / 3.6, digits=1, keep=True),
+        pipeline.Aggregate("wind_speed_km_per_h, temperature_c", window_s=60),
+    ])
+    batch = storm_batch(backend)
+    return lambda: readings_pipeline.process(batch)
+
+
+@benchmark("encoding.json")
+def bench_encoding_json(backend):
+    encoder = encoding.JsonEncoder()
+    batch = storm_batch(backend)
+    return lambda: encoder.encode(batch)
+
+
+@benchmark("encoding.struct")
+def bench_encoding_struct(backend):
+    encoder = encoding.StructEncoder()
+    batch = storm_batch(backend)
+    return lambda: encoder.encode(batch)
+
+
+# Running #
+###########
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(function, iterations):
+    for _ in range(min(1000, iterations)):
+        function()
+
+    started_ns = time.perf_counter_ns()
+    for _ in range(iterations):
+        function()
+    ops_per_s = iterations / ((time.perf_counter_ns() - started_ns) / 1e9)
+
+    latencies_ns = []
+    perf_counter_ns = time.perf_counter_ns
+    for _ in range(iterations):
+        started_ns = perf_counter_ns()
+        function()
+        latencies_ns.append(perf_counter_ns() - started_ns)
+    latencies_ns.sort()
+
+    allocation_iterations = min(1000, iterations)
+    peak_bytes = retained_bytes = 0
+    tracemalloc.start()
+    try:
+        for _ in range(allocation_iterations):
+            tracemalloc.clear_traces()
+            function()
+            current, peak = tracemalloc.get_traced_memory()
+            peak_bytes += peak
+            retained_bytes += current
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "ops_per_s": round(ops_per_s, 1),
+        "p50_ns": percentile(latencies_ns, 50),
+        "p99_ns": percentile(latencies_ns, 99),
+        "peak_bytes_per_call": round(peak_bytes / allocation_iterations, 1),
+        "retained_bytes_per_call": round(retained_bytes / allocation_iterations, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names=None, iterations=20000, progress=None):
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        backend = hardware.use_backend(simulated.SimulatedBackend(start_time=1.5e9))
+        # WeatherStationApplication.report prints every reading.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            function = setup(backend)
+            teardown = None
+            if isinstance(function, tuple):
+                function, teardown = function
+            try:
+                results[name] = measure(function, iterations)
+            finally:
+                if teardown:
+                    teardown()
+        if progress:
+            progress(name, results[name])
+    return {
+        "commit": git_commit(),
+        "created_at": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold_pct=REGRESSION_THRESHOLD_PCT):
+    """Returns (name, metric, baseline value, current value, change %, regression) rows."""
+    rows = []
+    for name, result in sorted(current["results"].items()):
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        for metric, higher_is_better in (("ops_per_s", True), ("p99_ns", False)):
+            change_pct = (result[metric] - before[metric]) / before[metric] * 100
+            worse_pct = -change_pct if higher_is_better else change_pct
+            rows.append(
+                (name, metric, before[metric], result[metric], change_pct, worse_pct > threshold_pct)
+            )
+    return rows
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
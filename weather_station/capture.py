@@ -0,0 +1,342 @@
+"""
+Raw GPIO edge capture and offline reprocessing.
+
+Capture files start with a small header followed by fixed-width records, so they
+can be memory-mapped as a NumPy array::
+
+    header: magic "WSEDGES1", version (uint16), record size (uint16),
+            pigpio tick (uint32) and unix time (float64) at the start of the file
+    record: pigpio tick (uint32), gpio (uint8), level (uint8), reserved (uint16)
+
+Ticks wrap every ~71 minutes. Files are rotated at least every hour and the
+wind vane sends frames every second, so the time between two records in a file
+never comes close to that and the ticks can be unwrapped from the differences.
+pigpio delivers edges asynchronously, so the first records of a file can be a
+little older than the start tick in its header.
+"""
+import datetime
+import glob
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+
+from . import clock, hardware
+from .sensors import anemometer, rainfall, wind_vane
+
+MAGIC = b"WSEDGES1"
+VERSION = 1
+HEADER = struct.Struct("<8sHHId")
+RECORD = struct.Struct("<IBBH")
+FILE_SUFFIX = ".wse"
+
+ROTATE_INTERVAL_S = 60 * 60
+FLUSH_INTERVAL_S = 1
+
+CAPTURED_PINS = (anemometer.PIN_ANEMOMETER, rainfall.PIN, wind_vane.PIN_WIND_VANE)
+# The glitch filters the sensors use, so the captured edges are the ones they see.
+GLITCH_FILTERS_US = {
+    anemometer.PIN_ANEMOMETER: anemometer.GLITCH_MICROSECONDS,
+    rainfall.PIN: rainfall.GLITCH_MICROSECONDS,
+    wind_vane.PIN_WIND_VANE: wind_vane.GLITCH,
+}
+PULL_UPS = (anemometer.PIN_ANEMOMETER, rainfall.PIN)
+
+
+class EdgeCapture:
+    """
+    Streams every edge of the given pins to rotating capture files. The pigpio
+    callback only appends to an in-memory buffer, a thread writes it out.
+    """
+
+    def __init__(self, directory, pins=CAPTURED_PINS, rotate_interval_s=ROTATE_INTERVAL_S):
+        self.directory = directory
+        self.pins = pins
+        self.rotate_interval_s = rotate_interval_s
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.record_count = 0
+        backend = hardware.get_backend()
+        self.pi = backend.gpio()
+        self.now = backend.time
+        self.callbacks = []
+        self.file = None
+        self.file_opened_at = None
+        self.writer = None
+        self.stopped = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if not self.pi.connected:
+            logging.critical("Cannot connect to pigpio-pi")
+        self.stopped.clear()
+        self.rotate()
+        for pin in self.pins:
+            self.pi.set_mode(pin, hardware.INPUT)
+            if pin in PULL_UPS:
+                self.pi.set_pull_up_down(pin, hardware.PUD_UP)
+            if pin in GLITCH_FILTERS_US:
+                self.pi.set_glitch_filter(pin, GLITCH_FILTERS_US[pin])
+            self.callbacks.append(self.pi.callback(pin, hardware.EITHER_EDGE, self.handle_edge))
+        self.writer = threading.Thread(target=self.write_loop, name="edge-capture")
+        self.writer.start()
+
+    def stop(self):
+        for callback in self.callbacks:
+            callback.cancel()
+        self.callbacks = []
+        self.stopped.set()
+        if self.writer:
+            self.writer.join()
+        self.flush()
+        self.file.close()
+
+    def handle_edge(self, gpio, level, tick):
+        if level == hardware.TIMEOUT:
+            return
+        record = RECORD.pack(tick, gpio, level, 0)
+        with self.lock:
+            self.buffer += record
+
+    def write_loop(self):
+        while not self.stopped.wait(FLUSH_INTERVAL_S):
+            self.flush()
+            if time.monotonic() - self.file_opened_at >= self.rotate_interval_s:
+                self.rotate()
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, bytearray()
+        self.write(buffer)
+
+    def write(self, buffer):
+        if buffer:
+            self.file.write(buffer)
+            self.file.flush()
+            self.record_count += len(buffer) // RECORD.size
+
+    def rotate(self):
+        with self.lock:
+            # Ticks in the new file are relative to this tick. Edges from before
+            # it can still be on their way from pigpiod and end up in the new
+            # file, the readers allow for that.
+            start_tick, start_time = self.pi.get_current_tick(), self.now()
+            buffer, self.buffer = self.buffer, bytearray()
+        if self.file:
+            self.write(buffer)
+            self.file.close()
+        self.file = self.create_file(start_time)
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, start_tick, start_time))
+        self.file.flush()
+        self.file_opened_at = time.monotonic()
+
+    def create_file(self, start_time):
+        """A new file, never one of an earlier run (e.g. a restart within the same second)."""
+        name = datetime.datetime.fromtimestamp(start_time).strftime("edges-%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.directory, name + FILE_SUFFIX)
+        for suffix in itertools.count(1):
+            try:
+                return open(path, "xb")
+            except FileExistsError:
+                # "_" sorts after FILE_SUFFIX, so the files stay in order.
+                path = os.path.join(self.directory, f"{name}_{suffix}{FILE_SUFFIX}")
+
+
+# Reading #
+###########
+
+
+def read_header(path):
+    """Returns (start tick, start unix time) of a capture file."""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(f"{path} is not a capture file")
+    magic, version, record_size, start_tick, start_time = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a version {VERSION} capture file")
+    return start_tick, start_time
+
+
+def is_capture_file(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def iter_edges(path):
+    """
+    Yields (elapsed_us, gpio, level) of every edge, elapsed since the start of the
+    file. This is the trace format of the simulated hardware.
+    """
+    start_tick, start_time = read_header(path)
+    elapsed_us, previous_tick = 0, start_tick
+    tick_diff = clock.signed_tick_diff
+    with open(path, "rb") as f:
+        f.seek(HEADER.size)
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            if not chunk:
+                return
+            usable = len(chunk) - len(chunk) % RECORD.size
+            for tick, gpio, level, _ in RECORD.iter_unpack(chunk[:usable]):
+                # Signed for the first edge, it can be from before the start tick.
+                elapsed_us += tick_diff(previous_tick, tick)
+                tick_diff = hardware.tick_diff
+                previous_tick = tick
+                yield elapsed_us, gpio, level
+
+
+def capture_files(paths):
+    """Expands directories to the capture files in them, sorted by time."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*" + FILE_SUFFIX))))
+        else:
+            files.append(path)
+    return files
+
+
+# Reprocessing (needs numpy) #
+##############################
+
+
+def load_edges(path):
+    """
+    Memory-maps a capture file. Returns (unix times in s, gpio, level) arrays with
+    the ticks unwrapped.
+    """
+    import numpy as np
+
+    start_tick, start_time = read_header(path)
+    dtype = np.dtype([("tick", "<u4"), ("gpio", "u1"), ("level", "u1"), ("reserved", "<u2")])
+    record_count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    if not record_count:
+        return np.empty(0), np.empty(0, "u1"), np.empty(0, "u1")
+    records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER.size, shape=(record_count,))
+    ticks = records["tick"].astype(np.int64)
+    diffs = np.diff(ticks, prepend=start_tick) % (1 << 32)
+    # The first edge can be from (a little) before the start tick.
+    diffs[0] = clock.signed_tick_diff(start_tick, int(ticks[0]))
+    times = start_time + np.cumsum(diffs) / 1e6
+    return times, records["gpio"], records["level"]
+
+
+def interval_counts(times, interval_s):
+    """(interval start times, number of times in each interval)"""
+    import numpy as np
+
+    start = np.floor(times[0] / interval_s) * interval_s
+    bins = ((times - start) // interval_s).astype(np.int64)
+    counts = np.bincount(bins)
+    return start + np.arange(len(counts)) * interval_s, counts
+
+
+def reprocess_anemometer(
+    times,
+    interval_s=anemometer.CALCULACTION_INTERVAL_S,
+    signals_per_rotation=anemometer.SIGNALS_PER_ROTATION,
+    correction_factor=anemometer.CORRECTION_FACTOR,
+):
+    """Mean wind speed per interval from the rising edge times of the anemometer."""
+    starts, counts = interval_counts(times, interval_s)
+    speeds_cm_per_s = anemometer.calculate_speed(
+        duration_s=interval_s,
+        tick_count=counts,
+        ticks_per_rotation=signals_per_rotation,
+        correction_factor=correction_factor,
+    )
+    return starts, anemometer.cm_per_s_to_km_per_h(speeds_cm_per_s).round(3)
+
+
+def reprocess_rainfall(times, interval_s=60, bucket_size_mm=rainfall.BUCKET_SIZE_MM):
+    """Rain amount per interval from the rising edge times of the rain bucket."""
+    starts, counts = interval_counts(times, interval_s)
+    return starts, rainfall.calculate_rainfall(counts, bucket_size_mm=bucket_size_mm).round(2)
+
+
+def reprocess_wind_vane(times):
+    """
+    Decodes all wind vane frames at once: (frame times, direction numbers) of the
+    frames that match the frame before them, like WindVane does.
+    """
+    import numpy as np
+
+    gaps_us = np.diff(times * 1e6, prepend=-np.inf)
+    frame_length = wind_vane.DIRECTION_BITS[-1][0] + 1
+    starts = np.flatnonzero(gaps_us > wind_vane.PRE_US)
+    starts = starts[starts + frame_length < len(gaps_us)]
+    pulses = gaps_us[starts[:, None] + 1 + np.arange(frame_length)]
+    # A complete frame has no end-of-code gap before its last direction bit.
+    complete = (pulses <= wind_vane.POST_US).all(axis=1)
+    pulses, starts = pulses[complete], starts[complete]
+
+    # Same check as WindVane.compare(previous, current).
+    ratios = pulses[:-1] / pulses[1:]
+    matches = ((ratios >= wind_vane.TOLER_MIN) & (ratios <= wind_vane.TOLER_MAX)).all(axis=1)
+    matches &= np.diff(starts) > frame_length
+    averaged = (pulses[1:] + pulses[:-1]) / 2
+
+    dir_nums = np.zeros(len(averaged), dtype=np.int64)
+    for index, bit in wind_vane.DIRECTION_BITS:
+        is_zero = (averaged[:, index] > wind_vane.ZERO_BIT_MIN_US) & (
+            averaged[:, index] < wind_vane.ZERO_BIT_MAX_US
+        )
+        dir_nums |= np.where(is_zero, 0, bit)
+    # Reported when the second frame ends.
+    frame_times = times[starts[1:] + frame_length]
+    return frame_times[matches], dir_nums[matches]
+
+
+def reprocess(
+    paths,
+    anemometer_pin=anemometer.PIN_ANEMOMETER,
+    rain_pin=rainfall.PIN,
+    wind_vane_pin=wind_vane.PIN_WIND_VANE,
+    **options
+):
+    """
+    Yields telemetry entries ({"ts": ms, "values": {...}}) recomputed from capture
+    files, one file at a time. options are passed to the reprocess_* functions.
+    """
+    for path in capture_files(paths):
+        times, gpios, levels = load_edges(path)
+        if not len(times):
+            continue
+        rising = levels == 1
+
+        anemometer_times = times[(gpios == anemometer_pin) & rising]
+        if len(anemometer_times):
+            starts, speeds = reprocess_anemometer(
+                anemometer_times,
+                interval_s=options.get("anemometer_interval_s", anemometer.CALCULACTION_INTERVAL_S),
+                signals_per_rotation=options.get("signals_per_rotation", anemometer.SIGNALS_PER_ROTATION),
+                correction_factor=options.get("correction_factor", anemometer.CORRECTION_FACTOR),
+            )
+            for ts, speed in zip(starts.tolist(), speeds.tolist()):
+                yield {"ts": int(ts * 1000), "values": {"wind_speed_km_per_h": speed}}
+
+        rain_times = times[(gpios == rain_pin) & rising]
+        if len(rain_times):
+            starts, amounts = reprocess_rainfall(
+                rain_times,
+                interval_s=options.get("rain_interval_s", 60),
+                bucket_size_mm=options.get("bucket_size_mm", rainfall.BUCKET_SIZE_MM),
+            )
+            for ts, amount in zip(starts.tolist(), amounts.tolist()):
+                yield {"ts": int(ts * 1000), "values": {"rain_amount_mm": amount}}
+
+        vane_times = times[gpios == wind_vane_pin]
+        if len(vane_times):
+            frame_times, dir_nums = reprocess_wind_vane(vane_times)
+            for ts, dir_num in zip(frame_times.tolist(), dir_nums.tolist()):
+                yield {
+                    "ts": int(ts * 1000),
+                    "values": {
+                        "wind_direction_text": wind_vane.DIRECTION_TEXTS[dir_num],
+                        "wind_direction_arrow": wind_vane.DIRECTION_ARROWS[dir_num],
+                        "wind_direction_degrees": dir_num * 22.5,
+                    },
+                }
@@ -1,10 +1,166 @@
+import atexit
+import configparser
+import datetime
+import logging
+import os
+import signal
+import threading
+import time
+
 import click
+from . import conditions, encoding, logs, pipeline, publisher, sensors, store
 from .app import WeatherStationApplication
+from .sensors import bme680
+
+
+DEFAULT_STORE_DIR = os.path.expanduser("~/.weather_station/store")
+
+
+class Duration(click.ParamType):
+    """30s, 15m, 24h or 7d, in seconds."""
+
+    name = "duration"
+    units_s = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return value
+        try:
+            return float(value[:-1]) * self.units_s[value[-1]]
+        except (KeyError, ValueError, IndexError):
+            self.fail(f"{value} is not a duration like 30m, 24h or 7d", param, ctx)
+
+
+DURATION = Duration()
+
+
+def http_options(command):
+    command = click.option(
+        "--http-port", envvar="WEATHER_STATION_HTTP_PORT", type=int, default=conditions.HTTP_PORT,
+        show_default=True, help="Serve the current conditions here (0 to disable).",
+    )(command)
+    return click.option(
+        "--http-host", envvar="WEATHER_STATION_HTTP_HOST", default=conditions.HTTP_HOST, show_default=True,
+        help="Use 0.0.0.0 to serve other devices on the network.",
+    )(command)
+
+
+def bme680_options(command):
+    command = click.option(
+        "--bme680-profile", type=click.Choice(list(bme680.PROFILES)), default=bme680.DEFAULT_PROFILE,
+        show_default=True, help="Oversampling, filter and heater settings of the BME680.",
+    )(command)
+    return click.option(
+        "--bme680-interval", type=float, default=bme680.REPORT_INTERVAL_S, show_default=True,
+        help="Seconds between BME680 readings.",
+    )(command)
+
+
+def runtime_options(command):
+    command = click.option(
+        "--processes", is_flag=True, envvar="WEATHER_STATION_PROCESSES",
+        help="Run the sensor groups in supervised worker processes (see weather_station.workers).",
+    )(command)
+    return click.option(
+        "--edge-batches", is_flag=True, envvar="WEATHER_STATION_EDGE_BATCHES",
+        help="Read GPIO edges in batches from pigpio's notification pipe instead of per-edge callbacks "
+        "(needs numpy, see weather_station.hardware.notify).",
+    )(command)
+
+
+def parse_sensor_types(ctx, param, value):
+    if not value:
+        return None
+    try:
+        return sensors.configs_from_types(value.split(","))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def sensor_options(command):
+    command = click.option(
+        "--sensors", "sensor_configs", callback=parse_sensor_types, envvar="WEATHER_STATION_SENSORS",
+        help=f"Comma separated sensor types to run, of {', '.join(sensors.SENSOR_TYPES)}. Overrides "
+        f"--sensors-config. Default: {','.join(sensors.DEFAULT_SENSORS)}",
+    )(command)
+    command = click.option(
+        "--sensors-config", envvar="WEATHER_STATION_SENSORS_CONFIG", type=click.Path(exists=True, dir_okay=False),
+        help="INI file with the sensors to run (see weather_station.sensors).",
+    )(command)
+    command = click.option(
+        "--pipeline-config", envvar="WEATHER_STATION_PIPELINE_CONFIG", type=click.Path(exists=True, dir_okay=False),
+        help="INI file with the stages the stored and published readings go through (see weather_station.pipeline).",
+    )(command)
+    command = click.option(
+        "--altitude", "altitude_m", envvar="WEATHER_STATION_ALTITUDE_M", type=float, default=None,
+        help="Altitude of the station (m), to report the sea-level pressure (pressure_qnh_hpa).",
+    )(command)
+    return click.option(
+        "--profile-startup", is_flag=True, help="Print how long the imports and sensor setup took.",
+    )(command)
+
+
+def create_app(sensor_configs, sensors_config, profile_startup, pipeline_config=None, **kwargs):
+    profile = sensors.StartupProfile() if profile_startup else None
+    if sensor_configs is None and sensors_config:
+        try:
+            sensor_configs = sensors.load_config(sensors_config)
+        except (ValueError, configparser.Error) as e:
+            raise click.BadParameter(str(e), param_hint="--sensors-config")
+    readings_pipeline = None
+    if pipeline_config:
+        try:
+            readings_pipeline = pipeline.load_config(pipeline_config)
+        except (ValueError, configparser.Error) as e:
+            raise click.BadParameter(str(e), param_hint="--pipeline-config")
+    app = WeatherStationApplication(
+        sensor_configs=sensor_configs, startup_profile=profile, pipeline=readings_pipeline, **kwargs
+    )
+    return app, profile
+
+
+def store_options(command):
+    command = click.option("--no-store", is_flag=True, help="Don't keep readings locally.")(command)
+    return click.option(
+        "--store-dir", envvar="WEATHER_STATION_STORE_DIR", default=DEFAULT_STORE_DIR, show_default=True,
+        help="Readings and their 1 minute / 1 hour rollups are stored here.",
+    )(command)
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--log-file", envvar="WEATHER_STATION_LOG_FILE", default=logs.LOG_FILENAME, show_default=True)
+@click.option("--log-level", envvar="WEATHER_STATION_LOG_LEVEL", default=logging.getLevelName(logs.LOG_LEVEL),
+              type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]), show_default=True,
+              help="Send SIGUSR1 to switch between this and DEBUG while running.")
+def cli(log_file, log_level):
+    logs.setup_logging(filename=log_file, level=log_level)
+    atexit.register(logs.stop_logging)
+
+
+def run_until_stopped(app, profile=None):
+    """Runs the app until SIGTERM (systemd) or Ctrl-C, then stops it cleanly."""
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    configured_level = logging.getLogger().level
+
+    def toggle_debug(signum, frame):
+        debug = logging.getLogger().level != logging.DEBUG
+        logs.set_level(logging.DEBUG if debug else configured_level)
+
+    signal.signal(signal.SIGUSR1, toggle_debug)
+    if profile:
+        with profile.time("start"):
+            app.start()
+        click.echo(profile.report())
+    else:
+        app.start()
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    click.echo("Stopping weather station...")
+    app.stop()
 
 
 @cli.command()
@@ -12,17 +168,229 @@ def cli():
 @click.option("--tb-port", envvar="WEATHER_STATION_TB_PORT", default=1883)
 @click.option("--tb-access-token", envvar="WEATHER_STATION_TB_ACCESS_TOKEN", default=None)
 @click.option("--tb-user", envvar="WEATHER_STATION_TB_USER", default=None)
-def report(tb_host, tb_port, tb_access_token, tb_user):
+@click.option("--batch-size", default=publisher.MAX_BATCH_SIZE, show_default=True,
+              help="Publish as soon as this many readings are queued.")
+@click.option("--batch-delay", type=float, default=publisher.MAX_BATCH_DELAY_S, show_default=True,
+              help="Publish queued readings after at most this many seconds.")
+@click.option("--queue-size", default=publisher.MAX_QUEUE_SIZE, show_default=True)
+@click.option("--overflow", type=click.Choice(publisher.OVERFLOW_POLICIES),
+              default=publisher.DROP_OLDEST, show_default=True,
+              help="What to do with new readings when the queue is full.")
+@click.option("--spool-dir", envvar="WEATHER_STATION_SPOOL_DIR",
+              default=os.path.expanduser("~/.weather_station/spool"), show_default=True,
+              help="Readings are kept here until the broker has received them.")
+@click.option("--no-spool", is_flag=True, help="Don't keep readings on disk during broker outages.")
+@click.option("--no-deadband", is_flag=True,
+              help="Publish every reading, not only changes (see weather_station.reporting).")
+@click.option("--encoding", "encoding_name", type=click.Choice(list(encoding.ENCODERS)), default="json",
+              show_default=True, help="Telemetry payload format. Binary formats need a converter in front of "
+              "ThingsBoard.")
+@click.option("--quiet", is_flag=True, help="Don't print every reading.")
+@store_options
+@http_options
+@bme680_options
+@runtime_options
+@sensor_options
+def report(tb_host, tb_port, tb_access_token, tb_user, batch_size, batch_delay, queue_size, overflow,
+           spool_dir, no_spool, no_deadband, encoding_name, quiet, store_dir, no_store, http_host, http_port, bme680_profile,
+           bme680_interval, processes, edge_batches, sensor_configs, sensors_config, altitude_m, pipeline_config,
+           profile_startup):
     click.echo(f"Starting weather station with reporting to {tb_host}...")
-    app = WeatherStationApplication(
-        tb_host=tb_host, tb_port=tb_port, tb_access_token=tb_access_token, tb_user=tb_user
+    app, profile = create_app(
+        sensor_configs, sensors_config, profile_startup, pipeline_config=pipeline_config,
+        tb_host=tb_host, tb_port=tb_port, tb_access_token=tb_access_token, tb_user=tb_user,
+        max_batch_size=batch_size, max_batch_delay_s=batch_delay,
+        max_queue_size=queue_size, overflow_policy=overflow,
+        spool_dir=None if no_spool else spool_dir,
+        deadband=not no_deadband, encoding_name=encoding_name, console=not quiet,
+        store_dir=None if no_store else store_dir,
+        http_host=http_host, http_port=http_port,
+        bme680_profile=bme680_profile, bme680_interval_s=bme680_interval,
+        processes=processes, edge_batches=edge_batches, altitude_m=altitude_m,
     )
-    app.start()
+    run_until_stopped(app, profile)
 
 
 @cli.command()
-def local():
+@store_options
+@http_options
+@bme680_options
+@runtime_options
+@sensor_options
+@click.option("--quiet", is_flag=True, help="Don't print every reading.")
+def local(store_dir, no_store, http_host, http_port, bme680_profile, bme680_interval, processes, edge_batches,
+          sensor_configs, sensors_config, altitude_m, pipeline_config, profile_startup, quiet):
     click.echo("Starting weather station without reporting...")
-    app = WeatherStationApplication()
-    app.start()
+    app, profile = create_app(
+        sensor_configs, sensors_config, profile_startup, pipeline_config=pipeline_config,
+        store_dir=None if no_store else store_dir, http_host=http_host, http_port=http_port, console=not quiet,
+        bme680_profile=bme680_profile, bme680_interval_s=bme680_interval,
+        processes=processes, edge_batches=edge_batches, altitude_m=altitude_m,
+    )
+    run_until_stopped(app, profile)
+
+
+@cli.command()
+@click.argument("field")
+@click.option("--last", "last_s", type=DURATION, default="24h", show_default=True,
+              help="Time range up to now, e.g. 30m, 24h, 7d or 365d.")
+@click.option("--tier", type=click.Choice(list(store.TIERS)), default=None,
+              help="Raw readings or rollups (default: depends on the range).")
+@click.option("--store-dir", envvar="WEATHER_STATION_STORE_DIR", default=DEFAULT_STORE_DIR, show_default=True)
+def query(field, last_s, tier, store_dir):
+    """Prints the stored values of FIELD (e.g. temperature_c)."""
+    local_store = store.TimeSeriesStore(store_dir)
+    end_ms = int(time.time() * 1000)
+    start_ms = end_ms - int(last_s * 1000)
+    tier = tier or local_store.pick_tier(start_ms, end_ms)
+    for row in local_store.query(field, start_ms, end_ms, tier=tier):
+        ts = datetime.datetime.fromtimestamp(row[0] / 1000)
+        if tier == store.RAW:
+            click.echo(f"[{ts}] {row[1]}")
+        else:
+            _, minimum, maximum, mean, count = row
+            click.echo(f"[{ts}] mean {mean:.3f} min {minimum} max {maximum} ({count} readings)")
+
+
+@cli.command()
+@click.option("--last", "last_s", type=DURATION, default="24h", show_default=True,
+              help="Time range up to now, of the raw readings (at most 7d).")
+@click.option("--altitude", "altitude_m", envvar="WEATHER_STATION_ALTITUDE_M", type=float, default=None,
+              help="Altitude of the station (m), for pressure_qnh_hpa.")
+@click.option("--store-dir", envvar="WEATHER_STATION_STORE_DIR", default=DEFAULT_STORE_DIR, show_default=True)
+@click.option("--output", type=click.File("w"), default="-",
+              help="Write JSON lines of telemetry entries here.")
+def derive(last_s, altitude_m, store_dir, output):
+    """Recomputes dew point, heat index etc. of the stored readings. Needs numpy."""
+    import json
+    import math
+    from . import derived
+
+    local_store = store.TimeSeriesStore(store_dir)
+    end_ms = int(time.time() * 1000)
+    ts_ms, fields = derived.recompute(local_store, end_ms - int(last_s * 1000), end_ms, altitude_m=altitude_m)
+    for index, ts in enumerate(ts_ms.tolist()):
+        values = {field: float(column[index]) for field, column in fields.items() if not math.isnan(column[index])}
+        if values:
+            output.write(json.dumps({"ts": ts, "values": values}) + "\n")
+
+
+@cli.command()
+@click.option("--output-dir", envvar="WEATHER_STATION_CAPTURE_DIR",
+              default=os.path.expanduser("~/.weather_station/capture"), show_default=True)
+@click.option("--rotate-minutes", default=60, show_default=True, type=click.IntRange(1, 60),
+              help="Start a new file after this many minutes.")
+def capture(output_dir, rotate_minutes):
+    """Records every raw edge of the wind and rain sensors to binary files."""
+    from .capture import EdgeCapture
+
+    click.echo(f"Capturing edges to {output_dir}...")
+    edge_capture = EdgeCapture(output_dir, rotate_interval_s=rotate_minutes * 60)
+    run_until_stopped(edge_capture)
+    click.echo(f"Captured {edge_capture.record_count} edges")
+
+
+@cli.command()
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--interval", default=5.0, show_default=True, help="Wind speed interval (s).")
+@click.option("--rain-interval", default=60.0, show_default=True, help="Rain amount interval (s).")
+@click.option("--signals-per-rotation", type=float, default=None,
+              help="Anemometer signals per rotation (default: the current setting).")
+@click.option("--correction-factor", type=float, default=None,
+              help="Anemometer correction factor (default: the current setting).")
+@click.option("--bucket-size-mm", type=float, default=None,
+              help="Rain per bucket tip (default: the current setting).")
+@click.option("--output", type=click.File("w"), default="-",
+              help="Write JSON lines of telemetry entries here.")
+def reprocess(files, interval, rain_interval, signals_per_rotation, correction_factor, bucket_size_mm,
+              output):
+    """Recomputes readings from capture files (e.g. with corrected calibration). Needs numpy."""
+    import json
+    from . import capture
+
+    options = {"anemometer_interval_s": interval, "rain_interval_s": rain_interval}
+    if signals_per_rotation is not None:
+        options["signals_per_rotation"] = signals_per_rotation
+    if correction_factor is not None:
+        options["correction_factor"] = correction_factor
+    if bucket_size_mm is not None:
+        options["bucket_size_mm"] = bucket_size_mm
+    for entry in capture.reprocess(files, **options):
+        output.write(json.dumps(entry) + "\n")
+
+
+@cli.command()
+@click.option("--hours", default=24.0, show_default=True, help="Virtual time to simulate.")
+@click.option("--wind", default=60.0, show_default=True, help="Mean wind speed (km/h) of the synthetic storm.")
+@click.option("--rain", default=15.0, show_default=True, help="Mean rain rate (mm/h) of the synthetic storm.")
+@click.option("--seed", default=0, show_default=True)
+@click.option("--trace", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Replay a recorded trace (CSV with elapsed_us,gpio,level rows or a capture file) instead.")
+@click.option("--speed", type=float, default=None,
+              help="Replay at this multiple of real time (default: as fast as possible).")
+@click.option("--print-readings", is_flag=True)
+def simulate(hours, wind, rain, seed, trace, speed, print_readings):
+    """Runs all sensors on simulated hardware in virtual time."""
+    from .hardware import simulated
+
+    readings = []
+
+    def report(data, ts=None):
+        readings.append(ts)
+        if print_readings:
+            click.echo(f"[{datetime.datetime.fromtimestamp(ts)}] {data}")
+
+    station = simulated.SimulatedStation(report_function=report)
+    if trace:
+        events = simulated.load_trace(trace)
+    else:
+        events = simulated.storm_trace(hours * 3600, mean_wind_km_per_h=wind, mean_rain_mm_per_h=rain, seed=seed)
+    started_at = time.perf_counter()
+    station.run(events, duration_s=hours * 3600, speed=speed)
+    elapsed_s = time.perf_counter() - started_at
+
+    click.echo(
+        f"Replayed {hours}h ({station.replayer.edge_count} edges) in {elapsed_s:.2f}s "
+        f"({hours * 3600 / elapsed_s:.0f}x real time, "
+        f"{station.replayer.edge_count / elapsed_s:.0f} edges/s), {len(readings)} readings"
+    )
+
+
+@cli.group()
+def bench():
+    """Benchmarks of the hot paths on simulated hardware."""
+
+
+@bench.command("run")
+@click.option("--iterations", default=20000, show_default=True)
+@click.option("--only", multiple=True, help="Only run these benchmarks.")
+@click.option("--output", type=click.Path(dir_okay=False), default="bench_results.json", show_default=True)
+def bench_run(iterations, only, output):
+    from . import benchmarks
+
+    def progress(name, result):
+        click.echo(
+            f"{name:<28} {result['ops_per_s']:>12.0f} ops/s  p50 {result['p50_ns']:>8}ns  "
+            f"p99 {result['p99_ns']:>8}ns  {result['peak_bytes_per_call']:>8.0f} B/call"
+        )
+
+    results = benchmarks.run_benchmarks(names=only, iterations=iterations, progress=progress)
+    benchmarks.save(results, output)
+    click.echo(f"Results written to {output}")
+
+
+@bench.command("compare")
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("current", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", default=10.0, show_default=True, help="Allowed slowdown in percent.")
+def bench_compare(baseline, current, threshold):
+    from . import benchmarks
 
+    baseline_results, current_results = benchmarks.load(baseline), benchmarks.load(current)
+    click.echo(f"{baseline_results['commit']} -> {current_results['commit']}")
+    rows = benchmarks.compare(baseline_results, current_results, threshold_pct=threshold)
+    for name, metric, before, after, change_pct, regression in rows:
+        flag = "REGRESSION" if regression else ""
+        click.echo(f"{name:<28} {metric:<10} {before:>12} -> {after:>12} {change_pct:>+7.1f}% {flag}")
+    if any(row[-1] for row in rows):
+        raise click.ClickException("Performance regressions found")
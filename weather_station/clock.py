@@ -0,0 +1,83 @@
+"""
+Time from pigpio ticks.
+
+pigpio passes every callback the tick (µs, 32 bit, wraps every ~72 min) at
+which the edge happened. Durations are computed from those ticks, so they
+don't include the callback's scheduling delay and don't jump with NTP.
+
+A TickClock unwraps the ticks into a 64 bit µs count and maps them to wall-clock
+time with an offset it measures once and then again every RECALIBRATE_INTERVAL_S
+of ticks. Mapping a tick is arithmetic only, no syscall and no pigpio round trip.
+It needs to see a tick at least every 2**31 µs (~35 min) to notice wraps; the
+sensors' watchdogs and sampling take care of that.
+
+A TickClock is not thread safe. Every sensor uses its own from one thread.
+"""
+from . import hardware
+
+TICK_WRAP = 1 << 32
+HALF_TICK_WRAP = 1 << 31
+
+RECALIBRATE_INTERVAL_S = 60
+
+
+def signed_tick_diff(start_tick, end_tick):
+    """Like hardware.tick_diff, but negative if end_tick is (a little) before start_tick."""
+    diff = (end_tick - start_tick) % TICK_WRAP
+    if diff >= HALF_TICK_WRAP:
+        diff -= TICK_WRAP
+    return diff
+
+
+class TickClock:
+    def __init__(self, pi, now, recalibrate_interval_s=RECALIBRATE_INTERVAL_S):
+        self.pi = pi
+        self.now = now
+        self.recalibrate_interval_us = round(recalibrate_interval_s * 1e6)
+        # The latest tick seen and its unwrapped value.
+        self.last_tick = None
+        self.last_elapsed_us = 0
+        # Wall-clock time at an unwrapped tick, from the last calibration.
+        self.reference_elapsed_us = None
+        self.reference_time = None
+        self.calibrate()
+
+    def calibrate(self):
+        """Measures the offset between ticks and wall-clock time."""
+        before = self.pi.get_current_tick()
+        now = self.now()
+        after = self.pi.get_current_tick()
+        # now() was called somewhere between the two ticks.
+        tick = (before + hardware.tick_diff(before, after) // 2) % TICK_WRAP
+        self.reference_elapsed_us = self.elapsed_us(tick)
+        self.reference_time = now
+
+    def current_tick(self):
+        tick = self.pi.get_current_tick()
+        self.elapsed_us(tick)
+        return tick
+
+    def elapsed_us(self, tick):
+        """The tick unwrapped: µs on a 64 bit count that doesn't wrap."""
+        if self.last_tick is None:
+            self.last_tick = tick
+            return self.last_elapsed_us
+        diff = signed_tick_diff(self.last_tick, tick)
+        if diff <= 0:
+            # An edge from before the latest tick seen (e.g. by calibrate()).
+            return self.last_elapsed_us + diff
+        self.last_tick = tick
+        self.last_elapsed_us += diff
+        return self.last_elapsed_us
+
+    def duration_s(self, start_elapsed_us, tick):
+        """Seconds from an unwrapped tick to tick."""
+        return (self.elapsed_us(tick) - start_elapsed_us) / 1e6
+
+    def to_time(self, tick):
+        """Wall-clock (unix) time of tick."""
+        elapsed_us = self.elapsed_us(tick)
+        if elapsed_us - self.reference_elapsed_us > self.recalibrate_interval_us:
+            # Follow NTP adjustments of the wall clock and the drift between both.
+            self.calibrate()
+        return self.reference_time + (elapsed_us - self.reference_elapsed_us) / 1e6
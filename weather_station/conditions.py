@@ -0,0 +1,134 @@
+"""
+Current conditions: the latest value of every reported field, served as JSON
+over HTTP for local displays and home automation.
+
+    GET /conditions             all fields with value, ts and source sensor
+    GET /conditions?wait=30     with If-None-Match: waits up to 30s for a change
+    GET /metrics                the metrics (see weather_station.metrics) for Prometheus
+
+Responses carry an ETag (the version of the cache), so clients can poll with
+If-None-Match and get a 304 until something changed. The JSON body is encoded
+once per version, however many clients ask for it.
+"""
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from . import metrics
+
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = 8080
+MAX_WAIT_S = 60
+
+
+class CurrentConditions:
+    def __init__(self):
+        # field -> (value, ts, source)
+        self.fields = {}
+        self.version = 0
+        # Keeps ETags of a previous run from matching after a restart.
+        self.started_at = int(time.time())
+        self.changed = threading.Condition()
+        self._body = None
+        self._body_version = None
+
+    def update(self, data, ts, source=None):
+        with self.changed:
+            for field, value in data.items():
+                self.fields[field] = (value, ts, source)
+            self.version += 1
+            self.changed.notify_all()
+
+    @property
+    def etag(self):
+        return f'"{self.started_at}-{self.version}"'
+
+    def wait_for_change(self, etag, timeout):
+        """Waits until the cache no longer has etag. Returns whether it changed."""
+        with self.changed:
+            return self.changed.wait_for(lambda: self.etag != etag, timeout)
+
+    def snapshot(self):
+        """(etag, JSON body) of the current version."""
+        with self.changed:
+            if self._body_version != self.version:
+                self._body = json.dumps(
+                    {
+                        "version": self.version,
+                        "fields": {
+                            field: {"value": value, "ts": int(ts * 1000), "source": source}
+                            for field, (value, ts, source) in sorted(self.fields.items())
+                        },
+                    }
+                ).encode("utf-8")
+                self._body_version = self.version
+            return self.etag, self._body
+
+
+class ConditionsRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Set by ConditionsServer.
+    conditions = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/metrics":
+            self.send_metrics()
+            return
+        if url.path not in ("/", "/conditions"):
+            self.send_error(404)
+            return
+        try:
+            wait_s = float(urllib.parse.parse_qs(url.query).get("wait", ["0"])[0])
+        except ValueError:
+            self.send_error(400, "wait must be a number of seconds")
+            return
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and wait_s > 0:
+            self.conditions.wait_for_change(if_none_match, min(wait_s, MAX_WAIT_S))
+        etag, body = self.conditions.snapshot()
+        if if_none_match == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self):
+        body = metrics.REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # Long-polling clients must not keep the application from stopping.
+    daemon_threads = True
+
+
+class ConditionsServer(threading.Thread):
+    def __init__(self, conditions, host=HTTP_HOST, port=HTTP_PORT):
+        threading.Thread.__init__(self, name="conditions-http", daemon=True)
+        handler = type("Handler", (ConditionsRequestHandler,), {"conditions": conditions})
+        self.server = ThreadingHTTPServer((host, port), handler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,256 @@
+"""
+Derived meteorology: dew point, absolute humidity, heat index, wind chill,
+sea-level pressure (QNH) and the 3 hour pressure tendency.
+
+DerivedMetrics sits on the report path. It keeps the latest temperature_c,
+humidity_pct, pressure_hpa and wind_speed_km_per_h of any sensor and, for every
+reading with one of them, returns the derived fields that depend on it. Inputs
+older than MAX_INPUT_AGE_S aren't joined.
+
+derive_batch() computes the same fields for NumPy arrays, e.g. to recompute
+them for stored readings (see recompute()). The formulas are written once and
+evaluated with math for single readings and with NumPy for arrays.
+"""
+import bisect
+import math
+import threading
+import types
+
+INPUT_FIELDS = ("temperature_c", "humidity_pct", "pressure_hpa", "wind_speed_km_per_h")
+MAX_INPUT_AGE_S = 15 * 60
+
+TENDENCY_S = 3 * 60 * 60
+# The pressure history keeps one reading per this many seconds.
+TENDENCY_SAMPLE_S = 60
+# How far the oldest pressure may be from TENDENCY_S ago to compute a tendency.
+TENDENCY_TOLERANCE_S = 10 * 60
+
+# derived field -> (input fields, digits)
+DERIVED_FIELDS = {
+    "dew_point_c": (("temperature_c", "humidity_pct"), 1),
+    "absolute_humidity_g_per_m3": (("temperature_c", "humidity_pct"), 2),
+    "heat_index_c": (("temperature_c", "humidity_pct"), 1),
+    "wind_chill_c": (("temperature_c", "wind_speed_km_per_h"), 1),
+    "pressure_qnh_hpa": (("pressure_hpa",), 1),
+    "pressure_tendency_3h_hpa": (("pressure_hpa",), 1),
+}
+
+# The formulas only use operators and these functions.
+SCALAR = types.SimpleNamespace(
+    exp=math.exp, log=math.log, sqrt=math.sqrt, maximum=max, absolute=abs,
+    where=lambda condition, a, b: a if condition else b,
+    logical_and=lambda a, b: a and b,
+)
+
+
+# Formulas #
+############
+
+# Magnus formula constants over water (Sonntag 1990).
+MAGNUS_B = 17.62
+MAGNUS_C_C = 243.12
+
+
+def dew_point_c(temperature_c, humidity_pct, xp=SCALAR):
+    gamma = xp.log(xp.maximum(humidity_pct, 0.1) / 100) + MAGNUS_B * temperature_c / (MAGNUS_C_C + temperature_c)
+    return MAGNUS_C_C * gamma / (MAGNUS_B - gamma)
+
+
+def absolute_humidity_g_per_m3(temperature_c, humidity_pct, xp=SCALAR):
+    vapour_pressure_hpa = 6.112 * xp.exp(MAGNUS_B * temperature_c / (MAGNUS_C_C + temperature_c)) * humidity_pct / 100
+    # Water vapour: 100 Pa/hPa * 1000 g/kg / 461.5 J/(kg K)
+    return 216.7 * vapour_pressure_hpa / (temperature_c + 273.15)
+
+
+def heat_index_c(temperature_c, humidity_pct, xp=SCALAR):
+    """The NWS heat index (Rothfusz regression with its adjustments); the temperature below 26.7°C."""
+    t = temperature_c * 9 / 5 + 32
+    rh = humidity_pct
+    simple = 0.5 * (t + 61 + (t - 68) * 1.2 + rh * 0.094)
+    regression = (
+        -42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh - 6.83783e-3 * t * t
+        - 5.481717e-2 * rh * rh + 1.22874e-3 * t * t * rh + 8.5282e-4 * t * rh * rh - 1.99e-6 * t * t * rh * rh
+    )
+    dry = xp.logical_and(rh < 13, t <= 112)
+    regression = regression - xp.where(
+        dry, (13 - rh) / 4 * xp.sqrt(xp.maximum(17 - xp.absolute(t - 95), 0) / 17), 0
+    )
+    humid = xp.logical_and(rh > 85, t <= 87)
+    regression = regression + xp.where(humid, (rh - 85) / 10 * (87 - t) / 5, 0)
+    index = xp.where((simple + t) / 2 < 80, simple, regression)
+    return xp.where(t < 80, temperature_c, (index - 32) * 5 / 9)
+
+
+def wind_chill_c(temperature_c, wind_speed_km_per_h, xp=SCALAR):
+    """The North American wind chill index; the temperature above 10°C or below 4.8km/h."""
+    v = xp.maximum(wind_speed_km_per_h, 0) ** 0.16
+    chill = 13.12 + 0.6215 * temperature_c - 11.37 * v + 0.3965 * temperature_c * v
+    applies = xp.logical_and(temperature_c <= 10, wind_speed_km_per_h > 4.8)
+    return xp.where(applies, chill, temperature_c)
+
+
+def pressure_qnh_hpa(pressure_hpa, altitude_m):
+    """Station pressure reduced to sea level in the ICAO standard atmosphere."""
+    return (pressure_hpa ** 0.190263 + 8.417286e-5 * altitude_m) ** (1 / 0.190263)
+
+
+# Incremental #
+###############
+
+
+class DerivedMetrics:
+    def __init__(self, altitude_m=None, max_input_age_s=MAX_INPUT_AGE_S):
+        """Without altitude_m, there is no pressure_qnh_hpa."""
+        self.altitude_m = altitude_m
+        self.max_input_age_s = max_input_age_s
+        # field -> (ts, value)
+        self.latest = {}
+        # (ts, pressure_hpa), one per TENDENCY_SAMPLE_S, the last TENDENCY_S + TENDENCY_TOLERANCE_S
+        self.pressure_history = []
+        self.lock = threading.Lock()
+
+    def update(self, data, ts):
+        """The derived fields that change with the inputs in data."""
+        updated = [field for field in INPUT_FIELDS if field in data and data[field] is not None]
+        if not updated:
+            return {}
+        with self.lock:
+            for field in updated:
+                self.latest[field] = (ts, data[field])
+            if "pressure_hpa" in updated:
+                self._add_pressure(ts, data["pressure_hpa"])
+            inputs = {
+                field: value for field, (input_ts, value) in self.latest.items()
+                if ts - input_ts <= self.max_input_age_s
+            }
+            tendency = self._tendency(ts, inputs["pressure_hpa"]) if "pressure_hpa" in updated else None
+
+        derived = {}
+        for field, (input_fields, digits) in DERIVED_FIELDS.items():
+            if not any(input_field in updated for input_field in input_fields):
+                continue
+            if not all(input_field in inputs for input_field in input_fields):
+                continue
+            if field == "pressure_qnh_hpa":
+                if self.altitude_m is None:
+                    continue
+                value = pressure_qnh_hpa(inputs["pressure_hpa"], self.altitude_m)
+            elif field == "pressure_tendency_3h_hpa":
+                value = tendency
+            else:
+                value = FORMULAS[field](*[inputs[input_field] for input_field in input_fields])
+            if value is not None:
+                derived[field] = round(value, digits)
+        return derived
+
+    def _add_pressure(self, ts, pressure_hpa):
+        history = self.pressure_history
+        if history and ts - history[-1][0] < TENDENCY_SAMPLE_S:
+            return
+        history.append((ts, pressure_hpa))
+        expired = bisect.bisect_left(history, (ts - TENDENCY_S - TENDENCY_TOLERANCE_S,))
+        del history[:expired]
+
+    def _tendency(self, ts, pressure_hpa):
+        index = bisect.bisect_right(self.pressure_history, (ts - TENDENCY_S, math.inf)) - 1
+        if index < 0:
+            return None
+        then_ts, then_pressure_hpa = self.pressure_history[index]
+        if ts - TENDENCY_S - then_ts > TENDENCY_TOLERANCE_S:
+            return None
+        return pressure_hpa - then_pressure_hpa
+
+
+FORMULAS = {
+    "dew_point_c": dew_point_c,
+    "absolute_humidity_g_per_m3": absolute_humidity_g_per_m3,
+    "heat_index_c": heat_index_c,
+    "wind_chill_c": wind_chill_c,
+}
+
+
+# Batch #
+#########
+
+
+def align(ts, series_ts, series_values, max_age_s=MAX_INPUT_AGE_S):
+    """
+    The latest value of a series at every ts, like DerivedMetrics joins them.
+    NaN where the series has no value in the max_age_s before. Needs numpy.
+    """
+    import numpy as np
+
+    ts = np.asarray(ts, dtype=np.float64)
+    series_ts = np.asarray(series_ts, dtype=np.float64)
+    series_values = np.asarray(series_values, dtype=np.float64)
+    indices = np.searchsorted(series_ts, ts, side="right") - 1
+    valid = indices >= 0
+    values = np.full(len(ts), np.nan)
+    values[valid] = series_values[indices[valid]]
+    values[valid & (ts - series_ts[np.maximum(indices, 0)] > max_age_s)] = np.nan
+    return values
+
+
+def pressure_tendency(ts, pressure_hpa):
+    """The change of pressure_hpa over the TENDENCY_S before every ts (sorted), NaN where unknown."""
+    import numpy as np
+
+    ts = np.asarray(ts, dtype=np.float64)
+    pressure_hpa = np.asarray(pressure_hpa, dtype=np.float64)
+    known = ~np.isnan(pressure_hpa)
+    known_ts, known_pressure = ts[known], pressure_hpa[known]
+    tendency = np.full(len(ts), np.nan)
+    if not len(known_ts):
+        return tendency
+    indices = np.searchsorted(known_ts, ts - TENDENCY_S, side="right") - 1
+    valid = indices >= 0
+    indices = np.maximum(indices, 0)
+    valid &= ts - TENDENCY_S - known_ts[indices] <= TENDENCY_TOLERANCE_S
+    tendency[valid] = pressure_hpa[valid] - known_pressure[indices[valid]]
+    return tendency
+
+
+def derive_batch(ts, altitude_m=None, **inputs):
+    """
+    The derived fields for arrays of aligned inputs (keyword arguments named
+    like INPUT_FIELDS, NaN where unknown) at the sorted times ts. Fields whose
+    inputs are missing are left out. Needs numpy.
+    """
+    import numpy as np
+
+    inputs = {field: np.asarray(values, dtype=np.float64) for field, values in inputs.items()}
+    derived = {}
+    with np.errstate(invalid="ignore"):
+        for field, formula in FORMULAS.items():
+            input_fields, digits = DERIVED_FIELDS[field]
+            if all(input_field in inputs for input_field in input_fields):
+                columns = [inputs[input_field] for input_field in input_fields]
+                values = formula(*columns, xp=np)
+                # The where() of a formula can pick a known input over a NaN.
+                values[np.isnan(columns[0]) | np.isnan(columns[1])] = np.nan
+                derived[field] = np.round(values, digits)
+        if "pressure_hpa" in inputs:
+            if altitude_m is not None:
+                derived["pressure_qnh_hpa"] = np.round(pressure_qnh_hpa(inputs["pressure_hpa"], altitude_m), 1)
+            derived["pressure_tendency_3h_hpa"] = np.round(pressure_tendency(ts, inputs["pressure_hpa"]), 1)
+    return derived
+
+
+def recompute(local_store, start_ms, end_ms, altitude_m=None):
+    """
+    The derived fields of the raw readings in local_store (a store.TimeSeriesStore)
+    with start_ms <= ts < end_ms. Returns (ts_ms, derived) arrays. Needs numpy.
+    """
+    import numpy as np
+
+    series = {}
+    for field in INPUT_FIELDS:
+        rows = local_store.query(field, start_ms, end_ms, tier="raw")
+        if rows:
+            series[field] = np.array(rows, dtype=np.float64).T
+    if not series:
+        return np.empty(0, dtype=np.int64), {}
+    ts_ms = np.unique(np.concatenate([field_ts for field_ts, _ in series.values()]))
+    ts = ts_ms / 1000
+    inputs = {field: align(ts, field_ts / 1000, values) for field, (field_ts, values) in series.items()}
+    return ts_ms.astype(np.int64), derive_batch(ts, altitude_m=altitude_m, **inputs)
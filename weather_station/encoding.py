@@ -0,0 +1,198 @@
+"""
+Telemetry payload encodings.
+
+- json: the ThingsBoard array-of-{ts, values} format (compact separators)
+- msgpack: the same structure as MessagePack (needs the msgpack package)
+- struct: a packed binary schema with numeric field ids, see StructEncoder
+
+Binary payloads are a lot smaller on the uplink, but ThingsBoard can't read
+them directly. They need a converter (e.g. a rule chain or bridge) in front of it.
+"""
+import json
+import struct
+
+# Field ids of the struct encoding. Only ever append to this, the position of a
+# name is its id on the wire.
+FIELD_NAMES = (
+    "temperature_c",
+    "humidity_pct",
+    "pressure_hpa",
+    "gas_ohms",
+    "temperature_underground_c",
+    "rain_amount_mm",
+    "rain_amount_mm_per_h",
+    "rain_today_mm",
+    "rain_10min_mm",
+    "rain_10min_peak_mm_per_h",
+    "rain_1h_mm",
+    "rain_1h_peak_mm_per_h",
+    "rain_24h_mm",
+    "rain_24h_peak_mm_per_h",
+    "wind_speed_km_per_h",
+    "wind_speed_3s_km_per_h",
+    "wind_speed_2min_km_per_h",
+    "wind_gust_2min_km_per_h",
+    "wind_lull_2min_km_per_h",
+    "wind_speed_10min_km_per_h",
+    "wind_gust_10min_km_per_h",
+    "wind_lull_10min_km_per_h",
+    "wind_direction_text",
+    "wind_direction_arrow",
+    "wind_direction_degrees",
+    "dew_point_c",
+    "absolute_humidity_g_per_m3",
+    "heat_index_c",
+    "wind_chill_c",
+    "pressure_qnh_hpa",
+    "pressure_tendency_3h_hpa",
+)
+FIELD_IDS = {name: field_id for field_id, name in enumerate(FIELD_NAMES)}
+# Followed by the field name, for fields that have no id (yet).
+UNKNOWN_FIELD_ID = 0xFF
+
+
+def merge_readings(readings):
+    """
+    Merges (ts_ms, values) readings into the ThingsBoard array-of-{ts, values}
+    telemetry format. Readings that share a timestamp end up in the same entry
+    (later values win).
+    """
+    merged = {}
+    for ts_ms, values in readings:
+        entry = merged.get(ts_ms)
+        if entry is None:
+            merged[ts_ms] = dict(values)
+        else:
+            entry.update(values)
+    return [{"ts": ts_ms, "values": values} for ts_ms, values in sorted(merged.items())]
+
+
+class JsonEncoder:
+    name = "json"
+
+    def encode(self, readings):
+        return json.dumps(merge_readings(readings), separators=(",", ":"))
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackEncoder:
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+
+        self.msgpack = msgpack
+
+    def encode(self, readings):
+        return self.msgpack.packb(merge_readings(readings), use_bin_type=True)
+
+    def decode(self, payload):
+        return self.msgpack.unpackb(payload, raw=False)
+
+
+class StructEncoder:
+    """
+    Little endian::
+
+        payload: version (uint8), ts of the first entry in ms (int64), entry count (uint16), entries
+        entry:   ms since the first entry (uint32), value count (uint8), values
+        value:   field id (uint8, 0xFF: followed by a string with the name), type (char), data
+
+    Types: f float32, i int32, s string (uint8 length + UTF-8), t true, F false,
+    n null. Floats are float32, good for ~7 significant digits.
+    """
+
+    name = "struct"
+    version = 1
+    HEADER = struct.Struct("<BqH")
+    ENTRY = struct.Struct("<IB")
+    FLOAT = struct.Struct("<f")
+    INT = struct.Struct("<i")
+    # field id, type and value in one go, for the common cases
+    FLOAT_VALUE = struct.Struct("<Bcf")
+    INT_VALUE = struct.Struct("<Bci")
+
+    def encode(self, readings):
+        entries = merge_readings(readings)
+        base_ts_ms = entries[0]["ts"] if entries else 0
+        parts = [self.HEADER.pack(self.version, base_ts_ms, len(entries))]
+        append = parts.append
+        pack_entry, pack_float, pack_int = self.ENTRY.pack, self.FLOAT_VALUE.pack, self.INT_VALUE.pack
+        for entry in entries:
+            values = entry["values"]
+            append(pack_entry(entry["ts"] - base_ts_ms, len(values)))
+            for field, value in values.items():
+                field_id = FIELD_IDS.get(field)
+                value_type = type(value)
+                if field_id is None:
+                    append(bytes((UNKNOWN_FIELD_ID,)) + self._string(field) + self._value(value))
+                elif value_type is float:
+                    append(pack_float(field_id, b"f", value))
+                elif value_type is int and -(2 ** 31) <= value < 2 ** 31:
+                    append(pack_int(field_id, b"i", value))
+                else:
+                    append(bytes((field_id,)) + self._value(value))
+        return b"".join(parts)
+
+    def _value(self, value):
+        if value is None:
+            return b"n"
+        if value is True or value is False:
+            return b"t" if value else b"F"
+        if isinstance(value, int) and -(2 ** 31) <= value < 2 ** 31:
+            return b"i" + self.INT.pack(value)
+        if isinstance(value, (int, float)):
+            return b"f" + self.FLOAT.pack(value)
+        return b"s" + self._string(str(value))
+
+    def _string(self, text):
+        data = text.encode("utf-8")[:255]
+        return bytes((len(data),)) + data
+
+    def decode(self, payload):
+        version, base_ts_ms, entry_count = self.HEADER.unpack_from(payload)
+        if version != self.version:
+            raise ValueError(f"Unknown struct telemetry version {version}")
+        offset = self.HEADER.size
+        entries = []
+        for _ in range(entry_count):
+            delta_ms, value_count = self.ENTRY.unpack_from(payload, offset)
+            offset += self.ENTRY.size
+            values = {}
+            for _ in range(value_count):
+                field_id = payload[offset]
+                offset += 1
+                if field_id == UNKNOWN_FIELD_ID:
+                    field, offset = self._read_string(payload, offset)
+                else:
+                    field = FIELD_NAMES[field_id]
+                value_type = payload[offset : offset + 1]
+                offset += 1
+                if value_type == b"f":
+                    (value,) = self.FLOAT.unpack_from(payload, offset)
+                    value = float(f"{value:.7g}")
+                    offset += self.FLOAT.size
+                elif value_type == b"i":
+                    (value,) = self.INT.unpack_from(payload, offset)
+                    offset += self.INT.size
+                elif value_type == b"s":
+                    value, offset = self._read_string(payload, offset)
+                else:
+                    value = {b"t": True, b"F": False, b"n": None}[value_type]
+                values[field] = value
+            entries.append({"ts": base_ts_ms + delta_ms, "values": values})
+        return entries
+
+    def _read_string(self, payload, offset):
+        length = payload[offset]
+        end = offset + 1 + length
+        return payload[offset + 1 : end].decode("utf-8"), end
+
+
+ENCODERS = {encoder.name: encoder for encoder in (JsonEncoder, MsgpackEncoder, StructEncoder)}
+
+
+def get_encoder(name):
+    return ENCODERS[name]()
@@ -0,0 +1,51 @@
+"""
+Hardware access for the sensors.
+
+Sensors get their GPIO connection, BME680 and 1-wire sensors from the active
+backend instead of constructing pigpio/busio/w1thermsensor objects themselves.
+The "pi" backend talks to the real hardware, the "simulated" backend replays
+traces in virtual time (see weather_station.hardware.simulated).
+"""
+import importlib
+
+# pigpio compatible constants, so the sensors don't need pigpio to be installed.
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+# level passed to callbacks when a watchdog fires
+TIMEOUT = 2
+INPUT = 0
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+
+BACKENDS = {
+    "pi": "weather_station.hardware.raspberry_pi:RaspberryPiBackend",
+    "simulated": "weather_station.hardware.simulated:SimulatedBackend",
+}
+
+_backend = None
+
+
+def tick_diff(start_tick, end_tick):
+    """Microseconds from start_tick to end_tick, handling the 32 bit wraparound."""
+    diff = end_tick - start_tick
+    if diff < 0:
+        diff += 1 << 32
+    return diff
+
+
+def use_backend(backend):
+    """Sets the backend for all sensors created from now on (a name or an instance)."""
+    global _backend
+    if isinstance(backend, str):
+        module_name, class_name = BACKENDS[backend].split(":")
+        backend = getattr(importlib.import_module(module_name), class_name)()
+    _backend = backend
+    return backend
+
+
+def get_backend():
+    if _backend is None:
+        use_backend("pi")
+    return _backend
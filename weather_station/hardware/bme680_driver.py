@@ -0,0 +1,122 @@
+"""
+Adafruit's BME680 driver with a batched read.
+
+The Adafruit driver rewrites all settings, triggers a conversion and polls the
+status register every 5ms whenever a property is read (unless the previous
+conversion is less than 1/refresh_rate old). read() instead triggers exactly one
+forced-mode conversion with settings that were written once by configure(),
+sleeps for the known conversion time and reads all four values from it.
+"""
+import time
+
+import adafruit_bme680
+
+from ..sensors.bme680 import conversion_time_ms
+
+REG_RES_HEAT_0 = 0x5A
+REG_GAS_WAIT_0 = 0x64
+REG_CTRL_GAS_1 = 0x71
+REG_CTRL_HUM = 0x72
+REG_CTRL_MEAS = 0x74
+REG_CONFIG = 0x75
+REG_STATUS = 0x1D
+
+RUN_GAS = 0x10
+MODE_FORCED = 0x01
+NEW_DATA = 0x80
+
+OVERSAMPLING = (0, 1, 2, 4, 8, 16)
+FILTER_SIZES = (0, 1, 3, 7, 15, 31, 63, 127)
+
+STATUS_POLL_INTERVAL_S = 0.002
+AMBIENT_TEMPERATURE_C = 25
+
+
+def gas_wait_register(duration_ms):
+    factor = 0
+    while duration_ms > 0x3F and factor < 3:
+        duration_ms //= 4
+        factor += 1
+    return min(duration_ms, 0x3F) | factor << 6
+
+
+class BatchedBME680(adafruit_bme680.Adafruit_BME680_I2C):
+    """
+    The temperature, humidity, pressure and gas properties return the values of
+    the last read().
+    """
+
+    def configure(
+        self,
+        temperature_oversample,
+        pressure_oversample,
+        humidity_oversample,
+        filter_size,
+        heater_temperature_c,
+        heater_duration_ms,
+    ):
+        self._temp_oversample = OVERSAMPLING.index(temperature_oversample)
+        self._pressure_oversample = OVERSAMPLING.index(pressure_oversample)
+        self._humidity_oversample = OVERSAMPLING.index(humidity_oversample)
+        self._filter = FILTER_SIZES.index(filter_size)
+        self._ctrl_meas = self._temp_oversample << 5 | self._pressure_oversample << 2
+        duration_ms = conversion_time_ms(
+            temperature_oversample, pressure_oversample, humidity_oversample, heater_duration_ms
+        )
+        self.conversion_time_s = duration_ms / 1000
+        # Only a write to ctrl_meas is needed per conversion, the rest sticks.
+        self._write(REG_CTRL_MEAS, [self._ctrl_meas])
+        self._write(REG_CONFIG, [self._filter << 2])
+        self._write(REG_CTRL_HUM, [self._humidity_oversample])
+        self._write(REG_RES_HEAT_0, [self._heater_resistance(heater_temperature_c)])
+        self._write(REG_GAS_WAIT_0, [gas_wait_register(heater_duration_ms)])
+        self._write(REG_CTRL_GAS_1, [RUN_GAS])
+
+    def read(self):
+        """Temperature, humidity, pressure and gas of one conversion."""
+        self._write(REG_CTRL_MEAS, [self._ctrl_meas | MODE_FORCED])
+        time.sleep(self.conversion_time_s)
+        data = self._read(REG_STATUS, 15)
+        while not data[0] & NEW_DATA:
+            time.sleep(STATUS_POLL_INTERVAL_S)
+            data = self._read(REG_STATUS, 15)
+        self._parse(data)
+        return {
+            "temperature": self.temperature,
+            "humidity": self.humidity,
+            "pressure": self.pressure,
+            "gas": self.gas,
+        }
+
+    def _perform_reading(self):
+        # The properties call this, read() already did the conversion.
+        pass
+
+    def _parse(self, data):
+        # Same as Adafruit_BME680._perform_reading
+        self._last_reading = time.monotonic()
+        self._adc_pres = adafruit_bme680._read24(data[2:5]) / 16
+        self._adc_temp = adafruit_bme680._read24(data[5:8]) / 16
+        self._adc_hum = data[8] << 8 | data[9]
+        self._adc_gas = int((data[13] << 8 | data[14]) / 64)
+        self._gas_range = data[14] & 0x0F
+
+        var1 = (self._adc_temp / 8) - (self._temp_calibration[0] * 2)
+        var2 = (var1 * self._temp_calibration[1]) / 2048
+        var3 = ((var1 / 2) * (var1 / 2)) / 4096
+        var3 = (var3 * self._temp_calibration[2] * 16) / 16384
+        self._t_fine = int(var2 + var3)
+
+    def _heater_resistance(self, target_c, ambient_c=AMBIENT_TEMPERATURE_C):
+        """res_heat register value for the target heater temperature (Bosch datasheet)."""
+        par_g1, par_g2, par_g3 = self._gas_calibration
+        heat_val = self._heat_val - 256 if self._heat_val > 127 else self._heat_val
+        var1 = (par_g1 / 16.0) + 49.0
+        var2 = ((par_g2 / 32768.0) * 0.0005) + 0.00235
+        var3 = par_g3 / 1024.0
+        var4 = var1 * (1.0 + (var2 * target_c))
+        var5 = var4 + (var3 * ambient_c)
+        resistance = 3.4 * (
+            (var5 * (4.0 / (4.0 + self._heat_range)) * (1.0 / (1.0 + (heat_val * 0.002)))) - 25
+        )
+        return max(0, min(255, int(resistance)))
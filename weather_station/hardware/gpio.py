@@ -0,0 +1,182 @@
+"""
+One GPIO connection for all sensors.
+
+Every pigpio.pi() is a socket to pigpiod plus a notification thread. The
+backends hand out one SharedGpio per process instead; pigpio multiplexes the
+callbacks of all pins over its one notification socket.
+
+SharedGpio keeps track of the pin settings, callbacks and watchdogs the sensors
+set up. stop() cancels all of them (pigpiod keeps watchdogs running after a
+client is gone), reconnect() opens a new connection and restores them. The
+station calls check() every CHECK_INTERVAL_S, which reconnects when pigpiod
+doesn't answer (e.g. after it was restarted).
+Notification pipes (see weather_station.hardware.notify) are closed by both and
+not restored; their readers see the end of the pipe.
+"""
+import logging
+import threading
+
+# pigpiod writes the reports of notification handle N here.
+NOTIFY_PIPE = "/dev/pigpio{}"
+CHECK_INTERVAL_S = 10
+
+
+class ManagedCallback:
+    def __init__(self, gpio, pin, edge, func):
+        self.gpio = gpio
+        self.pin = pin
+        self.edge = edge
+        self.func = func
+        # The callback of the current connection, None while disconnected.
+        self.handle = None
+
+    def cancel(self):
+        self.gpio.cancel_callback(self)
+
+
+class SharedGpio:
+    """The subset of pigpio.pi the sensors use, shared and tracked."""
+
+    def __init__(self, connect):
+        """connect() returns a new pigpio.pi (or something that behaves like one)."""
+        self.connect = connect
+        self.lock = threading.RLock()
+        # pin -> {setting method name: value}, to restore them on reconnect
+        self.pin_settings = {}
+        self.callbacks = []
+        # pin -> timeout in ms of the running watchdogs
+        self.watchdogs = {}
+        self.notify_handles = set()
+        self.pi = connect()
+
+    @property
+    def connected(self):
+        return self.pi is not None and self.pi.connected
+
+    def _set(self, method_name, pin, value):
+        with self.lock:
+            self.pin_settings.setdefault(pin, {})[method_name] = value
+            if self.pi is not None:
+                getattr(self.pi, method_name)(pin, value)
+
+    def set_mode(self, pin, mode):
+        self._set("set_mode", pin, mode)
+
+    def set_pull_up_down(self, pin, pud):
+        self._set("set_pull_up_down", pin, pud)
+
+    def set_glitch_filter(self, pin, steady):
+        self._set("set_glitch_filter", pin, steady)
+
+    def set_watchdog(self, pin, timeout_ms):
+        with self.lock:
+            if timeout_ms:
+                self.watchdogs[pin] = timeout_ms
+            else:
+                self.watchdogs.pop(pin, None)
+            if self.pi is not None:
+                self.pi.set_watchdog(pin, timeout_ms)
+
+    def callback(self, pin, edge, func):
+        callback = ManagedCallback(self, pin, edge, func)
+        with self.lock:
+            self.callbacks.append(callback)
+            if self.pi is not None:
+                callback.handle = self.pi.callback(pin, edge, func)
+        return callback
+
+    def cancel_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+            if callback.handle is not None:
+                callback.handle.cancel()
+                callback.handle = None
+
+    def open_notifications(self, bits):
+        """Starts notifications for the pins in the bits mask. Returns (handle, pipe)."""
+        with self.lock:
+            handle = self.pi.notify_open()
+            if handle < 0:
+                raise IOError(f"Opening a pigpio notification pipe failed ({handle})")
+            self.notify_handles.add(handle)
+            # Open before notify_begin, pigpiod doesn't wait for a reader.
+            pipe = open(NOTIFY_PIPE.format(handle), "rb", buffering=0)
+            self.pi.notify_begin(handle, bits)
+            return handle, pipe
+
+    def close_notifications(self, handle):
+        with self.lock:
+            if handle in self.notify_handles:
+                self.notify_handles.remove(handle)
+                if self.pi is not None:
+                    self.pi.notify_close(handle)
+
+    def read(self, pin):
+        return self.pi.read(pin)
+
+    def get_current_tick(self):
+        return self.pi.get_current_tick()
+
+    def _disconnect(self):
+        handles = [callback.handle for callback in self.callbacks if callback.handle is not None]
+        for callback in self.callbacks:
+            callback.handle = None
+        if self.pi is None:
+            return
+        try:
+            for handle in handles:
+                handle.cancel()
+            for pin in self.watchdogs:
+                self.pi.set_watchdog(pin, 0)
+            for handle in self.notify_handles:
+                self.pi.notify_close(handle)
+            self.pi.stop()
+        except Exception:
+            # E.g. pigpiod is gone already, the reason to reconnect.
+            logging.warning("Closing the pigpio connection failed", exc_info=True)
+        self.pi = None
+        self.notify_handles = set()
+
+    def stop(self):
+        """Cancels every callback and watchdog and closes the connection."""
+        with self.lock:
+            self._disconnect()
+            self.callbacks = []
+            self.watchdogs = {}
+
+    def reconnect(self):
+        """Opens a new connection and restores pin settings, callbacks and watchdogs."""
+        with self.lock:
+            self._disconnect()
+            self.pi = self.connect()
+            if not self.pi.connected:
+                logging.critical("Cannot reconnect to pigpio-pi")
+                return False
+            for pin, settings in self.pin_settings.items():
+                for method_name, value in settings.items():
+                    getattr(self.pi, method_name)(pin, value)
+            for callback in self.callbacks:
+                callback.handle = self.pi.callback(callback.pin, callback.edge, callback.func)
+            for pin, timeout_ms in self.watchdogs.items():
+                self.pi.set_watchdog(pin, timeout_ms)
+            return True
+
+    def check(self):
+        """Reconnects if pigpiod doesn't answer. Returns whether it's connected."""
+        with self.lock:
+            if self.connected:
+                try:
+                    self.pi.get_current_tick()
+                    return True
+                except Exception:
+                    logging.warning("pigpiod doesn't answer", exc_info=True)
+            logging.warning("Reconnecting to pigpiod")
+            try:
+                reconnected = self.reconnect()
+            except Exception:
+                logging.exception("Reconnecting to pigpiod failed")
+                return False
+            if reconnected:
+                logging.info("Reconnected to pigpiod, callbacks and watchdogs restored")
+            return reconnected
@@ -0,0 +1,184 @@
+"""
+Bulk edge ingestion from pigpio's notification pipe.
+
+pigpio's own callbacks cost a Python call (and a struct.unpack) per report and
+per callback. Instead, a NotificationReader reads the notification pipe of
+pigpiod (/dev/pigpioN) in chunks, parses all reports of a chunk at once with
+NumPy and hands every sensor the edges (and watchdog timeouts) of its pin as
+arrays::
+
+    sensor.handle_edges(ticks, levels)  # uint32 ticks, levels 0/1 or hardware.TIMEOUT
+
+It waits BATCH_INTERVAL_S between reads, so the reader wakes up at most that
+often no matter how fast the edges come. Sensors only see the edges they'd get
+a callback for (sensor.edge). Needs NumPy and pigpiod on the same machine.
+"""
+import logging
+import threading
+import time
+
+from . import FALLING_EDGE, RISING_EDGE, TIMEOUT
+from .. import metrics
+
+REPORT_SIZE = 12
+# Flags of a report (PI_NTFY_FLAGS_*), the low 5 bits are the gpio of a watchdog
+# or event report.
+FLAGS_WATCHDOG = 1 << 5
+FLAGS_ALIVE = 1 << 6
+FLAGS_EVENT = 1 << 7
+FLAGS_GPIO_MASK = 0x1F
+
+BATCH_INTERVAL_S = 0.02
+# The pipe holds 64KiB, more than 5000 reports.
+CHUNK_BYTES = 64 * 1024
+
+REPORTS = metrics.REGISTRY.counter("gpio_notification_reports_total", "pigpio notification reports read")
+LOST_REPORTS = metrics.REGISTRY.counter(
+    "gpio_notification_lost_reports_total", "Reports pigpiod dropped because the pipe was full"
+)
+BATCH_SECONDS = metrics.REGISTRY.histogram(
+    "gpio_notification_batch_seconds", "Time spent parsing and dispatching a chunk of reports",
+    buckets=metrics.FAST_BUCKETS,
+)
+
+
+def report_dtype():
+    import numpy as np
+
+    # seqno, flags, tick, level (a bit mask of gpios 0-31)
+    return np.dtype([("seqno", "<u2"), ("flags", "<u2"), ("tick", "<u4"), ("level", "<u4")])
+
+
+class NotificationReader(threading.Thread):
+    def __init__(self, gpio, batch_interval_s=BATCH_INTERVAL_S):
+        threading.Thread.__init__(self, name="gpio-notifications", daemon=True)
+        import numpy as np
+
+        self.np = np
+        self.dtype = report_dtype()
+        self.gpio = gpio
+        self.batch_interval_s = batch_interval_s
+        # pin -> sensor
+        self.sensors = {}
+        # pin -> level after the last report
+        self.levels = {}
+        self.seqno = None
+        self.handle = None
+        self.pipe = None
+        self.stopped = threading.Event()
+
+    def add_sensor(self, sensor):
+        """
+        Delivers the edges of sensor.pin in batches from now on. Cancels the
+        sensor's pigpio callback, if it has one.
+        """
+        if sensor.callback is not None:
+            sensor.callback.cancel()
+            sensor.callback = None
+        self.sensors[sensor.pin] = sensor
+        self.levels[sensor.pin] = self.gpio.read(sensor.pin)
+
+    def start(self):
+        bits = 0
+        for pin in self.sensors:
+            bits |= 1 << pin
+        self.handle, self.pipe = self.gpio.open_notifications(bits)
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle is not None:
+            # pigpiod closes the pipe, which ends the read in run().
+            self.gpio.close_notifications(self.handle)
+            self.handle = None
+        self.join()
+
+    def run(self):
+        remainder = b""
+        while not self.stopped.is_set():
+            data = self.pipe.read(CHUNK_BYTES)
+            if not data:
+                break
+            data = remainder + data
+            usable = len(data) - len(data) % REPORT_SIZE
+            remainder = data[usable:]
+            try:
+                self.process(data[:usable])
+            except Exception:
+                logging.exception("Handling GPIO notifications failed")
+            if len(data) < CHUNK_BYTES:
+                # Let the next batch accumulate.
+                self.stopped.wait(self.batch_interval_s)
+        self.pipe.close()
+
+    def process(self, data):
+        """Parses a chunk of whole reports and dispatches the edges to the sensors."""
+        np = self.np
+        started = time.perf_counter()
+        reports = np.frombuffer(data, dtype=self.dtype)
+        if not len(reports):
+            return
+        REPORTS.inc(len(reports))
+        self.check_seqno(reports["seqno"])
+        flags = reports["flags"]
+        ticks = reports["tick"]
+        is_level = (flags & (FLAGS_WATCHDOG | FLAGS_ALIVE | FLAGS_EVENT)) == 0
+        level_indices = np.flatnonzero(is_level)
+        watchdog_pins = np.where((flags & FLAGS_WATCHDOG) != 0, flags & FLAGS_GPIO_MASK, 0xFF)
+        for pin, sensor in self.sensors.items():
+            bits = ((reports["level"][level_indices] >> pin) & 1).astype(np.uint8)
+            if len(bits):
+                previous = np.empty_like(bits)
+                previous[0] = self.levels[pin]
+                previous[1:] = bits[:-1]
+                changed = bits != previous
+                self.levels[pin] = int(bits[-1])
+                if sensor.edge == RISING_EDGE:
+                    changed &= bits == 1
+                elif sensor.edge == FALLING_EDGE:
+                    changed &= bits == 0
+                edge_indices = level_indices[changed]
+                edge_levels = bits[changed]
+            else:
+                edge_indices = level_indices
+                edge_levels = bits
+            timeout_indices = np.flatnonzero(watchdog_pins == pin)
+            if len(timeout_indices):
+                indices = np.concatenate((edge_indices, timeout_indices))
+                levels = np.concatenate((edge_levels, np.full(len(timeout_indices), TIMEOUT, np.uint8)))
+                order = np.argsort(indices, kind="stable")
+                indices, levels = indices[order], levels[order]
+            else:
+                indices, levels = edge_indices, edge_levels
+            if len(indices):
+                sensor.handle_edges(ticks[indices], levels)
+        BATCH_SECONDS.observe(time.perf_counter() - started)
+
+    def check_seqno(self, seqnos):
+        np = self.np
+        if self.seqno is not None:
+            expected = (self.seqno + 1) & 0xFFFF
+            if seqnos[0] != expected:
+                self.report_lost((int(seqnos[0]) - expected) & 0xFFFF)
+        gaps = (np.diff(seqnos.astype(np.int32)) - 1) & 0xFFFF
+        lost = int(gaps.sum())
+        if lost:
+            self.report_lost(lost)
+        self.seqno = int(seqnos[-1])
+
+    def report_lost(self, count):
+        LOST_REPORTS.inc(count)
+        logging.warning(f"pigpiod dropped {count} GPIO notification reports")
+
+
+def pack_reports(events, first_seqno=0):
+    """
+    The reports pigpiod would write for events, a list of (tick, flags, level
+    bit mask). For tests and benchmarks.
+    """
+    import numpy as np
+
+    reports = np.zeros(len(events), dtype=report_dtype())
+    for index, (tick, flags, level) in enumerate(events):
+        reports[index] = ((first_seqno + index) & 0xFFFF, flags, tick & 0xFFFFFFFF, level)
+    return reports.tobytes()
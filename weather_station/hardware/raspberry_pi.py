@@ -0,0 +1,49 @@
+import threading
+import time
+
+from .gpio import SharedGpio
+
+
+class RaspberryPiBackend:
+    """The real thing. The hardware libraries are only imported when needed."""
+
+    name = "pi"
+
+    def __init__(self):
+        self._gpio = None
+        # Sensors are created in parallel.
+        self._gpio_lock = threading.Lock()
+
+    def gpio(self):
+        # One connection to pigpiod for all sensors.
+        with self._gpio_lock:
+            if self._gpio is None:
+                import pigpio  # http://abyz.co.uk/rpi/pigpio/python.html
+
+                self._gpio = SharedGpio(pigpio.pi)
+            return self._gpio
+
+    def close(self):
+        """Cancels all callbacks and watchdogs and disconnects from pigpiod."""
+        with self._gpio_lock:
+            if self._gpio is not None:
+                self._gpio.stop()
+                self._gpio = None
+
+    def bme680(self):
+        import board
+        import busio
+        from .bme680_driver import BatchedBME680
+
+        i2c = busio.I2C(board.SCL, board.SDA)
+        return BatchedBME680(i2c)
+
+    def w1_sensors(self):
+        """Every DS18B20 (and compatible) probe on the 1-wire bus."""
+        from w1thermsensor import W1ThermSensor
+
+        # all these 1-wire sensor are connected to GPIO Pin 4
+        return W1ThermSensor.get_available_sensors()
+
+    def time(self):
+        return time.time()
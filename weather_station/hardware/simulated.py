@@ -0,0 +1,441 @@
+"""
+Simulated hardware, so the station can run on any Linux box.
+
+A SimulatedClock provides virtual pigpio ticks and wall-clock time. The
+TraceReplayer advances it from edge to edge of a trace of (elapsed_us, gpio,
+level) events and fires pigpio style callbacks, watchdog TIMEOUTs and periodic
+jobs in between. Nothing sleeps, so a day of storm data replays in seconds (or
+at a fixed multiple of real time if asked to).
+
+Glitch filters are accepted but not simulated. Traces are expected to contain
+the edges pigpio would report, which are filtered already.
+"""
+import csv
+import heapq
+import itertools
+import math
+import random
+import time
+
+from . import EITHER_EDGE, PUD_UP, RISING_EDGE, TIMEOUT, use_backend
+from .gpio import SharedGpio
+from ..sensors import anemometer, bme680, rainfall, temperature, wind_vane
+
+# Start close to the 32 bit wraparound of the pigpio tick, so every simulation
+# exercises it after 10 virtual seconds.
+START_TICK = (1 << 32) - 10 * 1000 * 1000
+
+
+class SimulatedClock:
+    def __init__(self, start_time=None, start_tick=START_TICK):
+        self.start_time = time.time() if start_time is None else start_time
+        self.start_tick = start_tick
+        self.elapsed_us = 0
+
+    @property
+    def tick(self):
+        return (self.start_tick + self.elapsed_us) & 0xFFFFFFFF
+
+    def time(self):
+        return self.start_time + self.elapsed_us / 1e6
+
+
+class SimulatedCallback:
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+    def wants(self, level):
+        if self.edge == EITHER_EDGE:
+            return True
+        return level == (1 if self.edge == RISING_EDGE else 0)
+
+
+class SimulatedPi:
+    """The subset of pigpio.pi the sensors use."""
+
+    connected = True
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.callbacks = []
+        self.levels = {}
+        self.glitch_filters = {}
+        # gpio -> [timeout_us, due at elapsed_us]
+        self.watchdogs = {}
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def set_pull_up_down(self, gpio, pud):
+        self.levels[gpio] = 1 if pud == PUD_UP else 0
+
+    def set_glitch_filter(self, gpio, steady):
+        self.glitch_filters[gpio] = steady
+
+    def set_watchdog(self, user_gpio, wdog_timeout):
+        if wdog_timeout:
+            timeout_us = wdog_timeout * 1000
+            self.watchdogs[user_gpio] = [timeout_us, self.clock.elapsed_us + timeout_us]
+        else:
+            self.watchdogs.pop(user_gpio, None)
+
+    def callback(self, user_gpio, edge=RISING_EDGE, func=None):
+        callback = SimulatedCallback(self, user_gpio, edge, func)
+        self.callbacks.append(callback)
+        return callback
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def get_current_tick(self):
+        return self.clock.tick
+
+    def stop(self):
+        self.callbacks = []
+        self.watchdogs = {}
+
+    def emit(self, gpio, level):
+        if self.levels.get(gpio) == level:
+            return
+        self.levels[gpio] = level
+        watchdog = self.watchdogs.get(gpio)
+        if watchdog:
+            watchdog[1] = self.clock.elapsed_us + watchdog[0]
+        tick = self.clock.tick
+        for callback in self.callbacks[:]:
+            if callback.gpio == gpio and callback.wants(level):
+                callback.func(gpio, level, tick)
+
+    def next_watchdog(self):
+        """(due at elapsed_us, gpio) of the next watchdog to fire, or None."""
+        if not self.watchdogs:
+            return None
+        return min((due_us, gpio) for gpio, (timeout_us, due_us) in self.watchdogs.items())
+
+    def fire_watchdog(self, gpio):
+        watchdog = self.watchdogs[gpio]
+        # Fires again if there are no edges for another timeout.
+        watchdog[1] += watchdog[0]
+        tick = self.clock.tick
+        for callback in self.callbacks[:]:
+            if callback.gpio == gpio:
+                callback.func(gpio, TIMEOUT, tick)
+
+
+def synthetic_bme680_readings(ts):
+    """A mild day: temperature and humidity follow the sun, pressure drifts slowly."""
+    day = 2 * math.pi * (ts % 86400) / 86400
+    return {
+        "temperature": 12 - 6 * math.cos(day),
+        "humidity": 70 + 15 * math.cos(day),
+        "pressure": 1013 + 4 * math.sin(2 * math.pi * ts / (3 * 86400)),
+        "gas": 50000 + 5000 * math.sin(day),
+    }
+
+
+class SimulatedBME680:
+    def __init__(self, clock, readings=synthetic_bme680_readings):
+        self.clock = clock
+        self.readings = readings
+        self.settings = None
+        self.conversion_count = 0
+
+    def configure(self, **settings):
+        self.settings = settings
+
+    def read(self):
+        self.conversion_count += 1
+        readings = self.readings(self.clock.time())
+        return dict(readings, gas=int(readings["gas"]))
+
+    @property
+    def temperature(self):
+        return self.readings(self.clock.time())["temperature"]
+
+    @property
+    def humidity(self):
+        return self.readings(self.clock.time())["humidity"]
+
+    @property
+    def pressure(self):
+        return self.readings(self.clock.time())["pressure"]
+
+    @property
+    def gas(self):
+        return int(self.readings(self.clock.time())["gas"])
+
+
+def synthetic_ground_temperature(ts):
+    return 8 + math.sin(2 * math.pi * (ts % 86400) / 86400)
+
+
+class SimulatedW1ThermSensor:
+    def __init__(self, clock, sensor_id="0000051234ab", temperature=synthetic_ground_temperature):
+        self.clock = clock
+        self.id = sensor_id
+        self.temperature = temperature
+        self.precision = 12
+
+    def set_precision(self, precision, persist=False):
+        self.precision = precision
+
+    def get_temperature(self):
+        # 0.5°C steps at 9 bits, 0.0625°C at 12.
+        step = 0.5 / (1 << (self.precision - 9))
+        return round(round(self.temperature(self.clock.time()) / step) * step, 4)
+
+
+class SimulatedBackend:
+    name = "simulated"
+
+    def __init__(
+        self,
+        start_time=None,
+        bme680_readings=synthetic_bme680_readings,
+        ground_temperature=synthetic_ground_temperature,
+        w1_sensor_ids=("0000051234ab",),
+    ):
+        self.clock = SimulatedClock(start_time=start_time)
+        self.pi = SimulatedPi(self.clock)
+        self.shared_gpio = SharedGpio(lambda: self.pi)
+        self.bme680_readings = bme680_readings
+        self.ground_temperature = ground_temperature
+        self.w1_sensor_ids = w1_sensor_ids
+
+    def gpio(self):
+        # All sensors share one virtual board.
+        return self.shared_gpio
+
+    def close(self):
+        self.shared_gpio.stop()
+
+    def bme680(self):
+        return SimulatedBME680(self.clock, readings=self.bme680_readings)
+
+    def w1_sensors(self):
+        return [
+            SimulatedW1ThermSensor(self.clock, sensor_id=sensor_id, temperature=self.ground_temperature)
+            for sensor_id in self.w1_sensor_ids
+        ]
+
+    def time(self):
+        return self.clock.time()
+
+
+class TraceReplayer:
+    def __init__(self, backend):
+        self.backend = backend
+        self.clock = backend.clock
+        self.pi = backend.pi
+        self.edge_count = 0
+        self.speed = None
+        # (due at elapsed_us, sequence, period_us, function)
+        self._jobs = []
+        self._sequence = itertools.count()
+        self._started_at = None
+        self._started_us = None
+
+    def every(self, period_s, function):
+        """Calls function() every period_s virtual seconds."""
+        period_us = round(period_s * 1e6)
+        heapq.heappush(
+            self._jobs,
+            (self.clock.elapsed_us + period_us, next(self._sequence), period_us, function),
+        )
+
+    def replay(self, events, until_s=None, speed=None):
+        """
+        Replays (elapsed_us, gpio, level) events sorted by time. With speed, the
+        replay is slowed down to that multiple of real time.
+        """
+        self.speed = speed
+        self._started_at = time.monotonic()
+        self._started_us = self.clock.elapsed_us
+        until_us = None if until_s is None else round(until_s * 1e6)
+        for elapsed_us, gpio, level in events:
+            if until_us is not None and elapsed_us > until_us:
+                break
+            self.advance(elapsed_us)
+            self.pi.emit(gpio, level)
+            self.edge_count += 1
+        if until_us is not None:
+            self.advance(until_us)
+
+    def advance(self, elapsed_us):
+        """Moves the clock forward, firing watchdogs and jobs that are due on the way."""
+        while True:
+            job_due = self._jobs[0][0] if self._jobs else None
+            watchdog = self.pi.next_watchdog()
+            if watchdog is not None and watchdog[0] <= elapsed_us and (
+                job_due is None or watchdog[0] <= job_due
+            ):
+                self._set_clock(watchdog[0])
+                self.pi.fire_watchdog(watchdog[1])
+            elif job_due is not None and job_due <= elapsed_us:
+                due_us, sequence, period_us, function = heapq.heappop(self._jobs)
+                heapq.heappush(self._jobs, (due_us + period_us, sequence, period_us, function))
+                self._set_clock(due_us)
+                function()
+            else:
+                break
+        self._set_clock(elapsed_us)
+
+    def _set_clock(self, elapsed_us):
+        if elapsed_us <= self.clock.elapsed_us:
+            return
+        if self.speed:
+            ahead_s = (elapsed_us - self._started_us) / 1e6 / self.speed - (
+                time.monotonic() - self._started_at
+            )
+            if ahead_s > 0:
+                time.sleep(ahead_s)
+        self.clock.elapsed_us = elapsed_us
+
+
+# Traces #
+##########
+
+
+def anemometer_trace(duration_s, speed_km_per_h, pin=anemometer.PIN_ANEMOMETER, pulse_us=2000):
+    """Edges of an anemometer in wind of speed_km_per_h(elapsed_s)."""
+    cm_per_tick = (
+        anemometer.CIRCUMFERENCE_CM
+        * anemometer.CORRECTION_FACTOR
+        / anemometer.SIGNALS_PER_ROTATION
+    )
+    elapsed_us = 0.0
+    while elapsed_us < duration_s * 1e6:
+        speed = speed_km_per_h(elapsed_us / 1e6)
+        if speed < 0.5:
+            elapsed_us += 1e6
+            continue
+        period_us = cm_per_tick / (speed * 100000 / 3600) * 1e6
+        elapsed_us += period_us
+        yield round(elapsed_us), pin, 1
+        yield round(elapsed_us + min(pulse_us, period_us / 2)), pin, 0
+
+
+def rain_trace(duration_s, rain_mm_per_h, pin=rainfall.PIN, pulse_us=50000):
+    """Edges of the rain bucket in rain of rain_mm_per_h(elapsed_s)."""
+    elapsed_us = 0.0
+    while elapsed_us < duration_s * 1e6:
+        rate = rain_mm_per_h(elapsed_us / 1e6)
+        if rate < 0.01:
+            elapsed_us += 60e6
+            continue
+        elapsed_us += rainfall.BUCKET_SIZE_MM / rate * 3600e6
+        yield round(elapsed_us), pin, 1
+        yield round(elapsed_us + pulse_us), pin, 0
+
+
+def wind_vane_frame(dir_num):
+    """Pulse lengths (µs) of a frame the WindVane decodes to dir_num."""
+    pulses = [500] * (wind_vane.DIRECTION_BITS[-1][0] + 2)
+    for index, bit in wind_vane.DIRECTION_BITS:
+        if dir_num & bit:
+            pulses[index] = 1500
+    return pulses
+
+
+def wind_vane_trace(duration_s, direction_degrees, pin=wind_vane.PIN_WIND_VANE, frame_interval_s=1.0):
+    """Edges of the wind vane sending one frame every frame_interval_s."""
+    level = 0
+    frame_start_us = 0
+    while frame_start_us < duration_s * 1e6:
+        frame_start_us += round(frame_interval_s * 1e6)
+        dir_num = round(direction_degrees(frame_start_us / 1e6) / 22.5) % 16
+        elapsed_us = frame_start_us
+        level = 1 - level
+        yield elapsed_us, pin, level
+        for pulse_us in wind_vane_frame(dir_num):
+            elapsed_us += pulse_us
+            level = 1 - level
+            yield elapsed_us, pin, level
+
+
+def storm_trace(duration_s, mean_wind_km_per_h=60.0, mean_rain_mm_per_h=15.0, seed=0):
+    """A gusty, rainy day with a veering wind. Deterministic for a given seed."""
+    rng = random.Random(seed)
+    gust = {"km_per_h": 0.0, "direction": rng.uniform(0, 360)}
+
+    def speed(elapsed_s):
+        # gusts are a mean reverting random walk on top of a slow swell
+        gust["km_per_h"] += rng.gauss(0, 3) - gust["km_per_h"] * 0.05
+        swell = 0.3 * mean_wind_km_per_h * math.sin(2 * math.pi * elapsed_s / 1800)
+        return max(0.0, mean_wind_km_per_h + swell + gust["km_per_h"])
+
+    def rain(elapsed_s):
+        return mean_rain_mm_per_h * max(0.0, 1 + math.sin(2 * math.pi * elapsed_s / 5400))
+
+    def direction(elapsed_s):
+        gust["direction"] = (gust["direction"] + rng.gauss(0, 5)) % 360
+        return gust["direction"]
+
+    return heapq.merge(
+        anemometer_trace(duration_s, speed),
+        rain_trace(duration_s, rain),
+        wind_vane_trace(duration_s, direction),
+    )
+
+
+def load_trace(path):
+    """
+    Reads a trace from a CSV file with elapsed_us,gpio,level rows or from a file
+    written by `weather_station capture`.
+    """
+    from .. import capture
+
+    if capture.is_capture_file(path):
+        yield from capture.iter_edges(path)
+        return
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            yield int(row[0]), int(row[1]), int(row[2])
+
+
+def save_trace(path, events):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["# elapsed_us", "gpio", "level"])
+        writer.writerows(events)
+
+
+class SimulatedStation:
+    """All sensors of the station on a simulated backend, driven in virtual time."""
+
+    def __init__(self, report_function, backend=None):
+        self.backend = use_backend(backend or SimulatedBackend())
+        self.replayer = TraceReplayer(self.backend)
+
+        self.anemometer = anemometer.Anemometer(report_function=report_function)
+        self.anemometer.start(run_worker=False)
+        self.replayer.every(anemometer.SAMPLE_INTERVAL_S, self.anemometer.aggregate)
+
+        self.rainfall = rainfall.Rainfall(report_function=report_function)
+        self.rainfall.start()
+
+        self.wind_vane = wind_vane.WindVane(report_function=report_function)
+        self.wind_vane.start(run_worker=False)
+        self.replayer.every(0.5, self.wind_vane.process_frames)
+
+        self.bme680 = bme680.BME680(report_function=report_function)
+        self.replayer.every(
+            bme680.REPORT_INTERVAL_S, lambda: self.bme680.sample(self.backend.time())
+        )
+        self.temperature = temperature.Temperature(report_function=report_function)
+        self.replayer.every(
+            temperature.REPORT_INTERVAL_S, lambda: self.temperature.sample(self.backend.time())
+        )
+
+    def run(self, events, duration_s, speed=None):
+        self.replayer.replay(events, until_s=duration_s, speed=speed)
+        self.wind_vane.process_frames()
@@ -0,0 +1,199 @@
+"""
+Logging for the whole application.
+
+Sensor callbacks must not wait on the SD card. Records go through a bounded
+queue to one writer thread (logging's QueueHandler/QueueListener) that writes to
+a size-rotated file and flushes at most every FLUSH_INTERVAL_S (errors right
+away). Floods from one call site are rate limited before they are queued: after
+RATE_LIMIT_BURST records in RATE_LIMIT_INTERVAL_S, the rest is counted and
+reported with the next record that gets through.
+
+Worker processes (see weather_station.workers) send their records through a
+multiprocessing queue to the same writer.
+"""
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import threading
+import time
+
+LOG_FILENAME = "log_weather.log"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(processName)s/%(threadName)s %(message)s"
+LOG_DATEFMT = "%d/%m/%Y %I:%M:%S %p"
+LOG_LEVEL = logging.INFO
+
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 3
+FLUSH_INTERVAL_S = 10
+
+QUEUE_SIZE = 10000
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_INTERVAL_S = 60
+
+_listener = None
+_file_handler = None
+_worker_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most burst records per interval_s from every call site."""
+
+    def __init__(self, burst=RATE_LIMIT_BURST, interval_s=RATE_LIMIT_INTERVAL_S):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval_s = interval_s
+        # (pathname, lineno) -> [window start, records in window, suppressed]
+        self.call_sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = record.created
+        with self.lock:
+            site = self.call_sites.get(key)
+            if site is None or now - site[0] >= self.interval_s:
+                suppressed = site[2] if site else 0
+                self.call_sites[key] = [now, 1, 0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                suppressed = 0
+            else:
+                site[2] += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records instead of blocking (or raising) when the writer is behind."""
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped_count = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+class LazyFlushRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Flushes every FLUSH_INTERVAL_S and on errors instead of after every record.
+    A timer flushes the end of a burst, so nothing waits longer than that.
+    """
+
+    def __init__(self, filename, flush_interval_s=FLUSH_INTERVAL_S, **kwargs):
+        logging.handlers.RotatingFileHandler.__init__(self, filename, **kwargs)
+        self.flush_interval_s = flush_interval_s
+        self._flushed_at = time.monotonic()
+        self._flush_now = False
+        self._timer = None
+
+    def emit(self, record):
+        self._flush_now = record.levelno >= logging.ERROR
+        logging.handlers.RotatingFileHandler.emit(self, record)
+
+    def flush(self):
+        # Called with the handler's lock held, after every record.
+        since_flush_s = time.monotonic() - self._flushed_at
+        if self._flush_now or since_flush_s >= self.flush_interval_s:
+            self.force_flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.flush_interval_s - since_flush_s, self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_flush(self):
+        with self.lock:
+            self._timer = None
+            self.force_flush()
+
+    def force_flush(self):
+        logging.handlers.RotatingFileHandler.flush(self)
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.force_flush()
+        logging.handlers.RotatingFileHandler.close(self)
+
+
+def setup_logging(
+    filename=LOG_FILENAME,
+    level=LOG_LEVEL,
+    max_bytes=MAX_BYTES,
+    backup_count=BACKUP_COUNT,
+    rate_limit_burst=RATE_LIMIT_BURST,
+    rate_limit_interval_s=RATE_LIMIT_INTERVAL_S,
+):
+    """Routes the root logger through the queue to filename. Call once at startup."""
+    global _listener, _file_handler
+    stop_logging()
+    file_handler = LazyFlushRotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backup_count, delay=True
+    )
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    queue_handler = _install_queue_handler(
+        queue.Queue(maxsize=QUEUE_SIZE), level, rate_limit_burst, rate_limit_interval_s
+    )
+    _file_handler = file_handler
+    _listener = logging.handlers.QueueListener(queue_handler.queue, file_handler)
+    _listener.start()
+    return queue_handler
+
+
+def _install_queue_handler(log_queue, level, rate_limit_burst, rate_limit_interval_s):
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit_burst, rate_limit_interval_s))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    return queue_handler
+
+
+def worker_log_queue(context=multiprocessing):
+    """
+    The queue worker processes log to, written to the file of setup_logging.
+    None if setup_logging wasn't called.
+    """
+    global _worker_listener
+    if _file_handler is None:
+        return None
+    if _worker_listener is None:
+        _worker_listener = logging.handlers.QueueListener(context.Queue(QUEUE_SIZE), _file_handler)
+        _worker_listener.start()
+    return _worker_listener.queue
+
+
+def setup_worker_logging(log_queue, level=LOG_LEVEL):
+    """Called in a worker process, sends its records to the main process."""
+    return _install_queue_handler(log_queue, level, RATE_LIMIT_BURST, RATE_LIMIT_INTERVAL_S)
+
+
+def set_level(level):
+    """Changes the level at runtime, e.g. logging.DEBUG or "DEBUG"."""
+    logging.getLogger().setLevel(level)
+
+
+def stop_logging():
+    """Writes out what is queued and stops the writer thread."""
+    global _listener, _file_handler, _worker_listener
+    if _worker_listener is not None:
+        _worker_listener.stop()
+        _worker_listener = None
+    if _listener is None:
+        return
+    _file_handler = None
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
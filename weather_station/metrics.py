@@ -0,0 +1,224 @@
+"""
+Counters, gauges and histograms of the hot paths.
+
+Exported in the Prometheus text format (GET /metrics on the conditions server)
+and, through SelfTelemetry, as regular readings of the station itself.
+
+Updates are not locked: they run in pigpio callbacks and must stay cheap. Under
+contention an increment can get lost, which is fine for monitoring.
+"""
+import bisect
+import time
+
+# Seconds. Callbacks take µs, sensor reads and publishes ms to s.
+FAST_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 0.1)
+SLOW_BUCKETS = (1e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+SELF_TELEMETRY_INTERVAL_S = 60
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=SLOW_BUCKETS):
+        self.buckets = tuple(buckets)
+        # counts[i]: observations <= buckets[i] (and > buckets[i - 1]), the last one +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", format_value(bound)),), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, function):
+        self.function = function
+
+    @property
+    def value(self):
+        return self.function()
+
+    def samples(self, name, labels):
+        yield name, labels, self.function()
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Family:
+    """A metric and its children, one per combination of label values."""
+
+    def __init__(self, metric_class, name, help_text, label_names=(), **kwargs):
+        self.metric_class = metric_class
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.kwargs = kwargs
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.metric_class(**self.kwargs)
+        return child
+
+    # Shortcuts for metrics without labels.
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Family(Counter, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=SLOW_BUCKETS):
+        return self._register(Family(Histogram, name, help_text, labels, buckets=buckets))
+
+    def gauge(self, name, help_text, function):
+        """A gauge that calls function() when it is read. Replaces one with the same name."""
+        family = self._register(Family(Gauge, name, help_text, function=function))
+        family.labels()
+        return family
+
+    def _register(self, family):
+        self.families[family.name] = family
+        return family
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help_text}")
+            lines.append(f"# TYPE {family.name} {family.metric_class.kind}")
+            for values, child in list(family.children.items()):
+                for name, labels, value in child.samples(family.name, tuple(zip(family.label_names, values))):
+                    lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+CALLBACKS = REGISTRY.counter("gpio_callbacks_total", "pigpio callbacks handled", ("sensor",))
+CALLBACK_LAG_SECONDS = REGISTRY.histogram(
+    "gpio_callback_lag_seconds",
+    "Age of the newest edge a sensor had handled when it was looked at, at least the callback lag",
+    ("sensor",),
+)
+SENSOR_READ_SECONDS = REGISTRY.histogram(
+    "sensor_read_seconds", "Duration of polled sensor reads", ("sensor",)
+)
+REPORT_SECONDS = REGISTRY.histogram(
+    "report_seconds", "Duration of WeatherStationApplication.report", buckets=FAST_BUCKETS
+)
+PUBLISH_SECONDS = REGISTRY.histogram("publish_seconds", "Duration of handing a batch to the MQTT client")
+PUBLISH_ACK_SECONDS = REGISTRY.histogram(
+    "publish_ack_seconds", "Time from publishing spooled readings until the broker acknowledged them"
+)
+PUBLISH_FAILURES = REGISTRY.counter("publish_failures_total", "Failed publishes")
+PUBLISHED_READINGS = REGISTRY.counter("published_readings_total", "Readings the broker received")
+
+
+def instrument_callback(sensor, callback):
+    """
+    Wraps a pigpio callback to count it. It runs for every edge, so that's all:
+    the sensors observe CALLBACK_LAG_SECONDS off the callback thread, or from
+    their TickClock instead of asking pigpiod for the current tick.
+    """
+    calls = CALLBACKS.labels(sensor)
+
+    def instrumented(gpio, level, tick):
+        calls.value += 1
+        callback(gpio, level, tick)
+
+    return instrumented
+
+
+class SelfTelemetry:
+    """
+    The metrics as readings of the station: counters and gauges as they are,
+    histograms as count and mean (ms) since the previous sample.
+    """
+
+    def __init__(self, registry=REGISTRY, prefix="station_"):
+        self.registry = registry
+        self.prefix = prefix
+        self.previous = {}
+
+    def sample(self):
+        data = {}
+        for family in self.registry.families.values():
+            for values, child in list(family.children.items()):
+                name = "_".join((self.prefix + family.name,) + values)
+                if isinstance(child, Histogram):
+                    count, total = child.count, child.sum
+                    previous_count, previous_total = self.previous.get(name, (0, 0.0))
+                    self.previous[name] = (count, total)
+                    data[f"{name}_count"] = count - previous_count
+                    if count > previous_count:
+                        data[f"{name}_mean_ms"] = round(
+                            (total - previous_total) / (count - previous_count) * 1000, 3
+                        )
+                else:
+                    data[name] = child.value
+        return data
@@ -0,0 +1,267 @@
+"""
+Processing of readings between the sensors and the sinks.
+
+A Pipeline is a list of stages, run by the telemetry publisher on every batch
+it flushes, on its own thread, so no rule ends up on a pigpio callback thread.
+A stage is a generator over (ts_ms, values) readings::
+
+    def process(self, readings):
+        for ts_ms, values in readings:
+            ...
+            yield ts_ms, values
+
+The stages of a batch are chained lazily, so a reading passes through all of
+them before the next one is read. Stages keep their state between batches and
+never change the values dicts they get (the current conditions share them).
+
+Pipelines are configured in an INI file, one section per stage in order, `type`
+one of STAGE_TYPES and the other keys the stage's arguments::
+
+    [spikes]
+    type = median_filter
+    fields = temperature_c, humidity_pct
+    window = 5
+    max_deviation = 3
+
+    [fahrenheit]
+    type = convert
+    field = temperature_c
+    to = temperature_f
+    scale = 1.8
+    offset = 32
+    keep = 1
+
+The pipeline only runs when there is a publisher (a broker or the store).
+"""
+import bisect
+import collections
+import configparser
+
+from . import metrics
+from .sensors import parse_value
+from .store import is_numeric
+
+PIPELINE_SECONDS = metrics.REGISTRY.histogram(
+    "pipeline_seconds", "Time spent processing a batch of readings", buckets=metrics.FAST_BUCKETS
+)
+REJECTED_VALUES = metrics.REGISTRY.counter(
+    "pipeline_rejected_values_total", "Values the median filter rejected as spikes", ("field",)
+)
+
+
+def parse_fields(fields):
+    """'a, b' or an iterable of names -> a frozenset of field names"""
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    return frozenset(field.strip() for field in fields if field.strip())
+
+
+def window_label(window_s):
+    """30s, 10min, 1h, like the names of the sensors' own aggregates."""
+    if window_s % 3600 == 0:
+        return f"{window_s // 3600}h"
+    if window_s % 60 == 0:
+        return f"{window_s // 60}min"
+    return f"{window_s}s"
+
+
+class MedianFilter:
+    """
+    Drops values that are more than max_deviation away from the median of the
+    last window values of their field. Every value joins the window, so a real
+    step change passes once it's the majority.
+    """
+
+    def __init__(self, fields, window=5, max_deviation=1.0):
+        self.fields = parse_fields(fields)
+        self.window = window
+        self.max_deviation = max_deviation
+        # field -> (the last window values, the same sorted)
+        self.windows = {}
+
+    def process(self, readings):
+        for ts_ms, values in readings:
+            kept = values
+            for field in self.fields.intersection(values):
+                value = values[field]
+                if is_numeric(value) and self.is_spike(field, value):
+                    if kept is values:
+                        kept = dict(values)
+                    del kept[field]
+                    REJECTED_VALUES.labels(field).inc()
+            if kept:
+                yield ts_ms, kept
+
+    def is_spike(self, field, value):
+        if field not in self.windows:
+            self.windows[field] = (collections.deque(), [])
+        recent, ordered = self.windows[field]
+        # Don't judge until half the window is there.
+        spike = len(ordered) > self.window // 2 and abs(value - median(ordered)) > self.max_deviation
+        recent.append(value)
+        bisect.insort(ordered, value)
+        if len(recent) > self.window:
+            del ordered[bisect.bisect_left(ordered, recent.popleft())]
+        return spike
+
+
+def median(ordered):
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class Convert:
+    """value * scale + offset, as the field to (in place without), rounded to digits."""
+
+    def __init__(self, field, to=None, scale=1.0, offset=0.0, digits=None, keep=False):
+        self.field = field
+        self.to = to or field
+        self.scale = scale
+        self.offset = offset
+        self.digits = digits
+        # Keep the original field next to the converted one.
+        self.keep = bool(keep)
+
+    def process(self, readings):
+        field = self.field
+        for ts_ms, values in readings:
+            value = values.get(field)
+            if is_numeric(value):
+                values = dict(values)
+                if not self.keep:
+                    del values[field]
+                value = value * self.scale + self.offset
+                values[self.to] = value if self.digits is None else round(value, self.digits)
+            yield ts_ms, values
+
+
+class Resample:
+    """
+    Moves fields onto a fixed grid of interval_s (aligned to the epoch). At a
+    grid point, every field has its latest value at or before it. A grid point
+    is emitted with the first reading after it; after a gap, only the first
+    grid point after the last value is, gaps stay gaps.
+    """
+
+    def __init__(self, fields, interval_s):
+        self.fields = parse_fields(fields)
+        self.interval_ms = int(interval_s * 1000)
+        self.latest = {}
+        # The next grid point to emit.
+        self.next_ms = None
+
+    def process(self, readings):
+        for ts_ms, values in readings:
+            fields = self.fields.intersection(values)
+            if not fields:
+                yield ts_ms, values
+                continue
+            if self.next_ms is not None and ts_ms > self.next_ms:
+                yield self.next_ms, dict(self.latest)
+                self.next_ms = None
+            for field in fields:
+                self.latest[field] = values[field]
+            if self.next_ms is None or ts_ms > self.next_ms:
+                self.next_ms = -(-ts_ms // self.interval_ms) * self.interval_ms
+            rest = {field: value for field, value in values.items() if field not in fields}
+            if rest:
+                yield ts_ms, rest
+
+
+class Aggregate:
+    """
+    Tumbling windows of window_s (aligned to the epoch). Adds a reading with the
+    functions (of mean, min, max, count) of every field, e.g. temperature_c_10min_mean,
+    at the end of a window, with the first reading after it. Readings pass through.
+    """
+
+    FUNCTIONS = ("mean", "min", "max", "count")
+
+    def __init__(self, fields, window_s, functions="mean, min, max"):
+        self.fields = parse_fields(fields)
+        self.window_ms = int(window_s * 1000)
+        self.functions = [function.strip() for function in functions.split(",")]
+        unknown = set(self.functions) - set(self.FUNCTIONS)
+        if unknown:
+            raise ValueError(f"Unknown aggregate functions {', '.join(sorted(unknown))}, of {', '.join(self.FUNCTIONS)}")
+        self.label = window_label(window_s)
+        self.window_start_ms = None
+        # field -> [min, max, sum, count], like the store's rollups
+        self.aggregates = {}
+
+    def process(self, readings):
+        for ts_ms, values in readings:
+            fields = self.fields.intersection(values)
+            if fields:
+                start_ms = ts_ms - ts_ms % self.window_ms
+                if self.window_start_ms is None or start_ms > self.window_start_ms:
+                    if self.aggregates:
+                        yield self.window_start_ms + self.window_ms, self.summary()
+                        self.aggregates = {}
+                    self.window_start_ms = start_ms
+                # Late readings count towards the current window.
+                for field in fields:
+                    value = values[field]
+                    if not is_numeric(value):
+                        continue
+                    aggregate = self.aggregates.get(field)
+                    if aggregate is None:
+                        self.aggregates[field] = [value, value, value, 1]
+                    else:
+                        aggregate[0] = min(aggregate[0], value)
+                        aggregate[1] = max(aggregate[1], value)
+                        aggregate[2] += value
+                        aggregate[3] += 1
+            yield ts_ms, values
+
+    def summary(self):
+        summary = {}
+        for field, (minimum, maximum, total, count) in self.aggregates.items():
+            results = {"mean": total / count, "min": minimum, "max": maximum, "count": count}
+            for function in self.functions:
+                summary[f"{field}_{self.label}_{function}"] = results[function]
+        return summary
+
+
+# type -> stage class
+STAGE_TYPES = {
+    "median_filter": MedianFilter,
+    "convert": Convert,
+    "resample": Resample,
+    "aggregate": Aggregate,
+}
+
+
+class Pipeline:
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+
+    def __repr__(self):
+        return f"<Pipeline {' -> '.join(type(stage).__name__ for stage in self.stages)}>"
+
+    def process(self, readings):
+        """The readings (a list of (ts_ms, values)) after all stages, as a list."""
+        with PIPELINE_SECONDS.time():
+            for stage in self.stages:
+                readings = stage.process(readings)
+            return list(readings)
+
+
+def load_config(path):
+    """The Pipeline of the INI file at path, its stages in the order of its sections."""
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(path) as f:
+        parser.read_file(f)
+    stages = []
+    for name in parser.sections():
+        options = {key: parse_value(value) for key, value in parser.items(name)}
+        stage_type = options.pop("type", None)
+        if stage_type not in STAGE_TYPES:
+            raise ValueError(f"Stage {name} in {path} has no type of {', '.join(STAGE_TYPES)}")
+        try:
+            stages.append(STAGE_TYPES[stage_type](**options))
+        except TypeError as e:
+            raise ValueError(f"Stage {name} in {path}: {e}")
+    return Pipeline(stages)
@@ -0,0 +1,250 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+from . import metrics
+from .encoding import JsonEncoder
+
+TELEMETRY_TOPIC = "devices/weather-station/telemetry"
+TELEMETRY_QOS = 1
+
+MAX_QUEUE_SIZE = 10000
+# Flush whenever MAX_BATCH_SIZE readings are waiting or the oldest waiting reading
+# is MAX_BATCH_DELAY_S old, whatever comes first.
+MAX_BATCH_SIZE = 500
+MAX_BATCH_DELAY_S = 10
+
+# What to do with a new reading if the queue is full.
+DROP_OLDEST = "drop-oldest"  # make room by throwing away the oldest queued reading
+DROP_NEWEST = "drop-newest"  # throw away the new reading
+BLOCK = "block"  # wait for the publisher (never use this from a pigpio callback)
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+# Replaying the spool: readings per publish, unacknowledged publishes at a time and
+# how often to come back for more while a backlog is waiting (while the broker is
+# connected or not).
+REPLAY_BATCH_SIZE = 2000
+MAX_INFLIGHT_REPLAYS = 4
+REPLAY_POLL_INTERVAL_S = 0.1
+OFFLINE_POLL_INTERVAL_S = 1
+
+# paho.mqtt.client.MQTT_ERR_NO_CONN: not sent, but queued (QoS > 0) and sent
+# when the client reconnects.
+MQTT_ERR_NO_CONN = 4
+
+_STOP = object()
+
+
+class TelemetryPublisher(threading.Thread):
+    """
+    Collects readings from all sensors in a bounded queue and publishes them in
+    batches from its own thread, so the sensor callbacks never wait on the network.
+
+    With a spool, every batch is written to disk first and published by replaying
+    the spool whenever the broker is connected. Every batch is also passed to the
+    sinks (callables taking a list of (ts_ms, values) readings, e.g. a local
+    store). Without get_client, batches only go to the sinks.
+
+    A report_filter (see reporting.DeadbandFilter) decides which values of a batch
+    are sent to the broker; the sinks get all of them. A pipeline (see
+    weather_station.pipeline) processes every batch before both.
+    """
+
+    def __init__(
+        self,
+        get_client,
+        topic=TELEMETRY_TOPIC,
+        max_queue_size=MAX_QUEUE_SIZE,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_batch_delay_s=MAX_BATCH_DELAY_S,
+        overflow_policy=DROP_OLDEST,
+        spool=None,
+        is_connected=None,
+        replay_batch_size=REPLAY_BATCH_SIZE,
+        sinks=(),
+        report_filter=None,
+        encoder=None,
+        pipeline=None,
+    ):
+        threading.Thread.__init__(self, name="telemetry-publisher", daemon=True)
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.get_client = get_client
+        self.topic = topic
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay_s = max_batch_delay_s
+        self.overflow_policy = overflow_policy
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped_count = 0
+        self.published_count = 0
+        self.spool = spool
+        self.is_connected = is_connected or (lambda: True)
+        self.replay_batch_size = replay_batch_size
+        self.sinks = list(sinks)
+        self.report_filter = report_filter
+        self.encoder = encoder or JsonEncoder()
+        self.pipeline = pipeline
+        # (message info, spool position, reading count, published at) of replays
+        # waiting for a PUBACK
+        self._inflight = collections.deque()
+        self._replay_position = spool.cursor if spool else None
+
+    def put(self, ts, data):
+        reading = (int(ts * 1000), data)
+        if self.overflow_policy == BLOCK:
+            self.queue.put(reading)
+            return
+        try:
+            self.queue.put_nowait(reading)
+            return
+        except queue.Full:
+            self.dropped_count += 1
+            if self.overflow_policy == DROP_NEWEST:
+                return
+        # DROP_OLDEST: make room and try once more. If another thread was faster,
+        # the reading is dropped after all.
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(reading)
+        except queue.Full:
+            pass
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self.join()
+
+    def run(self):
+        batch = []
+        flush_at = None
+        while True:
+            if batch:
+                timeout = max(0, flush_at - time.monotonic())
+            else:
+                timeout = None
+            if self.has_backlog():
+                poll_interval = (
+                    REPLAY_POLL_INTERVAL_S if self.is_connected() else OFFLINE_POLL_INTERVAL_S
+                )
+                if timeout is None or timeout > poll_interval:
+                    timeout = poll_interval
+            try:
+                reading = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                reading = None
+                self.replay()
+            if reading is _STOP:
+                self.flush(batch)
+                if self.spool:
+                    self.spool.close()
+                return
+            if reading is not None:
+                if not batch:
+                    flush_at = time.monotonic() + self.max_batch_delay_s
+                batch.append(reading)
+            if len(batch) >= self.max_batch_size or (
+                batch and time.monotonic() >= flush_at
+            ):
+                self.flush(batch)
+                batch = []
+
+    def flush(self, batch):
+        if self.pipeline and batch:
+            try:
+                batch = self.pipeline.process(batch)
+            except Exception:
+                # Better unprocessed than lost.
+                logging.exception(f"Processing telemetry with {self.pipeline} failed")
+        if not batch:
+            return
+        for sink in self.sinks:
+            try:
+                sink(batch)
+            except Exception:
+                logging.exception(f"Telemetry sink {sink} failed")
+        if self.get_client is None:
+            return
+        if self.report_filter:
+            batch = self.report_filter.filter_batch(batch)
+            if not batch:
+                return
+        if self.spool:
+            self.spool.append(batch)
+            self.replay()
+            return
+        try:
+            client = self.get_client()
+        except Exception:
+            logging.exception("Cannot connect to the telemetry broker")
+            client = None
+        if client is None:
+            self.dropped_count += len(batch)
+            metrics.PUBLISH_FAILURES.inc()
+            return
+        payload = self.encoder.encode(batch)
+        with metrics.PUBLISH_SECONDS.time():
+            info = client.publish(self.topic, payload, TELEMETRY_QOS)
+        if info.rc != 0:
+            self.dropped_count += len(batch)
+            metrics.PUBLISH_FAILURES.inc()
+            return
+        self.published_count += len(batch)
+        metrics.PUBLISHED_READINGS.inc(len(batch))
+
+    def has_backlog(self):
+        return bool(self._inflight) or (self.spool is not None and self.spool.has_backlog())
+
+    def replay(self):
+        """
+        Publishes the spooled backlog in bulk, keeping at most MAX_INFLIGHT_REPLAYS
+        publishes unacknowledged. The spool cursor only moves past readings the
+        broker has acknowledged.
+        """
+        if self.spool is None:
+            return
+        while self._inflight and (
+            self._inflight[0][0] is None or self._inflight[0][0].is_published()
+        ):
+            info, position, count, published_at = self._inflight.popleft()
+            self.spool.commit(position)
+            self.published_count += count
+            if info is not None:
+                # Resolution is REPLAY_POLL_INTERVAL_S, replay() polls for PUBACKs.
+                metrics.PUBLISH_ACK_SECONDS.observe(time.monotonic() - published_at)
+                metrics.PUBLISHED_READINGS.inc(count)
+        try:
+            client = self.get_client()
+        except Exception:
+            logging.exception("Cannot connect to the telemetry broker")
+            return
+        if client is None or not self.is_connected():
+            return
+        if len(self._inflight) >= MAX_INFLIGHT_REPLAYS:
+            return
+        batches = self.spool.read_batches(self.replay_batch_size, start=self._replay_position)
+        for readings, position in batches:
+            if readings:
+                if not self.is_connected():
+                    break
+                payload = self.encoder.encode(readings)
+                with metrics.PUBLISH_SECONDS.time():
+                    info = client.publish(self.topic, payload, TELEMETRY_QOS)
+                if info.rc not in (0, MQTT_ERR_NO_CONN):
+                    metrics.PUBLISH_FAILURES.inc()
+                    logging.warning("Publishing spooled telemetry failed (rc=%s)", info.rc)
+                    break
+            else:
+                info = None
+            self._inflight.append((info, position, len(readings), time.monotonic()))
+            self._replay_position = position
+            if info is not None and info.rc == MQTT_ERR_NO_CONN:
+                # Disconnected since the check. The client sends it once it
+                # reconnects, so it is in flight like the others.
+                break
+            if len(self._inflight) >= MAX_INFLIGHT_REPLAYS:
+                break
+        batches.close()
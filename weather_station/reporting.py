@@ -0,0 +1,128 @@
+"""
+Send-on-delta reporting.
+
+A field is only published when it moved out of its deadband around the last
+published value, and not more often than its min_interval_s. A field that has
+not been published for heartbeat_s is published with its next reading anyway,
+so a quiet field still shows up as alive. Fields without a deadband are
+published whenever they change.
+
+Local consumers (the store, the current conditions) still get every reading;
+the filter only thins out what goes to the broker.
+"""
+import fnmatch
+
+HEARTBEAT_S = 10 * 60
+
+
+class FieldPolicy:
+    def __init__(self, absolute=None, relative=None, min_interval_s=0, heartbeat_s=HEARTBEAT_S, always=False):
+        self.absolute = absolute
+        self.relative = relative
+        self.min_interval_s = min_interval_s
+        self.heartbeat_s = heartbeat_s
+        # Events (e.g. the rain of one bucket tip) are published every time.
+        self.always = always
+
+    def __repr__(self):
+        return (
+            f"<FieldPolicy absolute={self.absolute} relative={self.relative} "
+            f"min_interval_s={self.min_interval_s} heartbeat_s={self.heartbeat_s}>"
+        )
+
+    def changed(self, value, last_value):
+        if self.absolute is None and self.relative is None:
+            return value != last_value
+        try:
+            delta = abs(value - last_value)
+        except TypeError:  # not a number (any more)
+            return value != last_value
+        if self.absolute is not None and delta >= self.absolute:
+            return True
+        if self.relative is not None and delta >= self.relative * abs(last_value):
+            return True
+        return False
+
+
+# Field name (or fnmatch pattern) -> policy. The first match wins, exact names
+# before patterns.
+POLICIES = {
+    "temperature_c": FieldPolicy(absolute=0.2),
+    "temperature_underground_c": FieldPolicy(absolute=0.1),
+    "temperature_*_c": FieldPolicy(absolute=0.1),
+    "humidity_pct": FieldPolicy(absolute=1.0),
+    "pressure_hpa": FieldPolicy(absolute=0.2),
+    "gas_ohms": FieldPolicy(relative=0.05),
+    "rain_amount_mm": FieldPolicy(always=True),
+    "rain_amount_mm_per_h": FieldPolicy(always=True),
+    "rain_*": FieldPolicy(),
+    "wind_speed_km_per_h": FieldPolicy(absolute=1.0, relative=0.1),
+    "wind_speed_*": FieldPolicy(absolute=1.0, relative=0.1, min_interval_s=30),
+    "wind_gust_*": FieldPolicy(absolute=1.0, relative=0.1, min_interval_s=30),
+    "wind_lull_*": FieldPolicy(absolute=1.0, relative=0.1, min_interval_s=30),
+    "wind_direction_degrees": FieldPolicy(absolute=22.5),
+    "wind_direction_*": FieldPolicy(min_interval_s=30),
+    "dew_point_c": FieldPolicy(absolute=0.2),
+    "absolute_humidity_g_per_m3": FieldPolicy(absolute=0.1),
+    "heat_index_c": FieldPolicy(absolute=0.2),
+    "wind_chill_c": FieldPolicy(absolute=0.5, min_interval_s=30),
+    "pressure_qnh_hpa": FieldPolicy(absolute=0.2),
+    "pressure_tendency_3h_hpa": FieldPolicy(absolute=0.1),
+}
+DEFAULT_POLICY = FieldPolicy()
+
+
+class DeadbandFilter:
+    """Not thread safe; the telemetry publisher runs it on its own thread."""
+
+    def __init__(self, policies=POLICIES, default_policy=DEFAULT_POLICY):
+        self.policies = policies
+        self.default_policy = default_policy
+        # field -> (last published ts_ms, value)
+        self.published = {}
+        self._resolved = {}
+        self.received_count = 0
+        self.suppressed_count = 0
+
+    def policy(self, field):
+        policy = self._resolved.get(field)
+        if policy is None:
+            policy = self.policies.get(field)
+            if policy is None:
+                policy = next(
+                    (
+                        policy
+                        for pattern, policy in self.policies.items()
+                        if fnmatch.fnmatchcase(field, pattern)
+                    ),
+                    self.default_policy,
+                )
+            self._resolved[field] = policy
+        return policy
+
+    def filter(self, ts_ms, values):
+        """The part of the values that has to be published."""
+        publish = {}
+        for field, value in values.items():
+            self.received_count += 1
+            policy = self.policy(field)
+            last = self.published.get(field)
+            if last is not None and not policy.always:
+                since_ms = ts_ms - last[0]
+                if since_ms < policy.heartbeat_s * 1000 and (
+                    since_ms < policy.min_interval_s * 1000 or not policy.changed(value, last[1])
+                ):
+                    self.suppressed_count += 1
+                    continue
+            self.published[field] = (ts_ms, value)
+            publish[field] = value
+        return publish
+
+    def filter_batch(self, readings):
+        """Filters (ts_ms, values) readings, leaving out the ones with nothing to publish."""
+        filtered = []
+        for ts_ms, values in readings:
+            values = self.filter(ts_ms, values)
+            if values:
+                filtered.append((ts_ms, values))
+        return filtered
@@ -0,0 +1,130 @@
+"""
+One scheduler for all polled sensors.
+
+Jobs fire on absolute deadlines aligned to the wall clock (multiples of their
+period, shifted by their phase), so jobs with the same period sample at the same
+timestamps and their readings end up in the same telemetry record. The blocking
+reads run in one single-threaded executor per bus: reads on the same bus never
+overlap, reads on different buses run concurrently.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import math
+import threading
+import time
+
+
+def next_deadline(now, period_s, phase_s=0.0):
+    return math.ceil((now - phase_s) / period_s) * period_s + phase_s
+
+
+class Job:
+    def __init__(self, name, function, period_s, phase_s=0.0, bus=None):
+        self.name = name
+        self.function = function
+        self.period_s = period_s
+        self.phase_s = phase_s
+        self.bus = bus or name
+        self.runs = 0
+        self.failures = 0
+        # Deadlines that were skipped because the previous run was still busy.
+        self.overruns = 0
+        self.last_duration_s = None
+
+    def __repr__(self):
+        return f"<Job {self.name} every {self.period_s}s on {self.bus}>"
+
+
+class SensorScheduler(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, name="sensor-scheduler")
+        self.jobs = []
+        self.executors = {}
+        self.loop = None
+        # Set once run() has created the loop and its tasks (or failed to).
+        self.loop_ready = threading.Event()
+        self._tasks = []
+
+    def add_job(self, name, function, period_s, phase_s=0.0, bus=None):
+        """
+        Calls function(ts) every period_s seconds, with ts being the deadline the
+        call was scheduled for. The period_s of the returned Job can be changed
+        while the scheduler runs; it applies from the next deadline on.
+        """
+        job = Job(name, function, period_s, phase_s=phase_s, bus=bus)
+        self.jobs.append(job)
+        return job
+
+    def stop(self):
+        if self.ident is None:
+            # Never started, e.g. the station failed to start.
+            return
+        self.loop_ready.wait()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._cancel_tasks)
+            except RuntimeError:
+                # The loop is closed, run() is done already.
+                pass
+        self.join()
+
+    def run(self):
+        try:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self._tasks = [self.loop.create_task(self._run_job(job)) for job in self.jobs]
+        finally:
+            self.loop_ready.set()
+        try:
+            self.loop.run_until_complete(
+                asyncio.gather(*self._tasks, return_exceptions=True)
+            )
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.loop.close()
+
+    def _cancel_tasks(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def _executor(self, bus):
+        if bus not in self.executors:
+            self.executors[bus] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"bus-{bus}"
+            )
+        return self.executors[bus]
+
+    async def _run_job(self, job):
+        executor = self._executor(job.bus)
+        period_s = job.period_s
+        deadline = next_deadline(time.time(), period_s, job.phase_s)
+        while True:
+            await asyncio.sleep(max(0, deadline - time.time()))
+            started_at = time.monotonic()
+            try:
+                await self.loop.run_in_executor(executor, job.function, deadline)
+            except Exception:
+                job.failures += 1
+                logging.exception(f"Sensor job {job.name} failed")
+            job.runs += 1
+            job.last_duration_s = time.monotonic() - started_at
+
+            if job.period_s != period_s:
+                # Changed while running, e.g. by weather_station.adaptive. Stay
+                # aligned to the new period, between half and one and a half of
+                # it after the last deadline.
+                period_s = job.period_s
+                deadline = next_deadline(deadline + period_s / 2, period_s, job.phase_s)
+            else:
+                deadline += period_s
+            now = time.time()
+            if deadline < now:
+                missed = math.ceil((now - deadline) / period_s)
+                job.overruns += missed
+                deadline += missed * period_s
+                logging.warning(
+                    f"Sensor job {job.name} took {job.last_duration_s:.3f}s, "
+                    f"skipped {missed} deadline(s)"
+                )
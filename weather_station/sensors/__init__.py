@@ -0,0 +1,214 @@
+"""
+The sensors of the station, configured instead of hard coded.
+
+A sensor config is an INI file with one section per sensor; the section name is
+the sensor's name (its source in reports), `type` one of SENSOR_TYPES and the
+other keys its constructor arguments::
+
+    [rainfall_1]
+    type = rainfall
+
+    [bme680_1]
+    type = bme680
+    profile = precise
+    interval_s = 10
+
+Polled sensors also take `interval_s` and `phase_s`. With `max_interval_s`,
+a polled sensor samples adaptively between `min_interval_s` (default: its
+interval) and `max_interval_s`, depending on how fast its values change (see
+weather_station.adaptive). A sensor's module is only imported when a sensor of
+its type is configured, and the sensors are created in parallel (the BME680 and
+1-wire setup wait on their buses).
+"""
+import concurrent.futures
+import configparser
+import contextlib
+import importlib
+import logging
+import threading
+import time
+
+from .. import adaptive
+
+# Sensors that report on GPIO edges, started with start() and stopped with stop().
+EDGE = "edge"
+# Sensors the scheduler calls sample(ts) of, every interval_s.
+POLLED = "polled"
+
+# type -> ("module:Class", kind)
+SENSOR_TYPES = {
+    "anemometer": ("weather_station.sensors.anemometer:Anemometer", EDGE),
+    "rainfall": ("weather_station.sensors.rainfall:Rainfall", EDGE),
+    "wind_vane": ("weather_station.sensors.wind_vane:WindVane", EDGE),
+    "temperature": ("weather_station.sensors.temperature:Temperature", POLLED),
+    "bme680": ("weather_station.sensors.bme680:BME680", POLLED),
+}
+# What the station runs without a config.
+DEFAULT_SENSORS = ("rainfall", "bme680")
+
+
+class SensorConfig:
+    def __init__(
+        self, name, sensor_type, options=None, interval_s=None, phase_s=0.0, min_interval_s=None, max_interval_s=None
+    ):
+        if sensor_type not in SENSOR_TYPES:
+            raise ValueError(f"Unknown type {sensor_type!r} of sensor {name}, one of {', '.join(SENSOR_TYPES)}")
+        self.name = name
+        self.sensor_type = sensor_type
+        self.options = dict(options or {})
+        self.interval_s = interval_s
+        self.phase_s = phase_s
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+
+    @property
+    def kind(self):
+        return SENSOR_TYPES[self.sensor_type][1]
+
+    @property
+    def adaptive(self):
+        return self.max_interval_s is not None
+
+    def __repr__(self):
+        return f"<SensorConfig {self.name} ({self.sensor_type}) {self.options}>"
+
+
+def parse_value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def load_config(path):
+    """The SensorConfigs of the INI file at path, in the order of its sections."""
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(path) as f:
+        parser.read_file(f)
+    configs = []
+    for name in parser.sections():
+        options = {key: parse_value(value) for key, value in parser.items(name)}
+        if "type" not in options:
+            raise ValueError(f"Sensor {name} in {path} has no type")
+        sensor_type = options.pop("type")
+        interval_s = options.pop("interval_s", None)
+        phase_s = options.pop("phase_s", 0.0)
+        min_interval_s = options.pop("min_interval_s", None)
+        max_interval_s = options.pop("max_interval_s", None)
+        configs.append(SensorConfig(
+            name, sensor_type, options, interval_s=interval_s, phase_s=phase_s,
+            min_interval_s=min_interval_s, max_interval_s=max_interval_s,
+        ))
+    return configs
+
+
+def configs_from_types(sensor_types):
+    """One sensor of each type, named like rainfall_1."""
+    counts = {}
+    configs = []
+    for sensor_type in sensor_types:
+        counts[sensor_type] = counts.get(sensor_type, 0) + 1
+        configs.append(SensorConfig(f"{sensor_type}_{counts[sensor_type]}", sensor_type))
+    return configs
+
+
+class StartupProfile:
+    """How long imports and initialisation took, for --profile-startup."""
+
+    def __init__(self):
+        self.steps = []
+        self.lock = threading.Lock()
+        self.started_at = time.perf_counter()
+
+    @contextlib.contextmanager
+    def time(self, step):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.steps.append((step, started - self.started_at, time.perf_counter() - started))
+
+    def report(self):
+        lines = [f"{'step':<44} {'start ms':>9} {'took ms':>9}"]
+        for step, offset_s, duration_s in sorted(self.steps, key=lambda step: step[1]):
+            lines.append(f"{step:<44} {offset_s * 1000:>9.1f} {duration_s * 1000:>9.1f}")
+        lines.append(f"{'total':<44} {'':>9} {(time.perf_counter() - self.started_at) * 1000:>9.1f}")
+        return "\n".join(lines)
+
+
+def sensor_class(sensor_type, profile=None):
+    path, _ = SENSOR_TYPES[sensor_type]
+    module_name, class_name = path.split(":")
+    with profile.time(f"import {module_name}") if profile else contextlib.nullcontext():
+        module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def create_sensor(config, reporter, profile=None):
+    cls = sensor_class(config.sensor_type, profile)
+    with profile.time(f"init {config.name}") if profile else contextlib.nullcontext():
+        return cls(report_function=reporter(config.name), **config.options)
+
+
+def create_sensors(configs, reporter, profile=None):
+    """
+    Creates the configured sensors in parallel. Returns name -> sensor, in the
+    order of configs. reporter(name) returns the report function of a sensor.
+    """
+    if not configs:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(configs), thread_name_prefix="sensor-init"
+    ) as executor:
+        futures = [executor.submit(create_sensor, config, reporter, profile) for config in configs]
+    sensors = {}
+    for config, future in zip(configs, futures):
+        try:
+            sensors[config.name] = future.result()
+        except Exception:
+            # One broken sensor shouldn't take the others down.
+            logging.exception(f"Initialising sensor {config.name} failed")
+    return sensors
+
+
+def interval_s(config, sensor):
+    """The period a polled sensor is sampled at (the shortest one, if adaptive)."""
+    if config.adaptive and config.min_interval_s is not None:
+        period_s = config.min_interval_s
+    elif config.interval_s is not None:
+        period_s = config.interval_s
+    else:
+        period_s = importlib.import_module(type(sensor).__module__).REPORT_INTERVAL_S
+    # E.g. the conversion time of the BME680.
+    return max(period_s, getattr(sensor, "min_interval_s", 0))
+
+
+def start_sensors(configs, sensors, sensor_scheduler):
+    """Starts the edge sensors and schedules the polled ones."""
+    for config in configs:
+        sensor = sensors.get(config.name)
+        if sensor is None:
+            continue
+        if config.kind == EDGE:
+            sensor.start()
+        else:
+            period_s = interval_s(config, sensor)
+            job = sensor_scheduler.add_job(
+                config.name, sensor.sample, period_s=period_s, phase_s=config.phase_s, bus=sensor.bus,
+            )
+            if config.adaptive:
+                sensor.report_function = adaptive.AdaptiveSampling(
+                    config.name, job, sensor.report_function,
+                    min_interval_s=period_s, max_interval_s=config.max_interval_s,
+                )
+
+
+def stop_sensors(configs, sensors):
+    """Stops the edge sensors and the polled ones with threads of their own."""
+    for config in configs:
+        sensor = sensors.get(config.name)
+        if sensor is not None and hasattr(sensor, "stop"):
+            sensor.stop()
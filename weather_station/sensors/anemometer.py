@@ -1,17 +1,11 @@
-# FIXME: send a value of 0 if no ticks have been registered for so long that the speed on the next tick
-#        would be close to zero.
+import array
 import math
 import time
 import logging
+import threading
 
-import pigpio  # http://abyz.co.uk/rpi/pigpio/python.html
-
-logging.basicConfig(
-    filename="log_weather.log",
-    level=logging.DEBUG,
-    format="%(asctime)s %(message)s",
-    datefmt="%d/%m/%Y %I:%M:%S %p",
-)
+from .. import clock, hardware, metrics
+from ..sliding import SlidingExtremes, SlidingSum
 
 PIN_ANEMOMETER = 22
 
@@ -28,9 +22,25 @@ CIRCUMFERENCE_CM = (2 * math.pi) * RADIUS_CM
 
 GLITCH_MICROSECONDS = 1000  # 1ms
 
-MIN_REPORT_INTERVAL_S = 0.5
 COUNT_AS_0_TIMEOUT_MS = 5000
 
+# The pigpio callback only stores the tick of every signal in this ring buffer.
+# Must be a power of 2. At 1ms glitch filter it holds > 4s of the worst case.
+TICK_BUFFER_SIZE = 4096
+TICK_BUFFER_MASK = TICK_BUFFER_SIZE - 1
+
+# The aggregation worker samples the tick count at 4Hz like WMO recommends and
+# computes the 3s gust from the last 12 samples.
+SAMPLE_INTERVAL_S = 0.25
+GUST_SAMPLES = 12
+# name -> length of the windows the mean, gust (max 3s mean) and lull (min 3s mean)
+# are computed over.
+WINDOWS_S = {
+    "2min": 2 * 60,
+    "10min": 10 * 60,
+}
+REPORT_EVERY_SAMPLES = round(CALCULACTION_INTERVAL_S / SAMPLE_INTERVAL_S)
+
 
 def calculate_speed(
     duration_s,
@@ -49,56 +59,165 @@ def cm_per_s_to_km_per_h(cm_per_s):
     return cm_per_s * 60 * 60 / 100 / 1000
 
 
+def km_per_h(duration_us, tick_count):
+    if not duration_us:
+        return 0.0
+    speed_cms_per_s = calculate_speed(duration_s=duration_us / 1e6, tick_count=tick_count)
+    return round(cm_per_s_to_km_per_h(speed_cms_per_s), 3)
+
+
+class WindWindow:
+    """Mean, gust and lull over the last `samples` samples."""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.tick_count = SlidingSum()
+        self.duration_us = SlidingSum()
+        self.gusts = SlidingExtremes()
+
+    def add_sample(self, sample, tick_count, duration_us, gust_km_per_h=None):
+        cutoff = sample - self.samples + 1
+        self.tick_count.push(sample, tick_count)
+        self.tick_count.expire(cutoff)
+        self.duration_us.push(sample, duration_us)
+        self.duration_us.expire(cutoff)
+        if gust_km_per_h is not None:
+            self.gusts.push(sample, gust_km_per_h)
+            self.gusts.expire(cutoff)
+
+    @property
+    def mean_km_per_h(self):
+        return km_per_h(self.duration_us.total, self.tick_count.total)
+
+
 class Anemometer:
+    edge = hardware.RISING_EDGE
+
     def __init__(self, report_function, pin=PIN_ANEMOMETER):
         self.pin = pin
         self.report_function = report_function
-        self.last_tick_at = time.time()
-        self.tick_count = 0
-        self.pi = pigpio.pi()
+        self.ticks = array.array("I", bytes(4 * TICK_BUFFER_SIZE))
+        self.ticks_view = memoryview(self.ticks)
+        # Total number of ticks the callback has written to self.ticks and the
+        # aggregation worker has consumed.
+        self.ticks_written = 0
+        self.ticks_read = 0
+        self.sample = 0
+        self.sampled_at_tick = None
+        self.gust = WindWindow(GUST_SAMPLES)
+        self.windows = {
+            name: WindWindow(round(window_s / SAMPLE_INTERVAL_S))
+            for name, window_s in WINDOWS_S.items()
+        }
+        backend = hardware.get_backend()
+        self.pi = backend.gpio()
+        self.clock = clock.TickClock(self.pi, backend.time)
+        self.callback_lag = metrics.CALLBACK_LAG_SECONDS.labels("anemometer")
         self.callback = None
-        self.watchdog = None
+        self.worker = None
+        self.stopped = threading.Event()
         self.setup_hardware()
 
-    def start(self):
-        self.callback = self.pi.callback(self.pin, pigpio.RISING_EDGE, self.handle_tick)
-        self.watchdog = self.pi.set_watchdog(self.pin, COUNT_AS_0_TIMEOUT_MS)
+    def start(self, run_worker=True):
+        # Without the worker thread, aggregate() has to be called every
+        # SAMPLE_INTERVAL_S by someone else (e.g. a simulation in virtual time).
+        self.stopped.clear()
+        self.callback = self.pi.callback(
+            self.pin, self.edge, metrics.instrument_callback("anemometer", self.handle_tick)
+        )
+        if run_worker:
+            self.worker = threading.Thread(target=self.aggregate_loop, daemon=True)
+            self.worker.start()
 
     def stop(self):
         if self.callback:
             self.callback.cancel()
-            # FIXME: cancel watchdog
+            self.callback = None
+        self.stopped.set()
 
     def setup_hardware(self):
         if not self.pi.connected:
             logging.critical("Cannot connect to pigpio-pi")
 
-        self.pi.set_mode(self.pin, pigpio.INPUT)
-        self.pi.set_pull_up_down(self.pin, pigpio.PUD_UP)
+        self.pi.set_mode(self.pin, hardware.INPUT)
+        self.pi.set_pull_up_down(self.pin, hardware.PUD_UP)
         self.pi.set_glitch_filter(self.pin, GLITCH_MICROSECONDS)  # Ignore glitches.
 
     def handle_tick(self, gpio, level, tick):
-        if level == pigpio.TIMEOUT:
-            # There has not been any event for COUNT_AS_0_TIMEOUT_MS. Lets
-            # report 0 as speed.
-            self.report(0, ts=time.time())
+        # Runs on the pigpio callback thread for every signal. Keep it short.
+        self.ticks[self.ticks_written & TICK_BUFFER_MASK] = tick
+        self.ticks_written += 1
+
+    def handle_edges(self, ticks, levels):
+        """handle_tick for a batch of edges (uint32 arrays, see hardware.notify)."""
+        count = len(ticks)
+        # Only the newest TICK_BUFFER_SIZE ticks fit, the count includes all.
+        kept = ticks[-TICK_BUFFER_SIZE:]
+        start = (self.ticks_written + count - len(kept)) & TICK_BUFFER_MASK
+        first = min(len(kept), TICK_BUFFER_SIZE - start)
+        self.ticks_view[start:start + first] = kept[:first]
+        self.ticks_view[:len(kept) - first] = kept[first:]
+        self.ticks_written += count
+
+    def aggregate_loop(self):
+        next_sample_at = time.monotonic()
+        while not self.stopped.wait(max(0, next_sample_at - time.monotonic())):
+            self.aggregate()
+            next_sample_at += SAMPLE_INTERVAL_S
+            if next_sample_at < time.monotonic():
+                # We fell behind (e.g. the Pi was suspended), don't try to catch up.
+                next_sample_at = time.monotonic()
+
+    def aggregate(self):
+        """
+        Takes one sample: all ticks the callback has written since the last
+        sample. Updates the windows incrementally and reports every
+        REPORT_EVERY_SAMPLES samples.
+        """
+        written = self.ticks_written
+        now_tick = self.clock.current_tick()
+        if self.sampled_at_tick is None:
+            self.sampled_at_tick = now_tick
+            self.ticks_read = written
             return
-        current_tick_at, previous_tick_at = time.time(), self.last_tick_at
-        self.tick_count += 1
-
-        duration_s = current_tick_at - previous_tick_at
-        if duration_s < MIN_REPORT_INTERVAL_S:
-            # Don't report more than once every MIN_REPORT_INTERVAL_S.
-            # Just record the tick.
-            return
-        speed_cms_per_s = calculate_speed(
-            duration_s=duration_s, tick_count=self.tick_count
-        )
-        speed_km_per_h = cm_per_s_to_km_per_h(speed_cms_per_s)
-        speed_km_per_h = round(speed_km_per_h, 3)
-        self.report(speed_km_per_h, ts=current_tick_at)
-        self.tick_count = 0
-        self.last_tick_at = current_tick_at
+        tick_count = written - self.ticks_read
+        if tick_count:
+            newest_tick = self.ticks[(written - 1) & TICK_BUFFER_MASK]
+            self.callback_lag.observe(hardware.tick_diff(newest_tick, now_tick) / 1e6)
+        duration_us = hardware.tick_diff(self.sampled_at_tick, now_tick)
+        self.ticks_read = written
+        self.sampled_at_tick = now_tick
+        self.sample += 1
+
+        self.gust.add_sample(self.sample, tick_count, duration_us)
+        gust_km_per_h = self.gust.mean_km_per_h
+        for window in self.windows.values():
+            window.add_sample(self.sample, tick_count, duration_us, gust_km_per_h)
+
+        if self.sample % REPORT_EVERY_SAMPLES == 0:
+            self.report(
+                self.instantaneous_km_per_h(written, now_tick), ts=self.clock.to_time(now_tick)
+            )
+
+    def instantaneous_km_per_h(self, written, now_tick):
+        """Speed from the time between the last two ticks."""
+        if written < 2:
+            return 0.0
+        last_tick = self.ticks[(written - 1) & TICK_BUFFER_MASK]
+        since_last_us = hardware.tick_diff(last_tick, now_tick)
+        if since_last_us > COUNT_AS_0_TIMEOUT_MS * 1000:
+            return 0.0
+        period_us = hardware.tick_diff(self.ticks[(written - 2) & TICK_BUFFER_MASK], last_tick)
+        # If the next tick is overdue, the wind has slowed down at least that much.
+        return km_per_h(max(period_us, since_last_us), 1)
 
     def report(self, speed_km_per_h, ts):
-        self.report_function(data={"wind_speed_km_per_h": speed_km_per_h}, ts=ts)
+        data = {
+            "wind_speed_km_per_h": speed_km_per_h,
+            "wind_speed_3s_km_per_h": self.gust.mean_km_per_h,
+        }
+        for name, window in self.windows.items():
+            data[f"wind_speed_{name}_km_per_h"] = window.mean_km_per_h
+            data[f"wind_gust_{name}_km_per_h"] = window.gusts.max
+            data[f"wind_lull_{name}_km_per_h"] = window.gusts.min
+        self.report_function(data=data, ts=ts)
@@ -1,31 +1,75 @@
 # TODO: Find out if we could use pigpio or gpiozero instead of circuitpython to access the sensor
 #       (just to be consistent)
-import threading, time
-
-import board
-import busio
-import adafruit_bme680
+from .. import hardware, metrics
 
 
 REPORT_INTERVAL_S = 5
 
+# Oversampling, IIR filter and gas heater settings. One conversion takes
+# conversion_time_ms(**profile): fast ~36ms, balanced ~121ms, precise ~210ms.
+PROFILES = {
+    "fast": {
+        "temperature_oversample": 1,
+        "pressure_oversample": 1,
+        "humidity_oversample": 1,
+        "filter_size": 0,
+        "heater_temperature_c": 320,
+        "heater_duration_ms": 25,
+    },
+    "balanced": {
+        "temperature_oversample": 2,
+        "pressure_oversample": 4,
+        "humidity_oversample": 2,
+        "filter_size": 3,
+        "heater_temperature_c": 320,
+        "heater_duration_ms": 100,
+    },
+    "precise": {
+        "temperature_oversample": 8,
+        "pressure_oversample": 16,
+        "humidity_oversample": 4,
+        "filter_size": 7,
+        "heater_temperature_c": 320,
+        "heater_duration_ms": 150,
+    },
+}
+DEFAULT_PROFILE = "balanced"
+
+
+def conversion_time_ms(
+    temperature_oversample, pressure_oversample, humidity_oversample, heater_duration_ms, **settings
+):
+    """How long one forced-mode conversion takes (Bosch's calc_profile_dur)."""
+    measurement_cycles = temperature_oversample + pressure_oversample + humidity_oversample
+    duration_us = measurement_cycles * 1963 + 477 * 4 + 477 * 5 + 500
+    return duration_us // 1000 + 1 + heater_duration_ms
 
-class BME680(threading.Thread):
-    def __init__(self, report_function):
-        threading.Thread.__init__(self)
+
+class BME680:
+    # Reads on the same bus are never scheduled concurrently.
+    bus = "i2c"
+
+    def __init__(self, report_function, profile=DEFAULT_PROFILE):
         self.report_function = report_function
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.sensor = adafruit_bme680.Adafruit_BME680_I2C(self.i2c)
+        self.profile = profile
+        self.sensor = hardware.get_backend().bme680()
+        self.sensor.configure(**PROFILES[profile])
+
+    @property
+    def min_interval_s(self):
+        """Don't sample more often than this."""
+        return conversion_time_ms(**PROFILES[self.profile]) / 1000
 
     def get_readings(self):
+        # One conversion for all four values.
+        with metrics.SENSOR_READ_SECONDS.labels("bme680").time():
+            readings = self.sensor.read()
         return {
-            "temperature_c": round(self.sensor.temperature, 1),
-            "gas_ohms": self.sensor.gas,
-            "humidity_pct": round(self.sensor.humidity, 1),
-            "pressure_hpa": round(self.sensor.pressure, 1),
+            "temperature_c": round(readings["temperature"], 1),
+            "gas_ohms": readings["gas"],
+            "humidity_pct": round(readings["humidity"], 1),
+            "pressure_hpa": round(readings["pressure"], 1),
         }
 
-    def run(self):
-        while True:
-            self.report_function(data=self.get_readings(), ts=time.time())
-            time.sleep(REPORT_INTERVAL_S)
+    def sample(self, ts):
+        self.report_function(data=self.get_readings(), ts=ts)
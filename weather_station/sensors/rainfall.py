@@ -1,14 +1,8 @@
-import time
+import datetime
 import logging
 
-import pigpio  # http://abyz.co.uk/rpi/pigpio/python.html
-
-logging.basicConfig(
-    filename="log_weather.log",
-    level=logging.DEBUG,
-    format="%(asctime)s %(message)s",
-    datefmt="%d/%m/%Y %I:%M:%S %p",
-)
+from .. import clock, hardware, metrics
+from ..sliding import SlidingExtremes, SlidingSum
 
 PIN = 18
 
@@ -37,9 +31,23 @@ GLITCH_MICROSECONDS = 1000  # 1ms
 
 MIN_REPORT_INTERVAL_S = 1
 
+# Tips are counted in buckets of this size. The rolling totals and peak intensities
+# have this resolution.
+RAIN_BUCKET_S = 60
+# name -> length of the rolling windows reported as rain_<name>_mm and
+# rain_<name>_peak_mm_per_h. rain_today_mm is always reported (since local midnight).
+RAIN_WINDOWS_S = {
+    "10min": 10 * 60,
+    "1h": 60 * 60,
+    "24h": 24 * 60 * 60,
+}
+# Without tips the rolling totals still shrink. The watchdog makes sure they are
+# updated at least this often (60s is the maximum pigpio allows).
+WINDOWS_UPDATE_INTERVAL_MS = 60000
+
 
-def calculate_rainfall(tick_count):
-    return tick_count * BUCKET_SIZE_MM
+def calculate_rainfall(tick_count, bucket_size_mm=BUCKET_SIZE_MM):
+    return tick_count * bucket_size_mm
 
 
 def calculate_rainfall_per_hour(rain_amount_mm, duration_s):
@@ -47,35 +55,115 @@ def calculate_rainfall_per_hour(rain_amount_mm, duration_s):
     return rain_amount_mm_per_h
 
 
+class RainAccumulator:
+    """
+    Rolling rain totals and peak intensities. Tips are counted per RAIN_BUCKET_S
+    bucket; only buckets with tips are kept, so a dry day costs nothing.
+    """
+
+    def __init__(self, windows_s=RAIN_WINDOWS_S, bucket_s=RAIN_BUCKET_S):
+        self.bucket_s = bucket_s
+        # name -> (number of buckets, tips per bucket sum, tips per bucket max)
+        self.windows = {
+            name: (max(1, round(window_s / bucket_s)), SlidingSum(), SlidingExtremes())
+            for name, window_s in windows_s.items()
+        }
+        self.bucket = None
+        self.bucket_tips = 0
+        self.day = None
+        self.day_tips = 0
+
+    def add_tips(self, ts, tip_count=1):
+        self.advance(ts)
+        self.bucket_tips += tip_count
+        self.day_tips += tip_count
+
+    def advance(self, ts):
+        bucket = int(ts // self.bucket_s)
+        if bucket == self.bucket:
+            return
+        for bucket_count, tips, peaks in self.windows.values():
+            if self.bucket_tips:
+                tips.push(self.bucket, self.bucket_tips)
+                peaks.push(self.bucket, self.bucket_tips)
+            # The current bucket is not in the sliding windows yet.
+            tips.expire(bucket - bucket_count + 1)
+            peaks.expire(bucket - bucket_count + 1)
+        self.bucket = bucket
+        self.bucket_tips = 0
+        # Local midnight is always on a bucket boundary.
+        day = datetime.date.fromtimestamp(ts)
+        if day != self.day:
+            self.day = day
+            self.day_tips = 0
+
+    def totals(self):
+        mm_per_h_per_tip = BUCKET_SIZE_MM * (60 * 60) / self.bucket_s
+        data = {"rain_today_mm": round(calculate_rainfall(self.day_tips), 2)}
+        for name, (bucket_count, tips, peaks) in self.windows.items():
+            data[f"rain_{name}_mm"] = round(
+                calculate_rainfall(tips.total + self.bucket_tips), 2
+            )
+            peak_tips = max(peaks.max or 0, self.bucket_tips)
+            data[f"rain_{name}_peak_mm_per_h"] = round(peak_tips * mm_per_h_per_tip, 2)
+        return data
+
+
 class Rainfall:
-    def __init__(self, report_function, pin=PIN):
+    edge = hardware.RISING_EDGE
+
+    def __init__(self, report_function, pin=PIN, windows_s=RAIN_WINDOWS_S):
+        backend = hardware.get_backend()
         self.pin = pin
         self.report_function = report_function
-        self.last_tick_at = time.time()
+        self.pi = backend.gpio()
+        self.clock = clock.TickClock(self.pi, backend.time)
+        self.callback_lag = metrics.CALLBACK_LAG_SECONDS.labels("rainfall")
+        # Unwrapped tick (see clock.TickClock) of the last report.
+        self.reported_at_us = self.clock.elapsed_us(self.clock.current_tick())
         self.tick_count = 0
-        self.pi = pigpio.pi()
+        self.accumulator = RainAccumulator(windows_s=windows_s)
+        self.reported_totals = None
         self.callback = None
         self.setup_hardware()
 
     def start(self):
-        self.callback = self.pi.callback(self.pin, pigpio.RISING_EDGE, self.handle_tick)
+        self.callback = self.pi.callback(
+            self.pin, self.edge, metrics.instrument_callback("rainfall", self.handle_tick)
+        )
+        self.pi.set_watchdog(self.pin, WINDOWS_UPDATE_INTERVAL_MS)
 
     def stop(self):
         if self.callback:
             self.callback.cancel()
+            self.callback = None
+            self.pi.set_watchdog(self.pin, 0)
 
     def setup_hardware(self):
         if not self.pi.connected:
             logging.critical("Cannot connect to pigpio-pi")
 
-        self.pi.set_mode(self.pin, pigpio.INPUT)
-        self.pi.set_pull_up_down(self.pin, pigpio.PUD_UP)
+        self.pi.set_mode(self.pin, hardware.INPUT)
+        self.pi.set_pull_up_down(self.pin, hardware.PUD_UP)
         self.pi.set_glitch_filter(self.pin, GLITCH_MICROSECONDS)  # Ignore glitches.
 
     def handle_tick(self, gpio, level, tick):
-        current_tick_at, previous_tick_at = time.time(), self.last_tick_at
-        duration_s = current_tick_at - previous_tick_at
+        if level == hardware.TIMEOUT:
+            # No tips for WINDOWS_UPDATE_INTERVAL_MS. Report the rolling totals
+            # if older tips have dropped out of them.
+            now = self.clock.to_time(tick)
+            self.accumulator.advance(now)
+            totals = self.accumulator.totals()
+            if totals != self.reported_totals:
+                self.report_totals(totals, ts=now)
+            return
+        # Durations from the tick of the edge, not from when the callback runs.
+        duration_s = self.clock.duration_s(self.reported_at_us, tick)
+        current_tick_at = self.clock.to_time(tick)
+        # From the calibrated clock, asking pigpiod for the current tick is a round trip.
+        self.callback_lag.observe(self.clock.now() - current_tick_at)
         self.tick_count += 1
+        self.accumulator.add_tips(current_tick_at)
 
         if duration_s < MIN_REPORT_INTERVAL_S:
             # Don't report more than once every MIN_REPORT_INTERVAL_S.
@@ -96,10 +184,21 @@ class Rainfall:
         )
         # Reset counts for next report
         self.tick_count = 0
-        self.last_tick_at = current_tick_at
+        self.reported_at_us = self.clock.elapsed_us(tick)
+
+    def handle_edges(self, ticks, levels):
+        """handle_tick for a batch of edges (see hardware.notify). Tips are rare."""
+        for tick, level in zip(ticks.tolist(), levels.tolist()):
+            self.handle_tick(self.pin, level, tick)
 
     def report(self, rain_amount_mm, rain_amount_mm_per_h, ts):
         data = {"rain_amount_mm": rain_amount_mm}
         if rain_amount_mm_per_h is not None:
             data["rain_amount_mm_per_h"] = rain_amount_mm_per_h
+        self.reported_totals = self.accumulator.totals()
+        data.update(self.reported_totals)
         self.report_function(data=data, ts=ts)
+
+    def report_totals(self, totals, ts):
+        self.reported_totals = totals
+        self.report_function(data=dict(totals), ts=ts)
@@ -1,29 +1,135 @@
-import threading
-import time
+"""
+DS18B20 probes on the 1-wire bus.
 
-from w1thermsensor import W1ThermSensor
+Every probe found on the bus is read, each one under its own field name. The
+probes are configured as a comma separated list of id:field[:resolution]::
+
+    [temperature_1]
+    type = temperature
+    probes = 0000051234ab:temperature_soil_10cm_c:12, 0316a2794b2d:temperature_enclosure_c
+    resolution = 10
+
+Probes that aren't listed report as temperature_<id>_c, a single unlisted probe
+as temperature_underground_c. The resolution (9-12 bits, default: the probe's
+setting) trades precision for conversion time, 94ms at 9 bits up to 750ms at 12.
+
+A read blocks for the whole conversion. The probes are read concurrently, from
+one thread each, so a sample takes as long as the slowest probe, no matter how
+many there are. The kernel only overlaps the conversions of externally powered
+probes, parasite powered ones hold the bus while converting.
+"""
+import concurrent.futures
+import logging
+
+from .. import hardware, metrics
 
 
 REPORT_INTERVAL_S = 5
 
+# resolution (bits) -> conversion time (ms)
+CONVERSION_TIME_MS = {9: 94, 10: 188, 11: 375, 12: 750}
+DEFAULT_RESOLUTION = 12
+SINGLE_PROBE_FIELD = "temperature_underground_c"
+
+
+def parse_probes(text):
+    """'id:field[:resolution], ...' -> {id: (field, resolution or None)}"""
+    probes = {}
+    for entry in text.split(","):
+        parts = [part.strip() for part in entry.split(":")]
+        if len(parts) not in (2, 3) or not all(parts):
+            raise ValueError(f"Probe {entry.strip()!r} is not like id:field[:resolution]")
+        probes[parts[0]] = (parts[1], int(parts[2]) if len(parts) == 3 else None)
+    return probes
+
+
+class Probe:
+    def __init__(self, sensor, field, resolution=None):
+        if resolution is not None and resolution not in CONVERSION_TIME_MS:
+            raise ValueError(f"Resolution {resolution} of probe {sensor.id} is not one of 9-12 bits")
+        self.sensor = sensor
+        self.field = field
+        self.resolution = resolution
+        if resolution is not None:
+            try:
+                # Only in the probe's scratchpad, writing the EEPROM wears it out.
+                sensor.set_precision(resolution, persist=False)
+            except Exception:
+                # Needs write access to the probe's w1_slave file.
+                logging.warning(f"Setting the resolution of probe {sensor.id} failed", exc_info=True)
+
+    @property
+    def conversion_time_s(self):
+        return CONVERSION_TIME_MS[self.resolution or DEFAULT_RESOLUTION] / 1000
 
-class Temperature(threading.Thread):
-    def __init__(self, report_function):
-        threading.Thread.__init__(self)
+    def read(self):
+        with metrics.SENSOR_READ_SECONDS.labels("temperature").time():
+            return self.sensor.get_temperature()
+
+
+def read_probe(probe):
+    """(temperature, None) or (None, the exception), so one bad probe doesn't cost the others."""
+    try:
+        return probe.read(), None
+    except Exception as e:
+        return None, e
+
+
+class Temperature:
+    # Reads on the same bus are never scheduled concurrently.
+    bus = "w1"
+
+    def __init__(self, report_function, probes=None, resolution=None):
+        """
+        probes: 'id:field[:resolution], ...', see above. resolution applies to the
+        probes without one.
+        """
         self.report_function = report_function
-        # all these 1-wire sensor are connected to GPIO Pin 4
-        self.sensor = W1ThermSensor()
-
-    def get_temperature(self):
-        return self.sensor.get_temperature()
-
-    def run(self):
-        while True:
-            temperature_c = self.get_temperature()
-            self.report(temperature_c=temperature_c, ts=time.time())
-            time.sleep(REPORT_INTERVAL_S)
-
-    def report(self, temperature_c, ts=None):
-        return self.report_function(
-            data={"temperature_underground_c": temperature_c}, ts=ts
-        )
+        configured = parse_probes(probes) if probes else {}
+        sensors = hardware.get_backend().w1_sensors()
+        missing = set(configured) - {sensor.id for sensor in sensors}
+        if missing:
+            logging.warning(f"1-wire probes {', '.join(sorted(missing))} not found")
+        self.probes = []
+        for sensor in sensors:
+            if sensor.id in configured:
+                field, probe_resolution = configured[sensor.id]
+            elif len(sensors) == 1 and not configured:
+                field, probe_resolution = SINGLE_PROBE_FIELD, None
+            else:
+                field, probe_resolution = f"temperature_{sensor.id}_c", None
+            self.probes.append(Probe(sensor, field, probe_resolution or resolution))
+        self.executor = None
+        if len(self.probes) > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.probes), thread_name_prefix="w1-probe"
+            )
+
+    @property
+    def min_interval_s(self):
+        """Don't sample more often than this."""
+        return max((probe.conversion_time_s for probe in self.probes), default=0)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def get_temperatures(self):
+        """field -> temperature of every probe that could be read."""
+        if self.executor is None:
+            results = [read_probe(probe) for probe in self.probes]
+        else:
+            results = list(self.executor.map(read_probe, self.probes))
+        temperatures = {}
+        for probe, (temperature_c, error) in zip(self.probes, results):
+            if error is not None:
+                logging.warning(f"Reading 1-wire probe {probe.sensor.id} failed: {error!r}")
+            else:
+                temperatures[probe.field] = temperature_c
+        return temperatures
+
+    def sample(self, ts):
+        temperatures = self.get_temperatures()
+        if temperatures:
+            self.report_function(data=temperatures, ts=ts)
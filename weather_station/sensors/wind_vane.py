@@ -1,16 +1,9 @@
 # Based on https://github.com/MDreamer/WeatherStation/blob/master/WindVane.py
+import queue
 import threading
-import time
 import logging
 
-import pigpio  # http://abyz.co.uk/rpi/pigpio/python.html
-
-logging.basicConfig(
-    filename="log_weather.log",
-    level=logging.DEBUG,
-    format="%(asctime)s %(message)s",
-    datefmt="%d/%m/%Y %I:%M:%S %p",
-)
+from .. import clock, hardware, metrics
 
 # Wind vane params
 PIN_WIND_VANE = 17
@@ -30,20 +23,51 @@ GAP_S = GAP_MS / 1000.0
 TOLER_MIN = (100 - TOLERANCE) / 100.0
 TOLER_MAX = (100 + TOLERANCE) / 100.0
 
+FRAME_QUEUE_SIZE = 8
+MAX_MISMATCHES = 3
+
+# (index of the pulse in a frame, value of its bit) of the 4 direction bits.
+# A pulse of 400-600µs is a 0, anything else a 1.
+DIRECTION_BITS = ((8, 8), (10, 4), (12, 2), (14, 1))
+ZERO_BIT_MIN_US = 400
+ZERO_BIT_MAX_US = 600
+
+SHORT_FRAMES = metrics.REGISTRY.counter(
+    "wind_vane_short_frames_total", "Wind vane frames too short to decode (noise)"
+)
+
+DIRECTION_TEXTS = (
+    "N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+    "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW",
+)
+DIRECTION_ARROWS = (
+    "↑", "↑", "↗︎", "↗", "→", "→", "↘︎", "↘",
+    "↓", "↓", "↙︎", "↙", "←", "←", "↖︎", "↖",
+)
+
 
 class WindVane(threading.Thread):
+    edge = hardware.EITHER_EDGE
+
     def __init__(self, report_function, pin=PIN_WIND_VANE):
         threading.Thread.__init__(self)
         self.report_function = report_function
         self.code = []
-        self.fetching_code = False
         self.last_tick = 0
         self.in_code = False
         self.pin = pin
         self.direction_text = "nothing"
         self.direction_arrow = ""
         self.direction_degrees = "nothing"
-        self.pi = pigpio.pi()  # Connect to Pi.
+        # Completed (ts, pulse lengths) frames, filled by the pigpio callback.
+        self.frames = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.previous_frame = None
+        self.mismatches = 0
+        self.callback = None
+        backend = hardware.get_backend()
+        self.pi = backend.gpio()  # Connect to Pi.
+        self.clock = clock.TickClock(self.pi, backend.time)
         self.hwHandling()
 
     # for decoupling and mocking
@@ -51,31 +75,51 @@ class WindVane(threading.Thread):
         if not self.pi.connected:
             logging.critical("Cannot connect to pigpio-pi")
         self.pi.set_mode(
-            self.pin, pigpio.INPUT
+            self.pin, hardware.INPUT
         )  # wind vane connected to this pinWindVane.
         self.pi.set_glitch_filter(self.pin, GLITCH)  # Ignore glitches.
-        self.pi.callback(self.pin, pigpio.EITHER_EDGE, self.cbf)
+
+    def start(self, run_worker=True):
+        # Without the decoder thread, process_frames() has to be called regularly
+        # by someone else (e.g. a simulation in virtual time).
+        self.callback = self.pi.callback(
+            self.pin, self.edge, metrics.instrument_callback("wind_vane", self.cbf)
+        )
+        if run_worker:
+            threading.Thread.start(self)
+
+    def stop(self):
+        if self.callback:
+            self.callback.cancel()
+            self.callback = None
+        self.pi.set_watchdog(self.pin, 0)
+        self.stopped.set()
+        try:
+            # Wakes up the decoder. If the queue is full, it sees stopped after the next frame.
+            self.frames.put_nowait(None)
+        except queue.Full:
+            pass
 
     def cbf(self, gpio, level, tick):
 
-        if level != pigpio.TIMEOUT:
-            edge = pigpio.tickDiff(self.last_tick, tick)
+        if level != hardware.TIMEOUT:
+            edge = hardware.tick_diff(self.last_tick, tick)
 
             self.last_tick = tick
 
-            if self.fetching_code:
-                if (edge > PRE_US) and (not self.in_code):  # Start of a code.
-                    self.in_code = True
-                    self.pi.set_watchdog(self.pin, POST_MS)  # Start watchdog.
+            if (edge > PRE_US) and (not self.in_code):  # Start of a code.
+                self.in_code = True
+                self.code = []
+                self.pi.set_watchdog(self.pin, POST_MS)  # Start watchdog.
 
-                elif (edge > POST_US) and self.in_code:  # End of a code.
-                    self.in_code = False
-                    self.pi.set_watchdog(self.pin, 0)  # Cancel watchdog.
-                    self.end_of_code()
+            elif (edge > POST_US) and self.in_code:  # End of a code.
+                self.in_code = False
+                self.pi.set_watchdog(self.pin, 0)  # Cancel watchdog.
+                self.end_of_code()
 
-                elif self.in_code:
+            elif self.in_code:
 
-                    self.code.append(edge)
+                self.code.append(edge)
 
         else:
             self.pi.set_watchdog(self.pin, 0)  # Cancel watchdog.
@@ -84,92 +128,104 @@ class WindVane(threading.Thread):
                 self.in_code = False
                 self.end_of_code()
 
+    def handle_edges(self, ticks, levels):
+        """
+        cbf for a batch of edges (see hardware.notify), without the watchdog: a
+        long gap ends the frame before it, instead of the watchdog firing POST_MS
+        after its last edge.
+        """
+        # Watchdog timeouts are left over from the callback mode, gaps end frames here.
+        ticks = ticks[levels != hardware.TIMEOUT].astype("int64")
+        if not len(ticks):
+            return
+        gaps = ticks.copy()
+        gaps[0] -= self.last_tick
+        gaps[1:] -= ticks[:-1]
+        gaps &= 0xFFFFFFFF
+        for tick, edge in zip(ticks.tolist(), gaps.tolist()):
+            if edge > POST_US and self.in_code:
+                self.in_code = False
+                self.end_of_code()
+            self.last_tick = tick
+            if edge > PRE_US and not self.in_code:
+                self.in_code = True
+                self.code = []
+            elif self.in_code:
+                self.code.append(edge)
+
     def end_of_code(self):
-        if len(self.code) > SHORT:
-            self.fetching_code = False
-        else:
-            self.code = []
-            logging.critical("Error deciphering EOF")
+        code, self.code = self.code, []
+        if len(code) <= SHORT:
+            # Noise on the line, common in a storm.
+            SHORT_FRAMES.inc()
+            logging.debug(f"Skipping a wind vane frame of {len(code)} pulses")
+            return
+        try:
+            # Timestamped with the last edge of the frame.
+            self.frames.put_nowait((self.clock.to_time(self.last_tick), code))
+        except queue.Full:
+            # The decoder is behind. Skip this frame, newer ones will follow.
+            pass
 
     def run(self):
         self.loopWindVane()
 
     def loopWindVane(self):
+        while not self.stopped.is_set():
+            item = self.frames.get()
+            if item is None:
+                return
+            self.handle_frame(*item)
+
+    def process_frames(self):
+        """Handles the waiting frames without blocking (instead of running the thread)."""
         while True:
-            logging.debug("Starting reading wind vane")
-            dir_num = None
-            self.code = []
-            self.fetching_code = True
-            while self.fetching_code:
-                time.sleep(0.1)
-
-            time.sleep(0.5)
-            read_1 = self.code[:]
-            done = False
-            tries = 0
-            while not done:
-                self.code = []
-                self.fetching_code = True
-                while self.fetching_code:
-                    time.sleep(0.1)
-                read_2 = self.code[:]
-                the_same = self.compare(read_1, read_2)
-                if the_same:
-                    # OK reading
-                    done = True
-                    records = read_1[:]
-                    time.sleep(0.5)
-                else:
-                    tries += 1
-                    if tries <= 3:
-                        logging.debug("No match for wind vane")
-                    else:
-                        logging.debug("No match for wind vane, giving up after 3 tries")
-                        done = True
-                    time.sleep(0.5)
-
-            # Takes only the last 4 bit readings (out of 8)
-            # There are gaps between them so only take even numbers
-            if len(records) > 13:
-                compass = []
-
-                if records[8] > 400 and records[8] < 600:
-                    compass.append(0)
-                else:
-                    compass.append(1)
-
-                if records[10] > 400 and records[10] < 600:
-                    compass.append(0)
-                else:
-                    compass.append(1)
-
-                if records[12] > 400 and records[12] < 600:
-                    compass.append(0)
-                else:
-                    compass.append(1)
-
-                if records[14] > 400 and records[14] < 600:
-                    compass.append(0)
-                else:
-                    compass.append(1)
-
-                # number representation of the direction
-                dir_num = 0
-                for bit in compass:
-                    dir_num = (dir_num << 1) | bit
-
-            self.direction_text = self.numbers_to_direction(dir_num)
-            self.direction_arrow = self.numbers_to_arrow(dir_num)
-            self.direction_degrees = self.numbers_to_degrees(dir_num)
-            self.report(
-                text=self.direction_text,
-                arrow=self.direction_arrow,
-                degrees=self.direction_degrees,
-                ts=time.time(),
-            )
-            logging.debug(
-                "Finishing reading wind vane, direction: " + self.direction_text
-            )
+            try:
+                item = self.frames.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self.handle_frame(*item)
+
+    def handle_frame(self, ts, frame):
+        """
+        Decodes every frame that matches the one before it, so a direction is
+        reported for every frame the sensor sends.
+        """
+        previous, self.previous_frame = self.previous_frame, frame
+        if previous is None:
+            return
+        if not self.compare(previous, frame):
+            self.mismatches += 1
+            if self.mismatches == MAX_MISMATCHES:
+                logging.debug(f"No match for wind vane after {self.mismatches} frames")
+            return
+        self.mismatches = 0
+        # compare() averaged the two frames into previous.
+        dir_num = self.decode(previous)
+
+        self.direction_text = self.numbers_to_direction(dir_num)
+        self.direction_arrow = self.numbers_to_arrow(dir_num)
+        self.direction_degrees = self.numbers_to_degrees(dir_num)
+        self.report(
+            text=self.direction_text,
+            arrow=self.direction_arrow,
+            degrees=self.direction_degrees,
+            ts=ts,
+        )
+
+    def decode(self, records):
+        """
+        Takes only the last 4 bit readings (out of 8). There are gaps between them
+        so only the even pulses in DIRECTION_BITS are used.
+        """
+        if len(records) <= DIRECTION_BITS[-1][0]:
+            return None
+        dir_num = 0
+        for index, bit in DIRECTION_BITS:
+            if not ZERO_BIT_MIN_US < records[index] < ZERO_BIT_MAX_US:
+                dir_num |= bit
+        return dir_num
 
     def numbers_to_direction(self, argument):
         """
@@ -190,25 +246,9 @@ class WindVane(threading.Thread):
         1    1    1    0    NW
         1    1    1    1    NNW
         """
-        switcher = {
-            0: "N",
-            1: "NNE",
-            2: "NE",
-            3: "ENE",
-            4: "E",
-            5: "ESE",
-            6: "SE",
-            7: "SSE",
-            8: "S",
-            9: "SSW",
-            10: "SW",
-            11: "WSW",
-            12: "W",
-            13: "WNW",
-            14: "NW",
-            15: "NNW",
-        }
-        return switcher.get(argument, "nothing")
+        if argument is None:
+            return "nothing"
+        return DIRECTION_TEXTS[argument]
 
     def numbers_to_arrow(self, argument):
         """
@@ -229,29 +269,13 @@ class WindVane(threading.Thread):
         1    1    1    0    NW
         1    1    1    1    NNW
         """
-        switcher = {
-            0: "↑",
-            1: "↑",
-            2: "↗︎",
-            3: "↗",
-            4: "→",
-            5: "→",
-            6: "↘︎",
-            7: "↘",
-            8: "↓",
-            9: "↓",
-            10: "↙︎",
-            11: "↙",
-            12: "←",
-            13: "←",
-            14: "↖︎",
-            15: "↖",
-        }
-        return switcher.get(argument, "·")
+        if argument is None:
+            return "·"
+        return DIRECTION_ARROWS[argument]
 
     def numbers_to_degrees(self, argument):
         """
-        Converts the index like in the above switcher, but to degrees where
+        Converts the index like in the above tables, but to degrees where
         0 (North): 0
         4 (East): 90
         8 (South): 180
@@ -279,9 +303,8 @@ class WindVane(threading.Thread):
         if len(p1) != len(p2):
             return False
 
-        for i in range(len(p1)):
-            v = float(p2[i]) / float(p2[i])
-            if (v < TOLER_MIN) or (v > TOLER_MAX):
+        for a, b in zip(p1, p2):
+            if not (b * TOLER_MIN <= a <= b * TOLER_MAX):
                 return False
 
         for i in range(len(p1)):
@@ -0,0 +1,55 @@
+"""
+Sliding window aggregates with O(1) amortised updates.
+
+Values are pushed together with an increasing key (a timestamp or a sample
+number). expire(cutoff) drops everything with a key older than cutoff.
+"""
+import collections
+
+
+class SlidingSum:
+    def __init__(self):
+        self.entries = collections.deque()
+        self.total = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, key, value):
+        self.entries.append((key, value))
+        self.total += value
+
+    def expire(self, cutoff):
+        entries = self.entries
+        while entries and entries[0][0] < cutoff:
+            self.total -= entries.popleft()[1]
+
+
+class SlidingExtremes:
+    """Maximum and minimum of a sliding window (monotonic deques)."""
+
+    def __init__(self):
+        self._max = collections.deque()
+        self._min = collections.deque()
+
+    def push(self, key, value):
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((key, value))
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((key, value))
+
+    def expire(self, cutoff):
+        while self._max and self._max[0][0] < cutoff:
+            self._max.popleft()
+        while self._min and self._min[0][0] < cutoff:
+            self._min.popleft()
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else None
@@ -0,0 +1,222 @@
+"""
+Persistent store-and-forward spool for telemetry readings.
+
+Readings are appended to numbered segment files. Each record is a small binary
+header followed by the compact JSON encoded values::
+
+    <payload length: uint16> <crc32 of body: uint32> body=<ts_ms: int64><payload>
+
+A cursor file remembers how far the replayer got. Segments that have been
+replayed completely are deleted, the rest is evicted once the spool grows too
+big or too old. The spool is not thread safe; only the publisher thread uses it.
+"""
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+SEGMENT_MAGIC = b"WSSPOOL1"
+RECORD_HEADER = struct.Struct("<HI")
+RECORD_TS = struct.Struct("<q")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILENAME = "cursor"
+
+MAX_SEGMENT_BYTES = 4 * 1024 * 1024
+MAX_TOTAL_BYTES = 256 * 1024 * 1024
+MAX_AGE_S = 30 * 24 * 60 * 60
+FSYNC_EVERY_RECORDS = 1000
+FSYNC_INTERVAL_S = 30
+
+
+def encode_record(ts_ms, values):
+    payload = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    body = RECORD_TS.pack(ts_ms) + payload
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(body)) + body
+
+
+def iter_records(f):
+    """
+    Yields (ts_ms, values, end_offset) for every intact record from the current
+    position of f. Stops at the end of the file or at the first torn/corrupt record.
+    """
+    offset = f.tell()
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc = RECORD_HEADER.unpack(header)
+        body = f.read(RECORD_TS.size + length)
+        if len(body) < RECORD_TS.size + length or zlib.crc32(body) != crc:
+            logging.warning("Corrupt or incomplete spool record at offset %s in %s", offset, f.name)
+            return
+        (ts_ms,) = RECORD_TS.unpack_from(body)
+        offset += RECORD_HEADER.size + len(body)
+        yield ts_ms, json.loads(body[RECORD_TS.size:].decode("utf-8")), offset
+
+
+class Spool:
+    def __init__(
+        self,
+        directory,
+        max_segment_bytes=MAX_SEGMENT_BYTES,
+        max_total_bytes=MAX_TOTAL_BYTES,
+        max_age_s=MAX_AGE_S,
+        fsync_every_records=FSYNC_EVERY_RECORDS,
+        fsync_interval_s=FSYNC_INTERVAL_S,
+    ):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_age_s = max_age_s
+        self.fsync_every_records = fsync_every_records
+        self.fsync_interval_s = fsync_interval_s
+        os.makedirs(directory, exist_ok=True)
+
+        self._unsynced_records = 0
+        self._synced_at = time.monotonic()
+        self.cursor = self._load_cursor()
+        # Always start a fresh segment, the last one of a previous run may end
+        # in a torn record.
+        segments = self.segments()
+        self._segment = None
+        self._segment_seq = (segments[-1] if segments else 0) + 1
+        self._open_segment(self._segment_seq)
+        if self.cursor is None:
+            self.cursor = (segments[0] if segments else self._segment_seq, len(SEGMENT_MAGIC))
+        self.evict()
+
+    # Writing #
+    ###########
+
+    def append(self, readings):
+        """Appends (ts_ms, values) readings. Fsyncs in batches."""
+        for ts_ms, values in readings:
+            self._segment.write(encode_record(ts_ms, values))
+        self._unsynced_records += len(readings)
+        # Make the records visible to the replayer (same process), even if they
+        # are not on disk yet.
+        self._segment.flush()
+        if (
+            self._unsynced_records >= self.fsync_every_records
+            or time.monotonic() - self._synced_at >= self.fsync_interval_s
+        ):
+            self.sync()
+        if self._segment.tell() >= self.max_segment_bytes:
+            self.sync()
+            self._open_segment(self._segment_seq + 1)
+            self.evict()
+
+    def sync(self):
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self._unsynced_records = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self._segment.close()
+
+    def _open_segment(self, seq):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_seq = seq
+        self._segment = open(self._segment_path(seq), "ab")
+        if self._segment.tell() == 0:
+            self._segment.write(SEGMENT_MAGIC)
+            self._segment.flush()
+
+    # Replaying #
+    #############
+
+    def has_backlog(self):
+        seq, offset = self.cursor
+        return seq < self._segment_seq or offset < self._segment.tell()
+
+    def read_batches(self, batch_size, start=None):
+        """
+        Yields (readings, position) batches of at most batch_size readings, starting
+        at the given position (default: the committed cursor). Only one segment file
+        is open at a time and only one batch is held in memory. Pass the position of
+        a batch to commit() once it has been delivered.
+        """
+        seq, offset = start or self.cursor
+        for segment_seq in self.segments():
+            if segment_seq < seq:
+                continue
+            if segment_seq > seq:
+                offset = len(SEGMENT_MAGIC)
+            batch = []
+            end_offset = offset
+            with open(self._segment_path(segment_seq), "rb") as f:
+                f.seek(offset)
+                for ts_ms, values, end_offset in iter_records(f):
+                    batch.append((ts_ms, values))
+                    if len(batch) >= batch_size:
+                        yield batch, (segment_seq, end_offset)
+                        batch = []
+            if batch:
+                yield batch, (segment_seq, end_offset)
+            if segment_seq != self._segment_seq:
+                # Continue at the start of the next segment (skips corrupt tails).
+                yield [], (segment_seq + 1, len(SEGMENT_MAGIC))
+
+    def commit(self, position):
+        """Marks everything up to position as delivered."""
+        if position <= self.cursor:
+            return
+        self.cursor = position
+        path = os.path.join(self.directory, CURSOR_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(list(position), f)
+        os.replace(path + ".tmp", path)
+        for seq in self.segments():
+            if seq >= position[0]:
+                break
+            self._remove_segment(seq)
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILENAME)) as f:
+                seq, offset = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return seq, offset
+
+    # Housekeeping #
+    ################
+
+    def segments(self):
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def evict(self):
+        """Drops the oldest segments if the spool is too big or too old."""
+        sizes = {
+            seq: os.path.getsize(self._segment_path(seq)) for seq in self.segments()
+        }
+        total = sum(sizes.values())
+        too_old = time.time() - self.max_age_s
+        for seq, size in sorted(sizes.items()):
+            if seq == self._segment_seq:
+                break
+            if total <= self.max_total_bytes and os.path.getmtime(self._segment_path(seq)) >= too_old:
+                break
+            logging.warning("Evicting spool segment %s (%s bytes) before it was replayed", seq, size)
+            self._remove_segment(seq)
+            total -= size
+            if self.cursor[0] <= seq:
+                self.commit((seq + 1, len(SEGMENT_MAGIC)))
+
+    def _remove_segment(self, seq):
+        try:
+            os.remove(self._segment_path(seq))
+        except FileNotFoundError:
+            pass
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:010d}{SEGMENT_SUFFIX}")
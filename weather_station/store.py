@@ -0,0 +1,246 @@
+"""
+Local time-series store for readings.
+
+Readings are kept in three tiers: the raw readings and 1 minute and 1 hour
+rollups with min/max/sum/count of every numeric field. Each tier is a directory
+of append-only partition files covering a fixed time range, named after the
+start of that range, so a range query only opens the partitions it overlaps and
+retention deletes whole files. Records use the spool record format.
+
+Rollup buckets are kept in memory until FINALIZE_DELAY_S after they end and are
+then appended once. Readings that arrive later than that (or buckets flushed
+by close()) produce a second record for the same bucket; queries merge them.
+"""
+import logging
+import os
+import threading
+import time
+
+from .spool import encode_record, iter_records
+
+STORE_MAGIC = b"WSSTORE1"
+PARTITION_SUFFIX = ".seg"
+
+DAY_S = 24 * 60 * 60
+
+RAW = "raw"
+# name -> (bucket length s, partition length s, retention s)
+TIERS = {
+    RAW: (None, DAY_S, 7 * DAY_S),
+    "1min": (60, 7 * DAY_S, 90 * DAY_S),
+    "1h": (60 * 60, 365 * DAY_S, 10 * 365 * DAY_S),
+}
+ROLLUP_TIERS = ("1min", "1h")
+
+# Longest range that is answered from a tier when no tier is asked for.
+AUTO_TIER_MAX_RANGE_S = {
+    RAW: 6 * 60 * 60,
+    "1min": 7 * DAY_S,
+}
+
+FINALIZE_DELAY_S = 60
+FSYNC_INTERVAL_S = 60
+
+
+def is_numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def merge_aggregate(aggregate, other):
+    """Merges two [min, max, sum, count] aggregates into the first one."""
+    aggregate[0] = min(aggregate[0], other[0])
+    aggregate[1] = max(aggregate[1], other[1])
+    aggregate[2] += other[2]
+    aggregate[3] += other[3]
+
+
+class Tier:
+    """The partition files of one tier."""
+
+    def __init__(self, directory, name, bucket_s, partition_s, retention_s):
+        self.directory = os.path.join(directory, name)
+        self.name = name
+        self.bucket_s = bucket_s
+        self.partition_s = partition_s
+        self.retention_s = retention_s
+        self._partition = None
+        self._file = None
+        self.unsynced = False
+        os.makedirs(self.directory, exist_ok=True)
+
+    def append(self, records):
+        """Appends (ts_ms, values) records sorted by time."""
+        for ts_ms, values in records:
+            partition = ts_ms // 1000 // self.partition_s * self.partition_s
+            if partition != self._partition:
+                self._open_partition(partition)
+            self._file.write(encode_record(ts_ms, values))
+        if records:
+            self._file.flush()
+            self.unsynced = True
+
+    def sync(self):
+        if self._file and self.unsynced:
+            os.fsync(self._file.fileno())
+        self.unsynced = False
+
+    def close(self):
+        self.sync()
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._partition = None
+
+    def _open_partition(self, partition):
+        self.close()
+        self._partition = partition
+        self._file = open(self._partition_path(partition), "ab")
+        if self._file.tell() == 0:
+            self._file.write(STORE_MAGIC)
+
+    def partitions(self):
+        return sorted(
+            int(name[: -len(PARTITION_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(PARTITION_SUFFIX)
+        )
+
+    def read(self, start_ms, end_ms):
+        """Yields the (ts_ms, values) records with start_ms <= ts_ms < end_ms."""
+        for partition in self.partitions():
+            if (partition + self.partition_s) * 1000 <= start_ms or partition * 1000 >= end_ms:
+                continue
+            try:
+                f = open(self._partition_path(partition), "rb")
+            except FileNotFoundError:  # expired meanwhile
+                continue
+            with f:
+                if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                    logging.warning("Skipping %s, not a store partition", f.name)
+                    continue
+                for ts_ms, values, _ in iter_records(f):
+                    if start_ms <= ts_ms < end_ms:
+                        yield ts_ms, values
+
+    def expire(self, newest_ms):
+        """Deletes the partitions that end before the retention period."""
+        cutoff = newest_ms // 1000 - self.retention_s
+        for partition in self.partitions():
+            if partition + self.partition_s > cutoff:
+                break
+            if partition == self._partition:
+                self.close()
+            os.remove(self._partition_path(partition))
+
+    def _partition_path(self, partition):
+        return os.path.join(self.directory, f"{partition:010d}{PARTITION_SUFFIX}")
+
+
+class TimeSeriesStore:
+    """
+    Written by one thread (the telemetry publisher, see insert()), can be
+    queried from any thread.
+    """
+
+    def __init__(self, directory, tiers=TIERS, fsync_interval_s=FSYNC_INTERVAL_S):
+        self.directory = directory
+        self.fsync_interval_s = fsync_interval_s
+        self.tiers = {
+            name: Tier(directory, name, bucket_s, partition_s, retention_s)
+            for name, (bucket_s, partition_s, retention_s) in tiers.items()
+        }
+        # tier name -> {bucket ts_ms: {field: [min, max, sum, count]}}
+        self.open_buckets = {name: {} for name in self.tiers if name != RAW}
+        self.newest_ms = None
+        self.lock = threading.Lock()
+        self._synced_at = time.monotonic()
+
+    def insert(self, readings):
+        """Stores a batch of (ts_ms, values) readings and updates the rollups."""
+        if not readings:
+            return
+        readings = sorted(readings, key=lambda reading: reading[0])
+        with self.lock:
+            self.tiers[RAW].append(readings)
+            for name, buckets in self.open_buckets.items():
+                bucket_ms = self.tiers[name].bucket_s * 1000
+                for ts_ms, values in readings:
+                    bucket = buckets.setdefault(ts_ms // bucket_ms * bucket_ms, {})
+                    for field, value in values.items():
+                        if not is_numeric(value):
+                            continue
+                        aggregate = bucket.get(field)
+                        if aggregate is None:
+                            bucket[field] = [value, value, value, 1]
+                        else:
+                            merge_aggregate(aggregate, (value, value, value, 1))
+            previous_newest_ms = self.newest_ms
+            self.newest_ms = max(previous_newest_ms or 0, readings[-1][0])
+            self._finalize(self.newest_ms - FINALIZE_DELAY_S * 1000)
+            # Retention is checked once a day (of reading time).
+            day_ms = DAY_S * 1000
+            if previous_newest_ms is None or previous_newest_ms // day_ms != self.newest_ms // day_ms:
+                for tier in self.tiers.values():
+                    tier.expire(self.newest_ms)
+        if time.monotonic() - self._synced_at >= self.fsync_interval_s:
+            self.sync()
+
+    def _finalize(self, before_ms):
+        """Writes the rollup buckets that ended before before_ms."""
+        for name, buckets in self.open_buckets.items():
+            bucket_ms = self.tiers[name].bucket_s * 1000
+            done = sorted(ts_ms for ts_ms in buckets if ts_ms + bucket_ms <= before_ms)
+            self.tiers[name].append([(ts_ms, buckets.pop(ts_ms)) for ts_ms in done])
+
+    def sync(self):
+        with self.lock:
+            for tier in self.tiers.values():
+                tier.sync()
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._finalize(float("inf"))
+            for tier in self.tiers.values():
+                tier.close()
+
+    # Querying #
+    ############
+
+    def pick_tier(self, start_ms, end_ms):
+        for name, max_range_s in AUTO_TIER_MAX_RANGE_S.items():
+            if end_ms - start_ms <= max_range_s * 1000:
+                return name
+        return ROLLUP_TIERS[-1]
+
+    def query(self, field, start_ms, end_ms, tier=None):
+        """
+        Values of field with start_ms <= ts < end_ms, oldest first. From the raw
+        tier as (ts_ms, value), from a rollup tier as (ts_ms, min, max, mean, count).
+        Without a tier, the finest tier that is reasonable for the range is used.
+        """
+        tier = tier or self.pick_tier(start_ms, end_ms)
+        if tier == RAW:
+            return [
+                (ts_ms, values[field])
+                for ts_ms, values in self.tiers[RAW].read(start_ms, end_ms)
+                if field in values
+            ]
+        merged = {}
+        for ts_ms, values in self.tiers[tier].read(start_ms, end_ms):
+            if field in values:
+                self._merge_into(merged, ts_ms, values[field])
+        with self.lock:
+            for ts_ms, bucket in self.open_buckets[tier].items():
+                if start_ms <= ts_ms < end_ms and field in bucket:
+                    self._merge_into(merged, ts_ms, bucket[field])
+        return [
+            (ts_ms, minimum, maximum, total / count, count)
+            for ts_ms, (minimum, maximum, total, count) in sorted(merged.items())
+        ]
+
+    def _merge_into(self, merged, ts_ms, aggregate):
+        if ts_ms in merged:
+            merge_aggregate(merged[ts_ms], aggregate)
+        else:
+            merged[ts_ms] = list(aggregate)
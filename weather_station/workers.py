@@ -0,0 +1,282 @@
+"""
+Sensor groups in worker processes.
+
+Normally all sensors, the pigpio callback threads, the polling scheduler and the
+MQTT loop share one process and one GIL, so a slow 1-wire read or a big encode
+delays edge handling. With workers, every sensor group runs in its own process
+(and so, on the Pi, on its own core):
+
+    worker process  --RingBuffer-->  Supervisor thread  -->  report_function
+    (sensors)        shared memory   (main process)          (publisher, store, ...)
+
+A worker reports into a RingBuffer, a ring of JSON records in shared memory
+with any number of producer threads (in the worker) and one consumer. The Supervisor thread drains all rings every
+DRAIN_INTERVAL_S and restarts workers that died, with an exponential backoff.
+
+Workers are started with "spawn": they don't inherit the threads (and held
+locks) of the main process. Each worker has its own pigpio connection and its
+own metrics registry; only its log records go to the main process.
+"""
+import functools
+import json
+import logging
+import multiprocessing
+import signal
+import struct
+import sys
+import threading
+import time
+
+from . import hardware, logs
+
+CONTEXT = multiprocessing.get_context("spawn")
+
+RING_SIZE = 256 * 1024
+RECORD_HEADER = struct.Struct("<I")
+# How long the consumer waits for a ring's lock before trying again later.
+LOCK_TIMEOUT_S = 0.1
+
+DRAIN_INTERVAL_S = 0.05
+SUPERVISE_INTERVAL_S = 1
+MIN_RESTART_BACKOFF_S = 1
+MAX_RESTART_BACKOFF_S = 60
+# A worker that ran this long without crashing is restarted right away next time.
+STABLE_AFTER_S = 60
+STOP_TIMEOUT_S = 5
+
+
+class RingBuffer:
+    """
+    Length prefixed records in a shared byte array. write_position and
+    read_position count all bytes ever written and read; the producers move the
+    first, the single consumer the second. Producers (any number of threads)
+    hold the lock while they check for space, copy a record and move the write
+    position, so records never overlap. The consumer holds it only to read or
+    update a position, the records it copies out are ahead of read_position
+    and no producer overwrites them.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.buffer = CONTEXT.RawArray("B", size)
+        self.positions = CONTEXT.RawArray("Q", 2)
+        self.dropped = CONTEXT.RawValue("Q", 0)
+        self.lock = CONTEXT.Lock()
+        self._view = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_view"] = None
+        return state
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = memoryview(self.buffer).cast("B")
+        return self._view
+
+    def put(self, record):
+        """Appends record (bytes). Returns False (and drops it) if the ring is full."""
+        data = RECORD_HEADER.pack(len(record)) + record
+        with self.lock:
+            write, read = self.positions
+            if write + len(data) - read > self.size:
+                self.dropped.value += 1
+                return False
+            start = write % self.size
+            first = min(len(data), self.size - start)
+            self.view[start:start + first] = data[:first]
+            self.view[:len(data) - first] = data[first:]
+            self.positions[0] = write + len(data)
+        return True
+
+    def get_all(self):
+        """All records written since the last call, oldest first."""
+        if not self.lock.acquire(timeout=LOCK_TIMEOUT_S):
+            return []
+        try:
+            write, read = self.positions
+        finally:
+            self.lock.release()
+        records = []
+        while read < write:
+            (length,) = RECORD_HEADER.unpack(self._read(read, RECORD_HEADER.size))
+            records.append(self._read(read + RECORD_HEADER.size, length))
+            read += RECORD_HEADER.size + length
+        with self.lock:
+            self.positions[1] = read
+        return records
+
+    def _read(self, position, length):
+        start = position % self.size
+        end = start + length
+        if end <= self.size:
+            return bytes(self.view[start:end])
+        return bytes(self.view[start:]) + bytes(self.view[:end - self.size])
+
+
+def encode_reading(data, ts, source):
+    return json.dumps([ts, source, data], separators=(",", ":")).encode("utf-8")
+
+
+def decode_reading(record):
+    ts, source, data = json.loads(record.decode("utf-8"))
+    return data, ts, source
+
+
+def report_to_ring(ring, data, ts=None, source=None):
+    """The report function of the sensors in a worker process."""
+    if ts is None:
+        ts = time.time()
+    ring.put(encode_reading(data, ts, source))
+
+
+def run_worker(name, target, ring, stopped, backend_name, log_queue, log_level):
+    """Entry point of a worker process."""
+    # Ctrl-C reaches the whole process group. The main process stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if log_queue is not None:
+        logs.setup_worker_logging(log_queue, log_level)
+    hardware.use_backend(backend_name)
+
+    def reporter(source):
+        return functools.partial(report_to_ring, ring, source=source)
+
+    try:
+        target(reporter, stopped)
+    except Exception:
+        logging.exception(f"Worker {name} crashed")
+        sys.exit(1)
+
+
+class Worker:
+    def __init__(self, name, target, ring_size=RING_SIZE):
+        """target(reporter, stopped) runs the sensors until the stopped event is set."""
+        self.name = name
+        self.target = target
+        self.ring = RingBuffer(ring_size)
+        self.process = None
+        self.restarts = 0
+        # Records that couldn't be decoded.
+        self.corrupt_count = 0
+        self.started_at = None
+        self.backoff_s = MIN_RESTART_BACKOFF_S
+        # When a dead worker is restarted, None while it is running.
+        self.restart_at = None
+
+    def start(self, stopped, log_queue=None, log_level=logging.INFO):
+        """
+        Only call this while nobody drains the ring: before the Supervisor thread
+        runs, or from that thread (supervise() between drains). get_all would
+        otherwise take the old lock and update its position under the new one.
+        """
+        # If the previous process died holding the lock, it would never be released.
+        self.ring.lock = CONTEXT.Lock()
+        self.process = CONTEXT.Process(
+            target=run_worker,
+            name=f"weather-station-{self.name}",
+            args=(
+                self.name, self.target, self.ring, stopped, hardware.get_backend().name,
+                log_queue, log_level,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+
+    def stop(self, timeout_s=STOP_TIMEOUT_S):
+        if self.process is None:
+            return
+        self.process.join(timeout_s)
+        if self.process.is_alive():
+            logging.warning(f"Worker {self.name} didn't stop, terminating it")
+            self.process.terminate()
+            self.process.join()
+
+
+class Supervisor(threading.Thread):
+    def __init__(self, report_function):
+        threading.Thread.__init__(self, name="worker-supervisor", daemon=True)
+        self.report_function = report_function
+        self.workers = []
+        self.stopped = threading.Event()
+        self.workers_stopped = CONTEXT.Event()
+
+    def add_worker(self, name, target, ring_size=RING_SIZE):
+        worker = Worker(name, target, ring_size=ring_size)
+        self.workers.append(worker)
+        return worker
+
+    @property
+    def restarts(self):
+        return sum(worker.restarts for worker in self.workers)
+
+    @property
+    def dropped_count(self):
+        return sum(worker.ring.dropped.value for worker in self.workers)
+
+    @property
+    def corrupt_count(self):
+        return sum(worker.corrupt_count for worker in self.workers)
+
+    def start(self):
+        for worker in self.workers:
+            self._start_worker(worker)
+        threading.Thread.start(self)
+
+    def _start_worker(self, worker):
+        # Never concurrently with drain(), see Worker.start.
+        worker.start(
+            self.workers_stopped, log_queue=logs.worker_log_queue(CONTEXT),
+            log_level=logging.getLogger().level,
+        )
+
+    def stop(self):
+        self.workers_stopped.set()
+        for worker in self.workers:
+            worker.stop()
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        supervise_at = time.monotonic() + SUPERVISE_INTERVAL_S
+        while not self.stopped.wait(DRAIN_INTERVAL_S):
+            self.drain()
+            if time.monotonic() >= supervise_at:
+                self.supervise()
+                supervise_at = time.monotonic() + SUPERVISE_INTERVAL_S
+        self.drain()
+
+    def drain(self):
+        for worker in self.workers:
+            for record in worker.ring.get_all():
+                try:
+                    data, ts, source = decode_reading(record)
+                except Exception:
+                    worker.corrupt_count += 1
+                    logging.exception(f"Skipping corrupt record {record[:100]!r} of worker {worker.name}")
+                    continue
+                try:
+                    self.report_function(data, ts=ts, source=source)
+                except Exception:
+                    logging.exception(f"Reporting a reading of worker {worker.name} failed")
+
+    def supervise(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self._start_worker(worker)
+                continue
+            if worker.process.is_alive() or self.workers_stopped.is_set():
+                continue
+            if now - worker.started_at >= STABLE_AFTER_S:
+                worker.backoff_s = MIN_RESTART_BACKOFF_S
+            logging.error(
+                f"Worker {worker.name} died (exit code {worker.process.exitcode}), "
+                f"restarting it in {worker.backoff_s}s"
+            )
+            worker.restart_at = now + worker.backoff_s
+            worker.backoff_s = min(worker.backoff_s * 2, MAX_RESTART_BACKOFF_S)